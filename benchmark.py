@@ -0,0 +1,511 @@
+"""
+Retrieval benchmarks.
+
+    python benchmark.py index                  # recall@k vs latency of ANN indexes against flat
+    python benchmark.py index --synthetic 200000
+    python benchmark.py quantization           # memory, latency and recall@k of compressed vectors
+    python benchmark.py encode                 # ingest embedding throughput per batch size / pool size
+    python benchmark.py startup                # API import time, warm-up and first-query latency
+    python benchmark.py rerank                 # added rerank latency vs context size, over questions.json
+    python benchmark.py encoder                # query encode latency, RSS and parity of torch / ONNX / int8
+    python benchmark.py filter --synthetic 200000  # one-document retrieval: ID selector / exact subset vs post-filtering
+
+Without --synthetic the vectors stored in the current index version are used.
+"""
+import os
+import sys
+import json
+import argparse
+import subprocess
+import time
+import numpy as np
+import faiss
+import ingest
+import index_versions
+import rag
+import rerank
+import shards
+import metrics
+from chunk_store import ChunkStore, ids_in_ranges, in_ranges
+
+
+def synthetic_vectors(n, dimension=384, clusters=256, seed=0):
+    # Clustered unit vectors look more like sentence embeddings than uniform noise
+    rng = np.random.default_rng(seed)
+    centers = rng.standard_normal((clusters, dimension)).astype(np.float32)
+    vectors = centers[rng.integers(0, clusters, n)] + 0.6 * rng.standard_normal((n, dimension)).astype(np.float32)
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors
+
+
+def load_vectors(args):
+    if args.synthetic:
+        print(f"Generating {args.synthetic} synthetic vectors...")
+        return synthetic_vectors(args.synthetic)
+    index_dir = index_versions.current_dir()
+    if index_dir is None:
+        raise SystemExit("No index found; run ingestion or use --synthetic.")
+    store = ChunkStore(os.path.join(index_dir, ingest.CHUNK_STORE_DIR))
+    if store.vectors is not None:
+        return np.array(store.vectors, dtype=np.float32)
+    parts = []
+    for path in index_versions.index_files(index_dir):
+        stored = ingest.index_vectors(faiss.read_index(path))
+        if stored is None:
+            raise SystemExit("The current index only stores compressed codes; use --synthetic or a flat/hnsw/ivf index.")
+        parts.append(stored[1])
+    return np.ascontiguousarray(np.vstack(parts), dtype=np.float32)
+
+
+def make_queries(vectors, n, seed=1):
+    # Perturbed corpus vectors stand in for real questions
+    rng = np.random.default_rng(seed)
+    queries = vectors[rng.integers(0, len(vectors), n)] + 0.3 * rng.standard_normal((n, vectors.shape[1])).astype(np.float32)
+    queries /= np.linalg.norm(queries, axis=1, keepdims=True)
+    return queries
+
+
+def recall_at_k(found, truth, k):
+    hits = sum(len(set(f[:k]) & set(t[:k])) for f, t in zip(found, truth))
+    return hits / (k * len(truth))
+
+
+def timed_search(index, queries, k, params=None, vectors=None, rescore_factor=0):
+    """
+    Searches one query at a time on one thread, like /ask does.
+    With vectors and a rescore_factor, rescore_factor * k candidates are
+    re-ranked by exact distance, as rag.py does for quantized indexes.
+    Returns (ids, mean ms, p95 ms).
+    """
+    threads = faiss.omp_get_max_threads()
+    faiss.omp_set_num_threads(1)
+    found = []
+    latencies = []
+    try:
+        for query in queries:
+            start = time.perf_counter()
+            if rescore_factor:
+                _, ids = index.search(query[None, :], k * rescore_factor, params=params)
+                _, ids = rag.rescore(query[None, :], ids, lambda rows: vectors[rows], k)
+            else:
+                _, ids = index.search(query[None, :], k, params=params)
+            latencies.append((time.perf_counter() - start) * 1000)
+            found.append(ids[0])
+    finally:
+        faiss.omp_set_num_threads(threads)
+    return np.array(found), float(np.mean(latencies)), float(np.percentile(latencies, 95))
+
+
+def bench_index(args):
+    vectors = load_vectors(args)
+    n, dimension = vectors.shape
+    queries = make_queries(vectors, args.queries)
+    ids = np.arange(n, dtype=np.int64)
+
+    rows = []
+    flat = ingest.new_index(dimension, "flat")
+    flat.add_with_ids(vectors, ids)
+    truth, mean_ms, p95_ms = timed_search(flat, queries, args.k)
+    rows.append(("flat", "-", 0.0, 1.0, mean_ms, p95_ms))
+
+    sweeps = {
+        "hnsw": ("efSearch", [16, 32, 64, 128, 256], lambda v: faiss.SearchParametersHNSW(efSearch=v)),
+        "ivf": ("nprobe", [1, 4, 16, 64], lambda v: faiss.SearchParametersIVF(nprobe=v)),
+        "ivfpq": ("nprobe", [1, 4, 16, 64], lambda v: faiss.SearchParametersIVF(nprobe=v)),
+    }
+    for index_type in args.types:
+        knob, values, make_params = sweeps[index_type]
+        start = time.perf_counter()
+        train = vectors[:ingest.TRAIN_SAMPLE_SIZE] if ingest.needs_training(index_type) else None
+        index = ingest.new_index(dimension, index_type, train)
+        index.add_with_ids(vectors, ids)
+        build_s = time.perf_counter() - start
+        for value in values:
+            found, mean_ms, p95_ms = timed_search(index, queries, args.k, make_params(value))
+            rows.append((index_type, f"{knob}={value}", build_s, recall_at_k(found, truth, args.k), mean_ms, p95_ms))
+
+    print(f"\n{n} vectors, {dimension} dims, {len(queries)} queries, k={args.k}, searches on 1 thread\n")
+    print(f"| index | setting | build (s) | recall@{args.k} | mean (ms) | p95 (ms) |")
+    print("|---|---|---|---|---|---|")
+    for index_type, setting, build_s, recall, mean_ms, p95_ms in rows:
+        print(f"| {index_type} | {setting} | {build_s:.1f} | {recall:.3f} | {mean_ms:.3f} | {p95_ms:.3f} |")
+
+
+def index_bytes(index):
+    return len(faiss.serialize_index(index))
+
+
+def bench_quantization(args):
+    vectors = load_vectors(args)
+    n, dimension = vectors.shape
+    queries = make_queries(vectors, args.queries)
+    ids = np.arange(n, dtype=np.int64)
+    # The float vectors kept for re-scoring are memory-mapped from disk, not held per worker
+    float_mb = dimension * 4 * 1e6 / 2 ** 20
+
+    flat = ingest.new_index(dimension, "flat")
+    flat.add_with_ids(vectors, ids)
+    truth, mean_ms, p95_ms = timed_search(flat, queries, args.k)
+    rows = [("flat", "-", index_bytes(flat) / n, 1.0, mean_ms, p95_ms)]
+
+    for index_type in args.types:
+        train = vectors[:ingest.TRAIN_SAMPLE_SIZE] if ingest.needs_training(index_type) else None
+        index = ingest.new_index(dimension, index_type, train)
+        index.add_with_ids(vectors, ids)
+        params = faiss.SearchParametersIVF(nprobe=rag.DEFAULT_NPROBE) if index_type == "ivfpq" else None
+        bytes_per_vector = index_bytes(index) / n
+        for factor in [0] + args.rescore:
+            found, mean_ms, p95_ms = timed_search(index, queries, args.k, params, vectors, factor)
+            setting = f"rescore x{factor}" if factor else "-"
+            rows.append((index_type, setting, bytes_per_vector, recall_at_k(found, truth, args.k), mean_ms, p95_ms))
+
+    print(f"\n{n} vectors, {dimension} dims, {len(queries)} queries, k={args.k}, searches on 1 thread")
+    print(f"Re-scoring reads float vectors from the chunk store ({float_mb:.0f} MB per 1M chunks on disk, page cache shared by workers)\n")
+    print(f"| index | re-scoring | bytes/vector | RAM per 1M chunks (MB) | recall@{args.k} | mean (ms) | p95 (ms) |")
+    print("|---|---|---|---|---|---|---|")
+    for index_type, setting, bytes_per_vector, recall, mean_ms, p95_ms in rows:
+        print(f"| {index_type} | {setting} | {bytes_per_vector:.0f} | {bytes_per_vector * 1e6 / 2 ** 20:.0f} | {recall:.3f} | {mean_ms:.3f} | {p95_ms:.3f} |")
+
+
+def source_ranges(args, n):
+    """[first, end) id ranges of each source document: from the current chunk store, or --sources equal synthetic ones."""
+    if args.synthetic:
+        bounds = np.linspace(0, n, args.sources + 1).astype(np.int64)
+        return [np.array([[first, end]]) for first, end in zip(bounds[:-1], bounds[1:])]
+    store = ChunkStore(os.path.join(index_versions.current_dir(), ingest.CHUNK_STORE_DIR))
+    return [store.id_ranges([source]) for source in store.sources]
+
+
+def bench_filter(args):
+    vectors = load_vectors(args)
+    n, dimension = vectors.shape
+    queries = make_queries(vectors, args.queries)
+    ids = np.arange(n, dtype=np.int64)
+    all_ranges = source_ranges(args, n)
+    # Each query asks for one document, round robin
+    ranges = [all_ranges[i % len(all_ranges)] for i in range(len(queries))]
+
+    def run(search):
+        found, latencies = [], []
+        for query, query_ranges in zip(queries, ranges):
+            start = time.perf_counter()
+            found.append(search(query[None, :], query_ranges)[1][0])
+            latencies.append((time.perf_counter() - start) * 1000)
+        return found, float(np.mean(latencies)), float(np.percentile(latencies, 95))
+
+    def exact(query, query_ranges):
+        subset = ids_in_ranges(query_ranges)
+        return shards.exact_search(query, vectors[subset], subset, args.k)
+
+    def post_filter(index):
+        # The baseline: search the whole corpus for more hits, then drop the other documents
+        def search(query, query_ranges):
+            _, found = shards.search_index(index, query, args.k * args.overfetch, rag.DEFAULT_NPROBE, rag.DEFAULT_EF_SEARCH)
+            found = found[:, in_ranges(found[0], query_ranges)][:, :args.k]
+            return None, found
+        return search
+
+    threads = faiss.omp_get_max_threads()
+    faiss.omp_set_num_threads(1)
+    try:
+        truth, mean_ms, p95_ms = run(exact)
+        rows = [("-", "exact subset", 1.0, mean_ms, p95_ms)]
+        for index_type in args.types:
+            train = vectors[:ingest.TRAIN_SAMPLE_SIZE] if ingest.needs_training(index_type) else None
+            index = ingest.new_index(dimension, index_type, train)
+            index.add_with_ids(vectors, ids)
+            _, mean_ms, p95_ms = run(lambda query, _: shards.search_index(index, query, args.k, rag.DEFAULT_NPROBE, rag.DEFAULT_EF_SEARCH))
+            rows.append((index_type, "unfiltered", None, mean_ms, p95_ms))
+            found, mean_ms, p95_ms = run(post_filter(index))
+            rows.append((index_type, f"post-filter x{args.overfetch}", recall_at_k(found, truth, args.k), mean_ms, p95_ms))
+            found, mean_ms, p95_ms = run(lambda query, query_ranges: shards.search_index(index, query, args.k, rag.DEFAULT_NPROBE, rag.DEFAULT_EF_SEARCH, query_ranges))
+            rows.append((index_type, "ID selector", recall_at_k(found, truth, args.k), mean_ms, p95_ms))
+    finally:
+        faiss.omp_set_num_threads(threads)
+
+    sizes = [int((r[:, 1] - r[:, 0]).sum()) for r in all_ranges]
+    print(f"\n{n} vectors, {len(all_ranges)} documents of {min(sizes)}-{max(sizes)} chunks, {len(queries)} queries, k={args.k}, searches on 1 thread")
+    print(
+        f"rag.py compares subsets of up to RAG_FILTER_EXACT_MAX={rag.FILTER_EXACT_MAX} chunks exactly (on hnsw and ivf also up to "
+        f"RAG_FILTER_EXACT_FRACTION={rag.FILTER_EXACT_FRACTION} of the corpus), larger ones with the ID selector, "
+        f"whose nprobe / efSearch are raised up to RAG_FILTER_SEARCH_BOOST_MAX={shards.FILTER_SEARCH_BOOST_MAX} times\n"
+    )
+    print(f"| index | search | recall@{args.k} | mean (ms) | p95 (ms) |")
+    print("|---|---|---|---|---|")
+    for index_type, method, recall, mean_ms, p95_ms in rows:
+        print(f"| {index_type} | {method} | {'-' if recall is None else f'{recall:.3f}'} | {mean_ms:.3f} | {p95_ms:.3f} |")
+
+
+def load_texts(n, seed=0):
+    """Up to n chunk texts from the current index, or synthetic ones of 50-800 characters."""
+    index_dir = index_versions.current_dir()
+    if index_dir is not None:
+        store = ChunkStore(os.path.join(index_dir, ingest.CHUNK_STORE_DIR))
+        if len(store):
+            rows = np.random.default_rng(seed).permutation(len(store))[:n]
+            return [store.text_bytes(row).decode("utf-8") for row in rows]
+    rng = np.random.default_rng(seed)
+    words = "the aircraft engine fuel pressure checklist landing gear flaps airspeed altitude".split()
+    return [" ".join(rng.choice(words, size=rng.integers(8, 130))) for _ in range(n)]
+
+
+def bench_encode(args):
+    texts = load_texts(args.texts)
+    print(f"Encoding {len(texts)} texts with {ingest.EMBEDDING_MODEL_NAME}...")
+    model = ingest.load_model()
+    model.encode(texts[:32])
+
+    rows = []
+    start = time.perf_counter()
+    model.encode(texts, show_progress_bar=False)
+    rows.append(("model.encode defaults", "-", len(texts) / (time.perf_counter() - start)))
+    for workers in args.workers:
+        for batch_size in args.batch_sizes:
+            encoder = ingest.Encoder(model if workers == 1 else None, batch_size, args.threads, workers)
+            if workers > 1:
+                encoder.encode(texts[:workers * batch_size])  # start the pool and load the models
+                encoder.tokens = encoder.padded_tokens = encoder.unsorted_padded_tokens = 0
+            start = time.perf_counter()
+            encoder.encode(texts)
+            rate = len(texts) / (time.perf_counter() - start)
+            encoder.close()
+            padding = 100 * (encoder.padded_tokens - encoder.tokens) / max(encoder.tokens, 1)
+            rows.append((f"Encoder, {workers} process(es), {encoder.threads or 'default'} threads", f"{batch_size} ({padding:.0f}% padding)", rate))
+
+    print("\n| engine | batch size | vectors/s |")
+    print("|---|---|---|")
+    for engine, batch_size, rate in rows:
+        print(f"| {engine} | {batch_size} | {rate:.1f} |")
+
+
+STARTUP_SCRIPTS = {
+    # Importing the API module, as a worker process does before serving
+    "import": """
+import sys, time, json
+start = time.perf_counter()
+import main
+print(json.dumps({"import main": time.perf_counter() - start, "torch imported": "torch" in sys.modules}))
+""",
+    # No warm-up: the first query pays for loading the index and model
+    "cold": """
+import time, json
+import rag
+start = time.perf_counter()
+rag.retrieve(QUESTION)
+print(json.dumps({"first query, cold": time.perf_counter() - start}))
+""",
+    # Startup hook: warm-up first, then the first query
+    "warm": """
+import time, json
+import rag
+start = time.perf_counter()
+steps = rag.warm_up()
+warm_up = time.perf_counter() - start
+start = time.perf_counter()
+rag.retrieve(QUESTION)
+print(json.dumps({"warm-up": warm_up, **{"  " + k: v for k, v in (steps or {}).items()}, "first query, warm": time.perf_counter() - start}))
+""",
+}
+
+
+def run_script(script, **values):
+    """Runs script in a fresh interpreter, with values defined as globals, and returns the JSON it prints last."""
+    env = {**os.environ, "RAG_BATCH_WINDOW_MS": "0", "GROQ_API_KEY": os.getenv("GROQ_API_KEY", "benchmark")}
+    code = "".join(f"{name} = {value!r}\n" for name, value in values.items()) + script
+    result = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, env=env)
+    if result.returncode != 0:
+        raise SystemExit(result.stderr)
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def bench_startup(args):
+    if index_versions.current_dir() is None:
+        raise SystemExit("No index found; run ingestion first.")
+    samples = {}
+    for _ in range(args.runs):
+        for name in ("import", "cold", "warm"):
+            for key, value in run_script(STARTUP_SCRIPTS[name], QUESTION=args.question).items():
+                samples.setdefault(key, []).append(value)
+
+    print(f"\nMedian of {args.runs} fresh processes\n")
+    print("| step | seconds |")
+    print("|---|---|")
+    for key, values in samples.items():
+        if isinstance(values[0], bool):
+            print(f"| {key} | {values[0]} |")
+        else:
+            print(f"| {key} | {float(np.median(values)):.3f} |")
+
+
+# Loads one encoder backend in a fresh process, so its RSS and imports are not mixed with the others
+ENCODER_SCRIPT = """
+import sys, time, json, resource
+import numpy as np
+import rag
+rag.EMBEDDING_MODEL_NAME = MODEL
+start = time.perf_counter()
+model = rag.load_model(BACKEND)
+model.encode(["warm-up query"])
+load = time.perf_counter() - start
+latencies = []
+for text in TEXTS:
+    start = time.perf_counter()
+    model.encode([text])
+    latencies.append(1000 * (time.perf_counter() - start))
+start = time.perf_counter()
+embeddings = model.encode(TEXTS)
+batch = time.perf_counter() - start
+np.save(OUTPUT, np.asarray(embeddings, dtype=np.float32))
+print(json.dumps({
+    "load": load, "mean_ms": float(np.mean(latencies)), "p95_ms": float(np.percentile(latencies, 95)),
+    "batch_per_s": len(TEXTS) / batch, "torch": "torch" in sys.modules,
+    # Peak resident set size; kilobytes on Linux
+    "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+}))
+"""
+
+
+def bench_encoder(args):
+    import tempfile
+    import onnx_encoder
+    texts = []
+    if os.path.exists(args.questions):
+        with open(args.questions) as f:
+            texts = [question["question"] for question in json.load(f)]
+    texts = (texts or load_texts(args.texts))[:args.texts]
+    results, embeddings = {}, {}
+    with tempfile.TemporaryDirectory() as tmp:
+        for backend in args.backends:
+            output = os.path.join(tmp, f"{backend}.npy")
+            results[backend] = run_script(ENCODER_SCRIPT, MODEL=args.model, BACKEND=backend, TEXTS=texts, OUTPUT=output)
+            embeddings[backend] = np.load(output)
+
+    # Agreement of the top k chunks of the current index with those of the torch embeddings
+    state = rag.load_index_state()
+    index = state.index if state is not None else None
+    reference = embeddings.get("torch")
+    truth = None
+    if index is not None and reference is not None and index.d == reference.shape[1]:
+        truth = rag.rag_system.search(index, reference, args.k)[1]
+
+    print(f"\n{len(texts)} texts, one encode call per text, then one batched call\n")
+    print(f"| backend | load (s) | mean (ms) | p95 (ms) | batch (texts/s) | peak RSS (MB) | torch imported | cosine vs torch | top-{args.k} agreement |")
+    print("|---|---|---|---|---|---|---|---|---|")
+    for backend, result in results.items():
+        parity = f"{onnx_encoder.cosine_parity(reference, embeddings[backend]):.5f}" if reference is not None else "-"
+        agreement = f"{recall_at_k(rag.rag_system.search(index, embeddings[backend], args.k)[1], truth, args.k):.3f}" if truth is not None else "-"
+        print(f"| {backend} | {result['load']:.2f} | {result['mean_ms']:.2f} | {result['p95_ms']:.2f} | {result['batch_per_s']:.0f} | "
+              f"{result['peak_rss_mb']:.0f} | {result['torch']} | {parity} | {agreement} |")
+
+
+def source_found(hits, question):
+    """True if the chunk a question was generated from (or, for older files, its page) was retrieved."""
+    if "chunk_id" in question:
+        return any(hit["id"] == question["chunk_id"] for hit in hits)
+    return any((hit["source"], hit["page"]) == (question.get("source"), question.get("page")) for hit in hits)
+
+
+def bench_rerank(args):
+    # Imported here: llm creates the Groq client, which needs GROQ_API_KEY even to pack context
+    import llm
+    if index_versions.current_dir() is None:
+        raise SystemExit("No index found; run ingestion first.")
+    with open(args.questions) as f:
+        questions = json.load(f)[:args.limit]
+    system = rag.rag_system
+    system.batcher = None
+    rag.RERANK_CANDIDATES = args.candidates
+    # No score cache: every question pays for its cross-encoder passes
+    system.reranker = rerank.Reranker(batch_size=args.batch_size, deadline_ms=args.deadline_ms, cache_size=0)
+    system.warm_up()
+    system.reranker.ensure_loaded().predict([("warm-up query", "warm-up chunk")], show_progress_bar=False)
+
+    rows = []
+    for label, k, reranking in (("first stage", args.k, False), (f"rerank top {args.candidates}", args.rerank_k, True)):
+        latencies, rerank_ms, tokens, found, fallbacks = [], [], [], 0, 0
+        for question in questions:
+            trace = metrics.start_trace()
+            skipped = rerank.RERANKED._values.get(("deadline",), 0)
+            start = time.perf_counter()
+            hits = system.retrieve(question["question"], k=k, adaptive=False, rerank=reranking)
+            latencies.append(1000 * (time.perf_counter() - start))
+            rerank_ms.append(1000 * trace.get("rerank", 0.0))
+            fallbacks += rerank.RERANKED._values.get(("deadline",), 0) > skipped
+            tokens.append(llm.pack_context(hits)[1]["tokens_after"])
+            found += source_found(hits, question)
+        rows.append((label, k, np.mean(latencies), np.percentile(latencies, 95), np.mean(rerank_ms), np.percentile(rerank_ms, 95), np.mean(tokens), found / len(questions), fallbacks))
+
+    print(f"\n{len(questions)} questions, rerank batch size {args.batch_size}, deadline {args.deadline_ms:.0f} ms\n")
+    print("| retrieval | k | mean (ms) | p95 (ms) | rerank mean (ms) | rerank p95 (ms) | context tokens | source retrieved | deadline hit |")
+    print("|---|---|---|---|---|---|---|---|---|")
+    for label, k, mean_ms, p95_ms, rerank_mean, rerank_p95, mean_tokens, hit_rate, fallbacks in rows:
+        print(f"| {label} | {k} | {mean_ms:.1f} | {p95_ms:.1f} | {rerank_mean:.1f} | {rerank_p95:.1f} | {mean_tokens:.0f} | {hit_rate:.1%} | {fallbacks} |")
+    base, reranked = rows
+    print(f"\nRerank adds {reranked[2] - base[2]:.1f} ms mean ({reranked[3] - base[3]:.1f} ms p95) per question "
+          f"and changes the answer context by {100 * (reranked[6] - base[6]) / max(base[6], 1):+.0f}% tokens.")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    index_parser = sub.add_parser("index", help="recall@k vs latency of ANN index types")
+    index_parser.add_argument("--synthetic", type=int, default=0, help="use N synthetic vectors instead of the current index")
+    index_parser.add_argument("--queries", type=int, default=500)
+    index_parser.add_argument("--k", type=int, default=5)
+    index_parser.add_argument("--types", nargs="+", default=["hnsw", "ivf", "ivfpq"], choices=["hnsw", "ivf", "ivfpq"])
+    index_parser.set_defaults(func=bench_index)
+
+    quant_parser = sub.add_parser("quantization", help="memory, latency and recall@k of quantized indexes against flat")
+    quant_parser.add_argument("--synthetic", type=int, default=0, help="use N synthetic vectors instead of the current index")
+    quant_parser.add_argument("--queries", type=int, default=500)
+    quant_parser.add_argument("--k", type=int, default=5)
+    quant_parser.add_argument("--types", nargs="+", default=["fp16", "sq8", "pq"], choices=["fp16", "sq8", "pq", "ivfpq"])
+    quant_parser.add_argument("--rescore", nargs="*", type=int, default=[rag.RESCORE_FACTOR], help="candidate multipliers for exact re-scoring")
+    quant_parser.set_defaults(func=bench_quantization)
+
+    encode_parser = sub.add_parser("encode", help="vectors/s of the ingest encoder per batch size and pool size")
+    encode_parser.add_argument("--texts", type=int, default=2000)
+    encode_parser.add_argument("--batch-sizes", nargs="+", type=int, default=[16, 32, 64, 128])
+    encode_parser.add_argument("--workers", nargs="+", type=int, default=[1])
+    encode_parser.add_argument("--threads", type=int, default=None, help="intra-op threads per process")
+    encode_parser.set_defaults(func=bench_encode)
+
+    startup_parser = sub.add_parser("startup", help="import, warm-up and first-query latency of a fresh process")
+    startup_parser.add_argument("--runs", type=int, default=3)
+    startup_parser.add_argument("--question", default="What is the stall speed in landing configuration?")
+    startup_parser.set_defaults(func=bench_startup)
+
+    rerank_parser = sub.add_parser("rerank", help="added latency of the cross-encoder stage vs answer context size")
+    rerank_parser.add_argument("--questions", default="questions.json")
+    rerank_parser.add_argument("--limit", type=int, default=100)
+    rerank_parser.add_argument("--k", type=int, default=rag.TOP_K, help="chunks kept without reranking")
+    rerank_parser.add_argument("--rerank-k", type=int, default=3, help="chunks kept after reranking")
+    rerank_parser.add_argument("--candidates", type=int, default=rag.RERANK_CANDIDATES, help="first-stage hits reranked")
+    rerank_parser.add_argument("--batch-size", type=int, default=rerank.RERANK_BATCH_SIZE)
+    rerank_parser.add_argument("--deadline-ms", type=float, default=rerank.RERANK_DEADLINE_MS)
+    rerank_parser.set_defaults(func=bench_rerank)
+
+    encoder_parser = sub.add_parser("encoder", help="query encode latency, peak RSS and parity of the encoder backends")
+    encoder_parser.add_argument("--backends", nargs="+", default=list(rag.ENCODER_BACKENDS), choices=rag.ENCODER_BACKENDS)
+    encoder_parser.add_argument("--model", default=rag.EMBEDDING_MODEL_NAME, help="sentence-transformers model of the torch backend")
+    encoder_parser.add_argument("--questions", default="questions.json", help="texts to encode (chunk texts if missing)")
+    encoder_parser.add_argument("--texts", type=int, default=200)
+    encoder_parser.add_argument("--k", type=int, default=5)
+    encoder_parser.set_defaults(func=bench_encoder)
+
+    filter_parser = sub.add_parser("filter", help="latency and recall@k of one-document retrieval vs post-filtering")
+    filter_parser.add_argument("--synthetic", type=int, default=0, help="use N synthetic vectors instead of the current index")
+    filter_parser.add_argument("--sources", type=int, default=50, help="documents the synthetic vectors are split into")
+    filter_parser.add_argument("--queries", type=int, default=200)
+    filter_parser.add_argument("--k", type=int, default=5)
+    filter_parser.add_argument("--overfetch", type=int, default=10, help="hits fetched per kept hit when post-filtering")
+    filter_parser.add_argument("--types", nargs="+", default=["flat", "hnsw", "ivf", "sq8"], choices=list(ingest.INDEX_TYPES))
+    filter_parser.set_defaults(func=bench_filter)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
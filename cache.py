@@ -0,0 +1,280 @@
+import os
+import re
+import time
+import threading
+from collections import OrderedDict
+import numpy as np
+
+
+def normalize_question(text):
+    """Lowercases, collapses whitespace and drops trailing punctuation."""
+    text = " ".join(text.lower().split())
+    return re.sub(r"[\s?.!]+$", "", text)
+
+
+class AnswerCache:
+    """
+    Two-level cache of final answers, in front of the LLM.
+
+    Level 1 is an exact lookup on the normalized question.
+    Level 2 reuses the answer of a cached question whose embedding is within
+    max_distance cosine distance of the new one.
+    Entries expire after ttl seconds, the least recently used ones are evicted
+    beyond max_entries, and everything is dropped when the index version changes.
+    """
+    def __init__(self, max_entries=1024, ttl=3600, max_distance=0.05):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.max_distance = max_distance
+        self.version = None
+        self.exact_hits = 0
+        self.semantic_hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()  # question -> (value, unit embedding or None, created)
+        self._matrix = None            # stacked embeddings of _entries, rebuilt lazily
+        self._matrix_keys = []
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return self.max_entries > 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._matrix = None
+
+    def _sync_version(self, version):
+        if version != self.version:
+            self._entries.clear()
+            self._matrix = None
+            self.version = version
+
+    def _expired(self, created):
+        return self.ttl > 0 and time.monotonic() - created > self.ttl
+
+    def _drop(self, key):
+        del self._entries[key]
+        self._matrix = None
+
+    def get(self, question, version):
+        """Level 1: exact match on the normalized question."""
+        if not self.enabled:
+            return None
+        key = normalize_question(question)
+        with self._lock:
+            self._sync_version(version)
+            entry = self._entries.get(key)
+            if entry is None or self._expired(entry[2]):
+                if entry is not None:
+                    self._drop(key)
+                return None
+            self._entries.move_to_end(key)
+            self.exact_hits += 1
+            return entry[0]
+
+    def get_similar(self, embedding, version):
+        """Level 2: nearest cached question by cosine distance, if close enough."""
+        if not self.enabled:
+            return None
+        if embedding is None:
+            self.misses += 1
+            return None
+        query = _unit(embedding)
+        with self._lock:
+            self._sync_version(version)
+            if self._matrix is None:
+                self._matrix_keys = [key for key, entry in self._entries.items() if entry[1] is not None]
+                self._matrix = np.stack([self._entries[key][1] for key in self._matrix_keys]) if self._matrix_keys else None
+            if self._matrix is None:
+                self.misses += 1
+                return None
+            distances = 1.0 - self._matrix @ query
+            best = int(np.argmin(distances))
+            key = self._matrix_keys[best]
+            entry = self._entries[key]
+            if distances[best] > self.max_distance or self._expired(entry[2]):
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.semantic_hits += 1
+            return entry[0]
+
+    def put(self, question, embedding, value, version):
+        if not self.enabled:
+            return
+        key = normalize_question(question)
+        with self._lock:
+            self._sync_version(version)
+            self._entries[key] = (value, None if embedding is None else _unit(embedding), time.monotonic())
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+            self._matrix = None
+
+    def stats(self):
+        lookups = self.exact_hits + self.semantic_hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "exact_hits": self.exact_hits,
+            "semantic_hits": self.semantic_hits,
+            "misses": self.misses,
+            "hit_ratio": (self.exact_hits + self.semantic_hits) / lookups if lookups else 0.0
+        }
+
+
+def _unit(vector):
+    vector = np.asarray(vector, dtype=np.float32).reshape(-1)
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm > 0 else vector
+
+
+class EmbeddingCache:
+    """
+    Bounded LRU cache of query embeddings, keyed by model name and query text
+    (whitespace-normalized). Optionally persisted to an .npz file so that
+    evaluation runs and restarts start warm.
+    """
+    def __init__(self, max_entries=10000, path=None):
+        self.max_entries = max_entries
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        self.encode_seconds = 0.0  # time spent encoding misses, to estimate what hits save
+        self._entries = OrderedDict()  # (model name, text) -> float32 vector
+        self._dirty = False
+        self._lock = threading.Lock()
+        if path and os.path.exists(path):
+            self.load()
+
+    @property
+    def enabled(self):
+        return self.max_entries > 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    @staticmethod
+    def key(model_name, text):
+        return (model_name, " ".join(text.split()))
+
+    def get_many(self, model_name, texts):
+        """Returns a list with the cached vector, or None, for each text."""
+        if not self.enabled:
+            self.misses += len(texts)
+            return [None] * len(texts)
+        found = []
+        with self._lock:
+            for text in texts:
+                key = self.key(model_name, text)
+                vector = self._entries.get(key)
+                if vector is None:
+                    self.misses += 1
+                else:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                found.append(vector)
+        return found
+
+    def put_many(self, model_name, texts, vectors, seconds=0.0):
+        self.encode_seconds += seconds
+        if not self.enabled:
+            return
+        with self._lock:
+            for text, vector in zip(texts, vectors):
+                key = self.key(model_name, text)
+                self._entries[key] = np.array(vector, dtype=np.float32)
+                self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+            self._dirty = True
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._dirty = True
+
+    def load(self):
+        with np.load(self.path, allow_pickle=False) as data:
+            models, texts, vectors = data["models"], data["texts"], data["vectors"]
+        with self._lock:
+            for model_name, text, vector in zip(models, texts, vectors):
+                self._entries[(str(model_name), str(text))] = vector
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        print(f"Loaded {len(self._entries)} cached query embeddings from {self.path}")
+
+    def save(self):
+        """Writes the cache to path (if set and changed) via a temp file and rename."""
+        if not self.path or not self._dirty:
+            return
+        with self._lock:
+            keys = list(self._entries)
+            vectors = np.stack([self._entries[key] for key in keys]) if keys else np.zeros((0, 0), dtype=np.float32)
+            self._dirty = False
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            np.savez(f, models=np.array([k[0] for k in keys], dtype=str), texts=np.array([k[1] for k in keys], dtype=str), vectors=vectors)
+        os.replace(tmp_path, self.path)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        per_text = self.encode_seconds / self.misses if self.misses else 0.0
+        return {
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+            "encode_seconds": self.encode_seconds,
+            "estimated_seconds_saved": self.hits * per_text
+        }
+
+
+class ScoreCache:
+    """Bounded LRU cache of (query, chunk text) -> reranker score."""
+    def __init__(self, max_entries=10000):
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    @staticmethod
+    def key(query, text):
+        return (normalize_question(query), text)
+
+    def get_many(self, query, texts):
+        """Returns a list with the cached score, or None, for each text."""
+        found = []
+        with self._lock:
+            for text in texts:
+                key = self.key(query, text)
+                score = self._entries.get(key)
+                if score is None:
+                    self.misses += 1
+                else:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                found.append(score)
+        return found
+
+    def put_many(self, query, texts, scores):
+        if self.max_entries <= 0:
+            return
+        with self._lock:
+            for text, score in zip(texts, scores):
+                key = self.key(query, text)
+                self._entries[key] = float(score)
+                self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
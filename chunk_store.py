@@ -0,0 +1,262 @@
+import os
+import json
+import mmap
+import shutil
+from array import array
+import numpy as np
+
+# Files inside a chunk store directory
+TEXT_FILE = "text.bin"          # UTF-8 chunk texts, back to back
+OFFSETS_FILE = "offsets.npy"    # int64[n + 1], byte offsets of each row into text.bin
+IDS_FILE = "ids.npy"            # int64[n], index id of each row
+SOURCE_FILE = "source.npy"      # int32[n], position in sources.json
+PAGE_FILE = "page.npy"          # int32[n]
+SORTED_IDS_FILE = "sorted_ids.npy"  # int64[n], ids ascending, for lookups
+ORDER_FILE = "order.npy"        # int64[n], row of each entry in sorted_ids
+SOURCES_FILE = "sources.json"
+VECTORS_FILE = "vectors.npy"    # float32[n, dim], optional: the exact embedding of each row
+ID_RANGES_FILE = "id_ranges.npy"  # int64[m, 4], see id_range_table
+
+
+def id_range_table(ids, source, page):
+    """
+    Runs of consecutive ids with the same source and page, as rows of
+    (source, page, first id, end id), sorted by source and page. Ingestion numbers
+    the chunks of a document in order, so this is about one row per page.
+    """
+    ids = np.asarray(ids, dtype=np.int64)
+    if not len(ids):
+        return np.zeros((0, 4), dtype=np.int64)
+    order = np.lexsort((ids, page, source))
+    ids = ids[order]
+    source = np.asarray(source, dtype=np.int64)[order]
+    page = np.asarray(page, dtype=np.int64)[order]
+    breaks = (source[1:] != source[:-1]) | (page[1:] != page[:-1]) | (ids[1:] != ids[:-1] + 1)
+    starts = np.flatnonzero(np.concatenate([[True], breaks]))
+    ends = np.append(starts[1:], len(ids))
+    return np.stack([source[starts], page[starts], ids[starts], ids[ends - 1] + 1], axis=1)
+
+
+def ids_in_ranges(ranges):
+    """All ids of an (m, 2) array of [first, end) ranges, in order."""
+    ranges = np.asarray(ranges, dtype=np.int64).reshape(-1, 2)
+    lengths = ranges[:, 1] - ranges[:, 0]
+    return np.repeat(ranges[:, 0] - np.cumsum(lengths) + lengths, lengths) + np.arange(lengths.sum())
+
+
+def in_ranges(ids, ranges):
+    """Boolean mask of the ids that fall in sorted, disjoint [first, end) ranges."""
+    ids = np.asarray(ids, dtype=np.int64)
+    if not len(ranges):
+        return np.zeros(ids.shape, dtype=bool)
+    pos = np.searchsorted(ranges[:, 0], ids, side="right") - 1
+    return (pos >= 0) & (ids < ranges[np.maximum(pos, 0), 1])
+
+
+class ChunkStoreWriter:
+    """
+    Streams chunks into a new store directory.
+    Only a few fixed-size numbers per chunk are kept in memory; the texts and vectors go straight to disk.
+    Vectors are kept only if every row has one. The directory is written under a temporary name and moved into place by close().
+    """
+    def __init__(self, path):
+        self.path = path
+        self.tmp_path = path + ".tmp"
+        shutil.rmtree(self.tmp_path, ignore_errors=True)
+        os.makedirs(self.tmp_path)
+        self._text = open(os.path.join(self.tmp_path, TEXT_FILE), "wb")
+        self._vectors = open(os.path.join(self.tmp_path, VECTORS_FILE + ".raw"), "wb")
+        self._dimension = None
+        self._has_vectors = True
+        self._offsets = array("q", [0])
+        self._ids = array("q")
+        self._source = array("i")
+        self._page = array("i")
+        self._sources = {}
+
+    def __len__(self):
+        return len(self._ids)
+
+    def add(self, chunk_id, chunk, vector=None):
+        self.add_raw(chunk_id, chunk["text"].encode("utf-8"), chunk["source"], chunk["page"], vector)
+
+    def add_raw(self, chunk_id, text_bytes, source, page, vector=None):
+        self._add_vector(vector)
+        self._text.write(text_bytes)
+        self._offsets.append(self._offsets[-1] + len(text_bytes))
+        self._ids.append(int(chunk_id))
+        self._source.append(self._sources.setdefault(source, len(self._sources)))
+        self._page.append(int(page))
+
+    def _add_vector(self, vector):
+        if not self._has_vectors:
+            return
+        if vector is None:
+            self._has_vectors = False
+            return
+        vector = np.asarray(vector, dtype=np.float32).reshape(-1)
+        if self._dimension is None:
+            self._dimension = len(vector)
+        self._vectors.write(vector.tobytes())
+
+    def abort(self):
+        self._text.close()
+        self._vectors.close()
+        shutil.rmtree(self.tmp_path, ignore_errors=True)
+
+    def close(self):
+        self._text.close()
+        ids = np.frombuffer(self._ids, dtype=np.int64)
+        source = np.frombuffer(self._source, dtype=np.int32)
+        page = np.frombuffer(self._page, dtype=np.int32)
+        order = np.argsort(ids, kind="stable")
+        columns = {
+            OFFSETS_FILE: np.frombuffer(self._offsets, dtype=np.int64),
+            IDS_FILE: ids,
+            SOURCE_FILE: source,
+            PAGE_FILE: page,
+            SORTED_IDS_FILE: ids[order],
+            ORDER_FILE: order.astype(np.int64),
+            ID_RANGES_FILE: id_range_table(ids, source, page),
+        }
+        for name, values in columns.items():
+            np.save(os.path.join(self.tmp_path, name), values)
+        with open(os.path.join(self.tmp_path, SOURCES_FILE), "w") as f:
+            json.dump(list(self._sources), f)
+        self._write_vectors()
+
+        # Swap directories; readers that already mapped the old files keep them until they close
+        old_path = self.path + ".old"
+        shutil.rmtree(old_path, ignore_errors=True)
+        if os.path.exists(self.path):
+            os.replace(self.path, old_path)
+        os.replace(self.tmp_path, self.path)
+        shutil.rmtree(old_path, ignore_errors=True)
+
+    def _write_vectors(self):
+        # The raw float32 stream becomes an .npy file by prepending a header, without loading it
+        self._vectors.close()
+        raw_path = os.path.join(self.tmp_path, VECTORS_FILE + ".raw")
+        if self._has_vectors and len(self) and self._dimension:
+            header = {"descr": "<f4", "fortran_order": False, "shape": (len(self), self._dimension)}
+            with open(os.path.join(self.tmp_path, VECTORS_FILE), "wb") as out, open(raw_path, "rb") as raw:
+                np.lib.format.write_array_header_1_0(out, header)
+                shutil.copyfileobj(raw, out, 1 << 20)
+        os.remove(raw_path)
+
+
+class ChunkStore:
+    """
+    Read-only, memory-mapped view of a chunk store directory.
+    Processes that open the same store share its pages through the OS cache,
+    and chunk dicts are only built for the rows that are actually requested.
+    """
+    def __init__(self, path):
+        self.path = path
+
+        def load(name):
+            return np.load(os.path.join(path, name), mmap_mode="r")
+
+        self.offsets = load(OFFSETS_FILE)
+        self.ids = load(IDS_FILE)
+        self.source = load(SOURCE_FILE)
+        self.page = load(PAGE_FILE)
+        self.sorted_ids = load(SORTED_IDS_FILE)
+        self.order = load(ORDER_FILE)
+        # Stores written before vectors were kept, or from a legacy pickle, have none
+        self.vectors = load(VECTORS_FILE) if os.path.exists(os.path.join(path, VECTORS_FILE)) else None
+        with open(os.path.join(path, SOURCES_FILE)) as f:
+            self.sources = json.load(f)
+        self._source_codes = {name: code for code, name in enumerate(self.sources)}
+        # Stores written before the table existed get it computed once here
+        if os.path.exists(os.path.join(path, ID_RANGES_FILE)):
+            self.id_table = load(ID_RANGES_FILE)
+        else:
+            self.id_table = id_range_table(self.ids, self.source, self.page)
+        with open(os.path.join(path, TEXT_FILE), "rb") as f:
+            # mmap cannot map an empty file
+            self._text = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if os.fstat(f.fileno()).st_size else b""
+
+    @staticmethod
+    def exists(path):
+        return os.path.exists(os.path.join(path, ORDER_FILE))
+
+    def __len__(self):
+        return len(self.ids)
+
+    def row_of(self, chunk_id):
+        """Returns the row holding chunk_id, or -1."""
+        pos = int(np.searchsorted(self.sorted_ids, chunk_id))
+        if pos < len(self.sorted_ids) and self.sorted_ids[pos] == chunk_id:
+            return int(self.order[pos])
+        return -1
+
+    def rows_of(self, chunk_ids):
+        """Vectorized row_of: the row of each id, -1 where missing."""
+        chunk_ids = np.asarray(chunk_ids, dtype=np.int64)
+        if not len(self.sorted_ids):
+            return np.full(len(chunk_ids), -1, dtype=np.int64)
+        pos = np.minimum(np.searchsorted(self.sorted_ids, chunk_ids), len(self.sorted_ids) - 1)
+        return np.where(self.sorted_ids[pos] == chunk_ids, self.order[pos], -1)
+
+    def __contains__(self, chunk_id):
+        return self.row_of(chunk_id) != -1
+
+    def id_ranges(self, sources=None, page_range=None):
+        """
+        Sorted, merged [first, end) id ranges, shape (m, 2), of the chunks from the named
+        sources whose page is within page_range (first, last; inclusive). None means
+        no restriction; unknown sources match nothing.
+        """
+        table = self.id_table
+        if sources is not None:
+            # The table is sorted by source, so each source is one slice of it
+            codes = sorted({self._source_codes[name] for name in sources if name in self._source_codes})
+            column = table[:, 0]
+            slices = [table[np.searchsorted(column, code):np.searchsorted(column, code, side="right")] for code in codes]
+            table = np.concatenate(slices) if slices else table[:0]
+        if page_range is not None:
+            first, last = page_range
+            table = table[(table[:, 1] >= first) & (table[:, 1] <= last)]
+        ranges = np.asarray(table[np.argsort(table[:, 2], kind="stable"), 2:4], dtype=np.int64)
+        if not len(ranges):
+            return ranges
+        starts = np.flatnonzero(np.concatenate([[True], ranges[1:, 0] != ranges[:-1, 1]]))
+        ends = np.append(starts[1:], len(ranges)) - 1
+        return np.stack([ranges[starts, 0], ranges[ends, 1]], axis=1)
+
+    def text_bytes(self, row):
+        return self._text[int(self.offsets[row]):int(self.offsets[row + 1])]
+
+    def chunk(self, row):
+        return {
+            "text": self.text_bytes(row).decode("utf-8"),
+            "source": self.sources[self.source[row]],
+            "page": int(self.page[row])
+        }
+
+    def get(self, chunk_id, default=None):
+        row = self.row_of(chunk_id)
+        return self.chunk(row) if row != -1 else default
+
+    def __getitem__(self, chunk_id):
+        row = self.row_of(chunk_id)
+        if row == -1:
+            raise KeyError(chunk_id)
+        return self.chunk(row)
+
+    def items(self):
+        for row in range(len(self)):
+            yield int(self.ids[row]), self.chunk(row)
+
+    def copy_rows(self, writer, keep=None):
+        """Copies rows into writer without decoding them; keep(chunk_id) filters rows."""
+        for row in range(len(self)):
+            chunk_id = int(self.ids[row])
+            if keep is None or keep(chunk_id):
+                vector = self.vectors[row] if self.vectors is not None else None
+                writer.add_raw(chunk_id, self.text_bytes(row), self.sources[self.source[row]], self.page[row], vector)
+
+    def close(self):
+        if isinstance(self._text, mmap.mmap):
+            self._text.close()
@@ -1,4 +1,15 @@
+import os
+import sys
 import json
+import random
+import socket
+import argparse
+import asyncio
+import itertools
+import subprocess
+from contextlib import contextmanager
+import httpx
+import numpy as np
 import requests
 import pandas as pd
 from tqdm import tqdm
@@ -8,15 +19,80 @@ import time
 API_URL = "http://127.0.0.1:8000"
 QUESTIONS_FILE = "questions.json"
 REPORT_FILE = "report.md"
+# Questions per /ask_batch request in --batch mode
+BATCH_SIZE = 100
+LOAD_REPORT_FILE = "load_report.md"
 
-def evaluate():
+def score_result(question_text, category, data, latency):
+    answer = data["answer"]
+    retrieved_chunks = data["retrieved_chunks"]
+    return {
+        "question": question_text,
+        "category": category,
+        "answer": answer,
+        "citations": data["citations"],
+        "latency": latency,
+        "retrieved_chunks_count": len(retrieved_chunks),
+        "refusal": "not available in the provided document" in answer,
+        # Server-side breakdown (debug mode), one column per pipeline stage
+        **{f"{stage}_ms": ms for stage, ms in (data.get("timings_ms") or {}).items()}
+    }
+
+def evaluate_batch(questions):
+    """
+    Sends the questions to /ask_batch in groups of BATCH_SIZE.
+    Latency is the time from sending a group until that question's result arrived.
+    """
+    results = []
+    progress = tqdm(total=len(questions))
+    for offset in range(0, len(questions), BATCH_SIZE):
+        group = questions[offset:offset + BATCH_SIZE]
+        start_time = time.time()
+        try:
+            response = requests.post(
+                f"{API_URL}/ask_batch",
+                json={"questions": [q["question"] for q in group], "debug": True},
+                stream=True
+            )
+            response.raise_for_status()
+            for line in response.iter_lines():
+                if not line:
+                    continue
+                data = json.loads(line)
+                q = group[data["index"]]
+                if "error" in data:
+                    print(f"Error processing question '{q['question']}': {data['error']}")
+                    results.append({"question": q["question"], "error": data["error"]})
+                else:
+                    results.append(score_result(q["question"], q.get("category", "general"), data, time.time() - start_time))
+                progress.update(1)
+        except Exception as e:
+            print(f"Error processing batch at {offset}: {e}")
+            results.extend({"question": q["question"], "error": str(e)} for q in group)
+            progress.update(len(group))
+    progress.close()
+    return results
+
+def evaluate(batch=False):
     print("Loading questions...")
     with open(QUESTIONS_FILE, "r") as f:
         questions = json.load(f)
 
-    results = []
+    if batch:
+        print(f"Evaluating {len(questions)} questions via /ask_batch...")
+        results = evaluate_batch(questions)
+    else:
+        print(f"Evaluating {len(questions)} questions...")
+        results = evaluate_serial(questions)
+
+    # Save detailed results
+    pd.DataFrame(results).to_csv("evaluation_results.csv", index=False)
     
-    print(f"Evaluating {len(questions)} questions...")
+    # Generate Report
+    generate_report(results)
+
+def evaluate_serial(questions):
+    results = []
     for q in tqdm(questions):
         question_text = q["question"]
         category = q.get("category", "general")
@@ -32,27 +108,11 @@ def evaluate():
             
             latency = time.time() - start_time
             
-            answer = data["answer"]
-            citations = data["citations"]
-            retrieved_chunks = data["retrieved_chunks"]
-            
             # Metrics
             # 1. Retrieval Hit Rate (Approximation: Did we get chunks?)
             # Ideally we compare with ground truth source, but here we just check if chunks were returned.
-            retrieval_success = len(retrieved_chunks) > 0
-            
             # 2. Hallucination Check (Basic) - Did it refuse to answer?
-            refusal = "not available in the provided document" in answer
-            
-            results.append({
-                "question": question_text,
-                "category": category,
-                "answer": answer,
-                "citations": citations,
-                "latency": latency,
-                "retrieved_chunks_count": len(retrieved_chunks),
-                "refusal": refusal
-            })
+            results.append(score_result(question_text, category, data, latency))
             
         except Exception as e:
             print(f"Error processing question '{question_text}': {e}")
@@ -60,12 +120,7 @@ def evaluate():
                 "question": question_text,
                 "error": str(e)
             })
-
-    # Save detailed results
-    pd.DataFrame(results).to_csv("evaluation_results.csv", index=False)
-    
-    # Generate Report
-    generate_report(results)
+    return results
 
 def generate_report(results):
     df = pd.DataFrame(results)
@@ -95,6 +150,11 @@ def generate_report(results):
         )
         report += cat_stats.to_markdown()
 
+    stage_columns = [c for c in df.columns if c.endswith("_ms")]
+    if stage_columns:
+        report += "\n\n## Latency by Stage (ms)\n"
+        report += df[stage_columns].describe(percentiles=[0.5, 0.95]).loc[["mean", "50%", "95%"]].T.to_markdown()
+
     report += "\n\n## Qualitative Analysis\n(To be filled manually or with LLM-as-a-judge)\n"
 
     with open(REPORT_FILE, "w") as f:
@@ -102,5 +162,210 @@ def generate_report(results):
     
     print(f"Report saved to {REPORT_FILE}")
 
+async def send_request(client, question, stream):
+    """
+    One /ask or /ask/stream call. Returns its start time, latency, time to the
+    first streamed token (None for /ask) and error (None on success). A failed
+    LLM call is an error too, although /ask reports it with status 200.
+    """
+    start = time.perf_counter()
+    ttft = None
+    error = None
+    try:
+        if stream:
+            async with client.stream("POST", "/ask/stream", json={"question": question}) as response:
+                response.raise_for_status()
+                event = None
+                async for line in response.aiter_lines():
+                    if line.startswith("event: "):
+                        event = line[len("event: "):]
+                        if event == "token" and ttft is None:
+                            ttft = time.perf_counter() - start
+                    elif line.startswith("data: ") and event == "error":
+                        error = json.loads(line[len("data: "):]).get("detail", "error")
+                if error is None and event != "done":
+                    error = "stream ended without a 'done' event"
+        else:
+            response = await client.post("/ask", json={"question": question})
+            response.raise_for_status()
+            error = response.json().get("error")
+    except Exception as e:
+        error = f"{type(e).__name__}: {e}"
+    return {"start": start, "latency": time.perf_counter() - start, "ttft": ttft, "error": error}
+
+async def closed_loop(client, questions, clients, seconds, stream):
+    """clients concurrent users, each sending its next question as soon as the previous answer arrived."""
+    results = []
+    counter = itertools.count()
+    until = time.perf_counter() + seconds
+
+    async def user():
+        while time.perf_counter() < until:
+            question = questions[next(counter) % len(questions)]
+            results.append(await send_request(client, question, stream))
+
+    await asyncio.gather(*(user() for _ in range(clients)))
+    return results
+
+async def open_loop(client, questions, rate, seconds, stream, seed=0):
+    """
+    Poisson arrivals at rate requests/s. Requests go out on schedule whether or
+    not earlier ones finished, so queueing shows up in the latencies instead of
+    slowing down the load, as it would with real users.
+    """
+    rng = random.Random(seed)
+    tasks = []
+    start = time.perf_counter()
+    next_at = start
+    for i in itertools.count():
+        if next_at >= start + seconds:
+            break
+        await asyncio.sleep(max(0.0, next_at - time.perf_counter()))
+        tasks.append(asyncio.create_task(send_request(client, questions[i % len(questions)], stream)))
+        next_at += rng.expovariate(rate)
+    return list(await asyncio.gather(*tasks))
+
+def summarize(label, results, stream):
+    ok = [r for r in results if r["error"] is None]
+    elapsed = (max(r["start"] + r["latency"] for r in results) - min(r["start"] for r in results)) if results else 0.0
+
+    def percentiles(values):
+        if not values:
+            return [float("nan")] * 3
+        return [float(v) * 1000 for v in np.percentile(values, [50, 95, 99])]
+
+    summary = {
+        "run": label,
+        "requests": len(results),
+        "error_rate": (len(results) - len(ok)) / len(results) if results else 0.0,
+        "throughput": len(ok) / elapsed if elapsed > 0 else 0.0,
+    }
+    summary["p50_ms"], summary["p95_ms"], summary["p99_ms"] = percentiles([r["latency"] for r in ok])
+    if stream:
+        summary["ttft_p50_ms"], summary["ttft_p95_ms"], summary["ttft_p99_ms"] = percentiles(
+            [r["ttft"] for r in ok if r["ttft"] is not None]
+        )
+    errors = {}
+    for r in results:
+        if r["error"] is not None:
+            errors[r["error"]] = errors.get(r["error"], 0) + 1
+    return summary, errors
+
+async def load_test(url, questions, args):
+    """Runs a warm-up phase, then one measured phase per client count or arrival rate."""
+    timeout = httpx.Timeout(args.timeout)
+    limits = httpx.Limits(max_connections=None, max_keepalive_connections=None)
+    async with httpx.AsyncClient(base_url=url, timeout=timeout, limits=limits) as client:
+        if args.rate:
+            runs = [(f"open loop, {rate:g} req/s", lambda s, rate=rate: open_loop(client, questions, rate, s, args.stream)) for rate in args.rate]
+        else:
+            runs = [(f"closed loop, {n} clients", lambda s, n=n: closed_loop(client, questions, n, s, args.stream)) for n in args.clients]
+
+        summaries = []
+        for label, run in runs:
+            if args.warmup > 0:
+                print(f"{label}: warming up for {args.warmup:g}s...")
+                await run(args.warmup)
+            print(f"{label}: measuring for {args.duration:g}s...")
+            summary, errors = summarize(label, await run(args.duration), args.stream)
+            summaries.append(summary)
+            for error, count in sorted(errors.items(), key=lambda item: -item[1])[:5]:
+                print(f"  {count} x {error}")
+    return summaries
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+@contextmanager
+def local_server(stub_ms):
+    """
+    Starts the API on a free port with the stub LLM (see LLM_STUB_MS in llm.py) and
+    the answer cache off, so every request goes through retrieval and the server.
+    """
+    port = free_port()
+    env = {
+        **os.environ,
+        "LLM_STUB_MS": str(stub_ms),
+        "ANSWER_CACHE_SIZE": "0",
+        "GROQ_API_KEY": os.getenv("GROQ_API_KEY") or "stub",
+    }
+    server = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--host", "127.0.0.1", "--port", str(port), "--log-level", "warning"],
+        env=env
+    )
+    url = f"http://127.0.0.1:{port}"
+    try:
+        deadline = time.time() + 300
+        while True:
+            if server.poll() is not None:
+                raise SystemExit("The API server exited during startup.")
+            try:
+                if requests.get(f"{url}/ready", timeout=1).status_code == 200:
+                    break
+            except requests.RequestException:
+                pass
+            if time.time() > deadline:
+                raise SystemExit("The API server did not become ready.")
+            time.sleep(0.5)
+        yield url
+    finally:
+        server.terminate()
+        server.wait()
+
+def run_load_test(args):
+    with open(QUESTIONS_FILE, "r") as f:
+        questions = [q["question"] for q in json.load(f)]
+    endpoint = "/ask/stream" if args.stream else "/ask"
+
+    if args.stub_llm is not None:
+        print(f"Starting a local API server with a {args.stub_llm:g} ms stub LLM...")
+        with local_server(args.stub_llm) as url:
+            summaries = asyncio.run(load_test(url, questions, args))
+    else:
+        summaries = asyncio.run(load_test(args.url, questions, args))
+
+    columns = list(summaries[0])
+    lines = [
+        "# Load Test Report",
+        "",
+        f"- **Endpoint**: {endpoint}",
+        f"- **LLM**: {f'stub, {args.stub_llm:g} ms' if args.stub_llm is not None else 'Groq'}",
+        f"- **Questions**: {len(questions)}, warm-up {args.warmup:g}s, measured {args.duration:g}s per run",
+        "- Latency and time to first token (ttft) over successful requests; throughput in successful requests/s",
+        "",
+        "| " + " | ".join(columns) + " |",
+        "|" + "---|" * len(columns),
+    ]
+    def cell(column, value):
+        if column == "error_rate":
+            return f"{value:.1%}"
+        return f"{value:.1f}" if isinstance(value, float) else str(value)
+
+    for summary in summaries:
+        lines.append("| " + " | ".join(cell(c, v) for c, v in summary.items()) + " |")
+    report = "\n".join(lines) + "\n"
+    print("\n" + report)
+    with open(LOAD_REPORT_FILE, "w") as f:
+        f.write(report)
+    print(f"Report saved to {LOAD_REPORT_FILE}")
+
 if __name__ == "__main__":
-    evaluate()
+    parser = argparse.ArgumentParser(description="Evaluate answers, or load test the API with --load.")
+    parser.add_argument("--batch", action="store_true", help="send questions through /ask_batch")
+    parser.add_argument("--load", action="store_true", help="load test instead of evaluating answers")
+    parser.add_argument("--url", default=API_URL, help="API to load test")
+    parser.add_argument("--clients", nargs="+", type=int, default=[1, 4, 16], help="closed loop: concurrent clients per run")
+    parser.add_argument("--rate", nargs="+", type=float, help="open loop: Poisson arrival rates (requests/s) per run")
+    parser.add_argument("--duration", type=float, default=30, help="measured seconds per run")
+    parser.add_argument("--warmup", type=float, default=5, help="unmeasured seconds before each run")
+    parser.add_argument("--stream", action="store_true", help="use /ask/stream and report time to first token")
+    parser.add_argument("--stub-llm", type=float, nargs="?", const=500, default=None, metavar="MS",
+                        help="start a local API whose LLM answers after MS ms (default 500) instead of calling Groq")
+    parser.add_argument("--timeout", type=float, default=120, help="per-request timeout in seconds")
+    args = parser.parse_args()
+    if args.load:
+        run_load_test(args)
+    else:
+        evaluate(batch=args.batch)
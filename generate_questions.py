@@ -1,85 +1,289 @@
-import pickle
+"""
+Generates evaluation questions from random chunks of the current index.
+
+    python generate_questions.py                    # resumes an interrupted run if there is one
+    python generate_questions.py --fresh            # ignores the checkpoint
+    python generate_questions.py --concurrency 8 --per-prompt 5
+
+Prompts cover several chunks each and run concurrently, paced by token buckets
+for Groq's requests-per-minute and tokens-per-minute limits. Rate-limited (429)
+and transient failures are retried with exponential backoff. Every finished
+prompt is appended to a checkpoint file, so an interrupted run picks up where it stopped.
+"""
 import random
 import json
 import os
-from llm import ask_llm
+import time
+import asyncio
+import argparse
+import groq
+import llm
+from chunk_store import ChunkStore
+import index_versions
 
-CHUNKS_FILE = "chunks.pkl"
 OUTPUT_FILE = "questions.json"
+# One JSON line per finished prompt; removed once OUTPUT_FILE is written
+CHECKPOINT_FILE = OUTPUT_FILE + ".partial"
 
-def generate_questions():
-    if not os.path.exists(CHUNKS_FILE):
-        print("Chunks file not found. Run ingestion first.")
-        return
+# Questions wanted per category
+CATEGORIES = {
+    "factual": 20,
+    "applied": 20,
+    "reasoning": 10
+}
 
-    with open(CHUNKS_FILE, "rb") as f:
-        chunks = pickle.load(f)
-    
-    print(f"Loaded {len(chunks)} chunks. Sampling for question generation...")
-    
-    questions = []
-    
-    # Categories
-    categories = {
-        "factual": 20,
-        "applied": 20,
-        "reasoning": 10
-    }
-    
-    # We will sample random chunks and ask LLM to generate questions
-    # To get 50 questions, we might need to try multiple times or batch chunks
-    
-    total_needed = 50
-    generated_count = 0
-    
-    # Simple strategy: iterate and generate
-    # Shuffle chunks to get random coverage
-    random.shuffle(chunks)
-    
-    for category, count in categories.items():
-        print(f"Generating {count} {category} questions...")
-        current_cat_count = 0
-        
-        while current_cat_count < count:
-            if not chunks:
-                break
-                
-            chunk = chunks.pop()
-            text = chunk["text"]
-            
-            prompt = f"""
-            You are an expert aviation instructor.
-            Based strictly on the following text, generate 1 {category} question.
-            
-            Definition of {category} question:
-            - factual: Simple definition or lookup.
-            - applied: Scenario-based, operational or procedural.
-            - reasoning: Multi-step, trade-offs, conditional logic.
-            
-            Text:
-            {text[:1500]}
-            
-            Output ONLY the question.
-            """
-            
+# Prompts in flight at once
+CONCURRENCY = int(os.getenv("QUESTIONS_CONCURRENCY", "4"))
+# Chunks (and so questions) per prompt
+CHUNKS_PER_PROMPT = int(os.getenv("QUESTIONS_CHUNKS_PER_PROMPT", "5"))
+# Match these to the Groq rate limits of the account and model
+REQUESTS_PER_MINUTE = float(os.getenv("GROQ_REQUESTS_PER_MINUTE", "30"))
+TOKENS_PER_MINUTE = float(os.getenv("GROQ_TOKENS_PER_MINUTE", "8000"))
+# Attempts per prompt, and the first backoff delay in seconds (doubled per attempt)
+MAX_ATTEMPTS = 6
+BACKOFF_SECONDS = 2.0
+# Rough output size of one prompt, counted against the token bucket up front
+COMPLETION_TOKENS_PER_QUESTION = 60
+EXCERPT_CHARS = 1500
+
+# Replaces llm.SYSTEM_PROMPT, whose answer-only-from-context guardrails are for answering, not writing questions
+SYSTEM_PROMPT = """You are an expert aviation instructor writing exam questions.
+Each question must be answerable from its excerpt alone.
+Reply with JSON only, no commentary."""
+
+
+class TokenBucket:
+    """
+    Allows rate_per_minute units per minute on average, with bursts up to capacity.
+    acquire(n) waits until n units are available; pause(seconds) empties the bucket
+    for a while, e.g. after a 429 with a retry-after header.
+    """
+    def __init__(self, rate_per_minute, capacity=None):
+        self.rate = rate_per_minute / 60.0
+        self.capacity = capacity or rate_per_minute
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self, amount=1):
+        amount = min(amount, self.capacity)
+        async with self._lock:
+            while True:
+                self._refill()
+                if self.tokens >= amount:
+                    self.tokens -= amount
+                    return
+                await asyncio.sleep((amount - self.tokens) / self.rate)
+
+    def pause(self, seconds):
+        self._refill()
+        self.tokens = min(self.tokens, -seconds * self.rate)
+
+
+def build_prompt(category, chunks):
+    excerpts = "\n\n".join(f"[{i}]\n{chunk['text'][:EXCERPT_CHARS]}" for i, chunk in enumerate(chunks, start=1))
+    return f"""
+    Based strictly on each of the following numbered excerpts, generate 1 {category} question per excerpt.
+
+    Definition of {category} question:
+    - factual: Simple definition or lookup.
+    - applied: Scenario-based, operational or procedural.
+    - reasoning: Multi-step, trade-offs, conditional logic.
+
+    Excerpts:
+    {excerpts}
+
+    Output ONLY a JSON array with one object per excerpt, like
+    [{{"excerpt": 1, "question": "..."}}, {{"excerpt": 2, "question": "..."}}]
+    """
+
+
+def parse_questions(text, count):
+    """
+    Returns {excerpt number: question} from a model response, tolerating extra text
+    (including other brackets) around the JSON: the first JSON array in it is used.
+    """
+    text = text or ""
+    decoder = json.JSONDecoder()
+    items = []
+    start = text.find("[")
+    while start != -1:
+        try:
+            value, _ = decoder.raw_decode(text, start)
+        except ValueError:
+            value = None
+        if isinstance(value, list):
+            items = value
+            break
+        start = text.find("[", start + 1)
+    questions = {}
+    for item in items:
+        if not isinstance(item, dict):
+            continue
+        try:
+            number = int(item.get("excerpt"))
+        except (TypeError, ValueError):
+            continue
+        question = str(item.get("question", "")).strip()
+        if 1 <= number <= count and len(question) > 10:
+            questions[number] = question
+    return questions
+
+
+def _retry_after(error):
+    response = getattr(error, "response", None)
+    try:
+        return float(response.headers.get("retry-after"))
+    except (AttributeError, TypeError, ValueError):
+        return None
+
+
+class QuestionGenerator:
+    def __init__(self, store, concurrency=None, per_prompt=None, checkpoint=CHECKPOINT_FILE):
+        self.store = store
+        self.concurrency = concurrency or CONCURRENCY
+        self.per_prompt = per_prompt or CHUNKS_PER_PROMPT
+        self.checkpoint = checkpoint
+        self.requests = TokenBucket(REQUESTS_PER_MINUTE)
+        self.tokens = TokenBucket(TOKENS_PER_MINUTE)
+        # Retries are done here, with the buckets paused, instead of inside the SDK
+        self.client = llm.async_client.with_options(max_retries=0)
+        self.questions = []
+        self.used_ids = set()
+
+    def resume(self):
+        if not os.path.exists(self.checkpoint):
+            return
+        with open(self.checkpoint) as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue  # a line cut off by the interruption
+                self.used_ids.update(entry["chunk_ids"])
+                self.questions.extend(entry["questions"])
+        print(f"Resuming: {len(self.questions)} questions from {self.checkpoint}.")
+
+    def missing(self):
+        counts = {}
+        for question in self.questions:
+            counts[question["category"]] = counts.get(question["category"], 0) + 1
+        return {category: count - counts.get(category, 0) for category, count in CATEGORIES.items()}
+
+    def _save(self, category, chunk_ids, questions):
+        with open(self.checkpoint, "a") as f:
+            f.write(json.dumps({"category": category, "chunk_ids": chunk_ids, "questions": questions}) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+    async def _complete(self, prompt, expected):
+        cost = llm.estimate_tokens(SYSTEM_PROMPT + prompt) + COMPLETION_TOKENS_PER_QUESTION * expected
+        for attempt in range(MAX_ATTEMPTS):
+            await self.requests.acquire()
+            await self.tokens.acquire(cost)
             try:
-                question = ask_llm(prompt)
-                if question and len(question) > 10:
-                    questions.append({
-                        "question": question.strip(),
-                        "category": category,
-                        "source_chunk_id": chunk.get("source", "unknown")
-                    })
-                    current_cat_count += 1
-                    print(f"Generated: {question.strip()[:50]}...")
-                time.sleep(1)
+                return await llm.complete_async(prompt, client=self.client, system_prompt=SYSTEM_PROMPT)
+            except (groq.RateLimitError, groq.APIConnectionError, groq.InternalServerError) as e:
+                if attempt == MAX_ATTEMPTS - 1:
+                    raise
+                delay = _retry_after(e) or BACKOFF_SECONDS * 2 ** attempt * random.uniform(1, 1.5)
+                if isinstance(e, groq.RateLimitError):
+                    # Everyone waits, not just this prompt
+                    self.requests.pause(delay)
+                print(f"{type(e).__name__}, retrying in {delay:.1f}s...")
+                await asyncio.sleep(delay)
+
+    async def _run_prompt(self, category, rows, slots):
+        async with slots:
+            chunk_ids = [int(self.store.ids[row]) for row in rows]
+            chunks = [self.store.chunk(row) for row in rows]
+            try:
+                response = await self._complete(build_prompt(category, chunks), len(chunks))
             except Exception as e:
                 print(f"Error: {e}")
-                
+                return
+            questions = [
+                {
+                    "question": question,
+                    "category": category,
+                    # As before: the name of the source document
+                    "source_chunk_id": chunks[number - 1]["source"],
+                    "chunk_id": chunk_ids[number - 1],
+                    "source": chunks[number - 1]["source"],
+                    "page": chunks[number - 1]["page"]
+                }
+                for number, question in sorted(parse_questions(response, len(chunks)).items())
+            ]
+            self._save(category, chunk_ids, questions)
+            self.used_ids.update(chunk_ids)
+            self.questions.extend(questions)
+            for question in questions:
+                print(f"Generated ({category}): {question['question'][:50]}...")
+
+    async def run(self):
+        rows = [row for row in range(len(self.store)) if int(self.store.ids[row]) not in self.used_ids]
+        random.shuffle(rows)
+        slots = asyncio.Semaphore(self.concurrency)
+        # Plan prompts for whatever is missing; prompts that fail or come back short are topped up next round
+        while rows:
+            tasks = []
+            for category, count in self.missing().items():
+                for _ in range(-(-count // self.per_prompt) if count > 0 else 0):
+                    batch, rows = rows[:self.per_prompt], rows[self.per_prompt:]
+                    if batch:
+                        tasks.append(self._run_prompt(category, batch, slots))
+            if not tasks:
+                break
+            print(f"Running {len(tasks)} prompts, {self.concurrency} at a time...")
+            before = len(self.questions)
+            await asyncio.gather(*tasks)
+            if len(self.questions) == before:
+                print("No questions came back in this round, stopping.")
+                break
+
+        # Prompts that overshot a category are trimmed
+        kept, counts = [], {}
+        for question in self.questions:
+            counts[question["category"]] = counts.get(question["category"], 0) + 1
+            if counts[question["category"]] <= CATEGORIES.get(question["category"], 0):
+                kept.append(question)
+        return kept
+
+
+def generate_questions(concurrency=None, per_prompt=None, fresh=False):
+    index_dir = index_versions.current_dir()
+    store_dir = os.path.join(index_dir, index_versions.CHUNK_STORE_DIR) if index_dir else None
+    if store_dir is None or not ChunkStore.exists(store_dir):
+        print("Chunk store not found. Run ingestion first.")
+        return
+
+    store = ChunkStore(store_dir)
+    print(f"Loaded {len(store)} chunks. Sampling for question generation...")
+
+    if fresh and os.path.exists(CHECKPOINT_FILE):
+        os.remove(CHECKPOINT_FILE)
+    generator = QuestionGenerator(store, concurrency, per_prompt)
+    generator.resume()
+    start = time.perf_counter()
+    questions = asyncio.run(generator.run())
+
     with open(OUTPUT_FILE, "w") as f:
         json.dump(questions, f, indent=2)
-    
-    print(f"Saved {len(questions)} questions to {OUTPUT_FILE}")
+    if os.path.exists(CHECKPOINT_FILE):
+        os.remove(CHECKPOINT_FILE)
+
+    print(f"Saved {len(questions)} questions to {OUTPUT_FILE} in {time.perf_counter() - start:.1f}s")
+
 
 if __name__ == "__main__":
-    generate_questions()
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--concurrency", type=int, default=None, help="prompts in flight at once")
+    parser.add_argument("--per-prompt", type=int, default=None, help="chunks (questions) per prompt")
+    parser.add_argument("--fresh", action="store_true", help="ignore the checkpoint of an interrupted run")
+    args = parser.parse_args()
+    generate_questions(args.concurrency, args.per_prompt, args.fresh)
@@ -0,0 +1,118 @@
+import os
+import re
+import json
+import shutil
+import uuid
+from datetime import datetime
+
+# Each ingestion run writes a complete index into its own directory under INDEXES_DIR
+# and then points CURRENT at it, so readers never see a partially written index.
+INDEXES_DIR = "indexes"
+CURRENT_FILE = os.path.join(INDEXES_DIR, "CURRENT")
+# Version directories kept around for readers that still use them (including the current one)
+KEEP_VERSIONS = int(os.getenv("INDEX_KEEP_VERSIONS", "3"))
+
+# Names inside a version directory. Indexes written before versioning have them
+# directly in the working directory.
+INDEX_FILE = "faiss_index.bin"
+CHUNK_STORE_DIR = "chunk_store"
+LEXICAL_INDEX_DIR = "lexical_index"
+MANIFEST_FILE = "manifest.json"
+# A sharded index (INDEX_SHARDS > 1 in ingest.py) has one file per non-empty shard instead of INDEX_FILE
+SHARD_FILE = "faiss_index.{}.bin"
+_SHARD_FILE_PATTERN = re.compile(r"faiss_index\.(\d+)\.bin")
+
+
+def new_version():
+    # Sorts by creation time
+    return f"{datetime.now().strftime('%Y%m%d%H%M%S%f')}-{uuid.uuid4().hex[:6]}"
+
+
+def version_dir(version):
+    return os.path.join(INDEXES_DIR, version)
+
+
+def current_version():
+    try:
+        with open(CURRENT_FILE) as f:
+            return f.read().strip() or None
+    except OSError:
+        return None
+
+
+def current_dir():
+    """Directory of the index being served, "." for an unversioned index, or None."""
+    version = current_version()
+    if version is not None:
+        return version_dir(version)
+    if os.path.exists(INDEX_FILE):
+        return "."
+    return None
+
+
+def index_files(directory):
+    """Paths of the FAISS index in directory: [INDEX_FILE], the shard files in shard order, or []."""
+    single = os.path.join(directory, INDEX_FILE)
+    if os.path.exists(single):
+        return [single]
+    return [path for _, path in shard_files(directory)]
+
+
+def shard_files(directory):
+    """
+    (shard number, path) of each shard file in directory, in shard order. Empty shards
+    have no file, so a position in this list is not a shard number.
+    """
+    shards = []
+    for name in os.listdir(directory):
+        match = _SHARD_FILE_PATTERN.fullmatch(name)
+        if match:
+            shards.append((int(match.group(1)), os.path.join(directory, name)))
+    return sorted(shards)
+
+
+def shard_count(directory):
+    """Number of shards the index in directory was built with (its manifest's "shards"), empty ones included."""
+    try:
+        with open(os.path.join(directory, MANIFEST_FILE)) as f:
+            return int(json.load(f)["shards"])
+    except (OSError, ValueError, KeyError, TypeError):
+        files = shard_files(directory)
+        return files[-1][0] + 1 if files else 1
+
+
+def create(version):
+    path = version_dir(version)
+    shutil.rmtree(path, ignore_errors=True)
+    os.makedirs(path)
+    return path
+
+
+def discard(version):
+    shutil.rmtree(version_dir(version), ignore_errors=True)
+
+
+def publish(version):
+    """Atomically makes version the current index, then prunes old versions."""
+    tmp = CURRENT_FILE + ".tmp"
+    with open(tmp, "w") as f:
+        f.write(version)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, CURRENT_FILE)
+    prune(version)
+
+
+def prune(current):
+    versions = sorted(
+        name for name in os.listdir(INDEXES_DIR)
+        if os.path.isdir(os.path.join(INDEXES_DIR, name))
+    )
+    # Directories newer than current are leftovers of failed runs
+    older = [name for name in versions if name < current]
+    keep = set(older[max(0, len(older) - (KEEP_VERSIONS - 1)):]) | {current}
+    for name in versions:
+        if name not in keep:
+            # Processes that still map files of an old version keep them until they let go
+            # (on Windows the delete fails and is retried on the next publish)
+            shutil.rmtree(version_dir(name), ignore_errors=True)
@@ -1,40 +1,195 @@
 import os
+import sys
+import hashlib
+import json
 from pypdf import PdfReader
-from sentence_transformers import SentenceTransformer
 import faiss
 import numpy as np
 import pickle
+import time
+from collections import deque
+from contextlib import contextmanager
+from itertools import islice
+from concurrent.futures import ProcessPoolExecutor
+from chunk_store import ChunkStore, ChunkStoreWriter
+from lexical import LexicalIndex, build_lexical_index
+import index_versions
+# Names inside an index version directory, see index_versions.py
+from index_versions import INDEX_FILE, SHARD_FILE, CHUNK_STORE_DIR, LEXICAL_INDEX_DIR, MANIFEST_FILE
+from shards import shard_of
 
 DATA_FOLDER = "data"
 # Consistency: match this with rag.py
 EMBEDDING_MODEL_NAME = 'all-MiniLM-L6-v2'
+# Each version holds faiss_index.bin, the memory-mapped chunk store (chunk_store.py),
+# the BM25 index (lexical.py) and manifest.json with per-file and per-page content hashes
+LEGACY_CHUNKS_FILE = "chunks.pkl"
 
-def load_documents():
-    documents = []
+# Process-pool size for PDF text extraction (1 = extract in this process)
+EXTRACT_WORKERS = int(os.getenv("INGEST_WORKERS", "1"))
+# Large manuals are split into page ranges of this size across the pool
+PAGES_PER_TASK = int(os.getenv("INGEST_PAGES_PER_TASK", "32"))
+
+# Chunks are embedded and inserted in batches of this size, which bounds memory
+EMBED_BATCH_SIZE = int(os.getenv("INGEST_EMBED_BATCH", "1024"))
+# Texts per forward pass. Each embed batch is sorted by token count first,
+# so the texts of one forward pass pad to about the same length
+ENCODE_BATCH_SIZE = int(os.getenv("INGEST_ENCODE_BATCH", "64"))
+# torch intra-op threads per encoding process (0 = torch default, or split evenly across the pool)
+ENCODE_THREADS = int(os.getenv("INGEST_ENCODE_THREADS", "0"))
+# Processes encoding in parallel on CPU (1 = encode in this process)
+ENCODE_WORKERS = int(os.getenv("INGEST_ENCODE_WORKERS", "1"))
+
+# Index type chosen at ingest time: flat (exact), hnsw, ivf or ivfpq, or a compressed
+# exhaustive index: sq8 (int8 scalar quantization), fp16, or pq (product quantization)
+INDEX_TYPES = ("flat", "hnsw", "ivf", "ivfpq", "sq8", "fp16", "pq")
+INDEX_TYPE = os.getenv("INDEX_TYPE", "flat")
+HNSW_M = int(os.getenv("INDEX_HNSW_M", "32"))
+IVF_NLIST = int(os.getenv("INDEX_IVF_NLIST", "1024"))
+# PQ sub-quantizers (bytes per vector); must divide the embedding dimension (384 for MiniLM)
+PQ_M = int(os.getenv("INDEX_PQ_M", "48"))
+# IVF/PQ are trained on at most this many vectors from the start of the stream
+TRAIN_SAMPLE_SIZE = int(os.getenv("INDEX_TRAIN_SAMPLE", "50000"))
+# Number of index shards; chunks are assigned by a hash of their source document, and
+# the API searches the shards in parallel (see shards.py). 1 writes a single index file.
+INDEX_SHARDS = max(1, int(os.getenv("INDEX_SHARDS", "1")))
+
+CHUNK_SIZE = 800
+CHUNK_OVERLAP = 100
+
+
+def list_documents():
     if not os.path.exists(DATA_FOLDER):
         os.makedirs(DATA_FOLDER)
-        
-    for file in os.listdir(DATA_FOLDER):
-        if file.endswith(".pdf"):
-            path = os.path.join(DATA_FOLDER, file)
-            print(f"Loading {file}...")
-            try:
-                reader = PdfReader(path)
-                for page_num, page in enumerate(reader.pages):
-                    text = page.extract_text()
-                    if text:
-                        documents.append({
-                            "text": text,
-                            "source": file,
-                            "page": page_num + 1
-                        })
-            except Exception as e:
-                print(f"Error reading {file}: {e}")
-
-    return documents
-
-
-def chunk_text(text, chunk_size=800, overlap=100):
+    return sorted(f for f in os.listdir(DATA_FOLDER) if f.endswith(".pdf"))
+
+
+def file_hash(path):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def page_hash(text):
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def _count_pages(path):
+    try:
+        return len(PdfReader(path).pages), None
+    except Exception as e:
+        return 0, e
+
+
+def _extract_page_range(path, start, end=None):
+    """
+    Returns [(page_number, text), ...] for pages start..end-1 of one PDF.
+    Runs inside pool workers, so it opens its own reader.
+    """
+    reader = PdfReader(path)
+    pages = reader.pages[start:end]
+    results = []
+    for page_num, page in enumerate(pages, start=start + 1):
+        text = page.extract_text()
+        if text:
+            results.append((page_num, text))
+    return results
+
+
+def _iter_serial(files):
+    for file in files:
+        print(f"Loading {file}...")
+        try:
+            yield file, _extract_page_range(os.path.join(DATA_FOLDER, file), 0)
+        except Exception as e:
+            print(f"Error reading {file}: {e}")
+            yield file, None
+
+
+def _iter_parallel(files, workers):
+    """
+    Fans extraction out over a process pool, one task per PAGES_PER_TASK pages,
+    so a single very large manual is spread over several cores as well.
+    At most 2 * workers page ranges are in flight, and results are consumed
+    in submission order, so output order is deterministic and memory is bounded.
+    """
+    window = 2 * workers
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        paths = [os.path.join(DATA_FOLDER, file) for file in files]
+        counts = pool.map(_count_pages, paths)
+
+        def plan():
+            for file, path, (page_count, error) in zip(files, paths, counts):
+                if error is not None:
+                    yield file, None, error
+                    continue
+                print(f"Loading {file} ({page_count} pages)...")
+                if page_count == 0:
+                    yield file, None, None
+                for start in range(0, page_count, PAGES_PER_TASK):
+                    end = min(start + PAGES_PER_TASK, page_count)
+                    yield file, pool.submit(_extract_page_range, path, start, end), None
+
+        tasks = plan()
+        pending = deque()
+        current, pages, failure = None, [], None
+        while True:
+            for task in islice(tasks, window - len(pending)):
+                pending.append(task)
+            if not pending:
+                break
+            file, future, error = pending.popleft()
+            if file != current:
+                if current is not None:
+                    yield current, pages if failure is None else None
+                current, pages, failure = file, [], None
+            if failure is not None:
+                continue
+            if error is None and future is not None:
+                try:
+                    pages.extend(future.result())
+                except Exception as e:
+                    error = e
+            if error is not None:
+                print(f"Error reading {file}: {error}")
+                failure = error
+        if current is not None:
+            yield current, pages if failure is None else None
+
+
+def iter_files(files, workers=None):
+    """
+    Yields (file, [(page_number, text), ...]) in the order of files,
+    or (file, None) when the file could not be read. A failing file yields
+    no pages at all, so callers can keep the previously indexed version.
+    """
+    if workers is None:
+        workers = EXTRACT_WORKERS
+    if workers > 1 and files:
+        yield from _iter_parallel(files, workers)
+    else:
+        yield from _iter_serial(files)
+
+
+def iter_documents(files=None, workers=None):
+    if files is None:
+        files = list_documents()
+    for file, pages in iter_files(files, workers):
+        for page_num, text in pages or []:
+            yield {
+                "text": text,
+                "source": file,
+                "page": page_num
+            }
+
+
+def load_documents(files=None, workers=None):
+    return list(iter_documents(files, workers))
+
+
+def chunk_text(text, chunk_size=CHUNK_SIZE, overlap=CHUNK_OVERLAP):
     text = text.replace("-\n", "")
     text = text.replace("\n", " ")
     text = " ".join(text.split())
@@ -69,59 +224,751 @@ def chunk_text(text, chunk_size=800, overlap=100):
     return chunks
 
 
-def create_chunks(documents):
-    all_chunks = []
-    print(f"Chunking {len(documents)} pages...")
+def iter_chunks(documents):
     for doc in documents:
-        chunks = chunk_text(doc["text"])
-        for chunk in chunks:
-            all_chunks.append({
+        for chunk in chunk_text(doc["text"]):
+            yield {
                 "text": chunk,
                 "source": doc["source"],
                 "page": doc["page"]
-            })
-    return all_chunks
+            }
+
+
+def create_chunks(documents):
+    print(f"Chunking {len(documents)} pages...")
+    return list(iter_chunks(documents))
+
+
+class StageStats:
+    """
+    Item count and busy time of one ingestion stage, for throughput reporting.
+    """
+    def __init__(self, name, unit):
+        self.name = name
+        self.unit = unit
+        self.count = 0
+        self.seconds = 0.0
+
+    @contextmanager
+    def measure(self, count=0):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.seconds += time.perf_counter() - start
+            self.count += count
+
+    def timed(self, iterable):
+        """Wraps an iterator so the time spent producing each item is attributed to this stage."""
+        it = iter(iterable)
+        while True:
+            with self.measure():
+                item = next(it, _END)
+            if item is _END:
+                return
+            yield item
+
+    @property
+    def rate(self):
+        return self.count / self.seconds if self.seconds > 0 else 0.0
+
+    def __str__(self):
+        return f"{self.name}: {self.count} {self.unit} in {self.seconds:.2f}s ({self.rate:.1f} {self.unit}/s)"
+
+
+_END = object()
+
+
+def _batched(iterable, size):
+    it = iter(iterable)
+    while True:
+        batch = list(islice(it, size))
+        if not batch:
+            return
+        yield batch
+
+
+def load_model():
+    # Imported here so that importing ingest does not pull in torch
+    from sentence_transformers import SentenceTransformer
+    return SentenceTransformer(EMBEDDING_MODEL_NAME)
+
+
+def _set_threads(threads):
+    if threads > 0:
+        import torch
+        torch.set_num_threads(threads)
+
+
+# Model of an encode pool worker, loaded once by _init_encode_worker
+_worker_model = None
+
+
+def _init_encode_worker(threads):
+    global _worker_model
+    _set_threads(threads)
+    _worker_model = load_model()
+
+
+def _encode_in_worker(texts):
+    return np.asarray(_worker_model.encode(texts, batch_size=len(texts), show_progress_bar=False), dtype=np.float32)
+
+
+class Encoder:
+    """
+    Embedding engine for ingestion.
+    Texts are sorted by token count and cut into forward passes of batch_size, so
+    little compute goes into padding; the vectors come back in input order.
+    With workers > 1 the forward passes are spread over a process pool on CPU,
+    each process loading its own model with threads intra-op threads.
+    """
+    def __init__(self, model=None, batch_size=None, threads=None, workers=None):
+        self.model = model
+        self.batch_size = batch_size or ENCODE_BATCH_SIZE
+        self.workers = workers or ENCODE_WORKERS
+        self.threads = ENCODE_THREADS if threads is None else threads
+        if self.threads <= 0 and self.workers > 1:
+            self.threads = max(1, (os.cpu_count() or 1) // self.workers)
+        self._pool = None
+        self._started = False
+        # Token counts, with and without the padding of each forward pass, for the report
+        self.tokens = 0
+        self.padded_tokens = 0
+        self.unsorted_padded_tokens = 0
+
+    def _start(self):
+        if self._started:
+            return
+        self._started = True
+        if self.workers > 1:
+            print(f"Starting {self.workers} encode processes ({self.threads} threads each)...")
+            self._pool = ProcessPoolExecutor(
+                max_workers=self.workers, initializer=_init_encode_worker, initargs=(self.threads,)
+            )
+            return
+        _set_threads(self.threads)
+        if self.model is None:
+            print(f"Loading {EMBEDDING_MODEL_NAME}...")
+            self.model = load_model()
+
+    def token_counts(self, texts):
+        """Token count per text from the model's tokenizer, or character count without one."""
+        tokenizer = getattr(self.model, "tokenizer", None)
+        if tokenizer is None:
+            return np.array([len(text) for text in texts])
+        encoded = tokenizer(texts, add_special_tokens=False)["input_ids"]
+        return np.array([len(ids) for ids in encoded])
+
+    def _padded(self, lengths):
+        return sum(int(lengths[i:i + self.batch_size].max()) * len(lengths[i:i + self.batch_size])
+                   for i in range(0, len(lengths), self.batch_size))
+
+    def encode(self, texts):
+        """Returns a float32 matrix with one row per text, in the order of texts."""
+        if not texts:
+            return None
+        self._start()
+        lengths = self.token_counts(texts)
+        order = np.argsort(-lengths, kind="stable")
+        self.tokens += int(lengths.sum())
+        self.padded_tokens += self._padded(lengths[order])
+        self.unsorted_padded_tokens += self._padded(lengths)
+
+        passes = [[texts[i] for i in order[start:start + self.batch_size]] for start in range(0, len(texts), self.batch_size)]
+        if self._pool is not None:
+            parts = list(self._pool.map(_encode_in_worker, passes))
+        else:
+            parts = [
+                np.asarray(self.model.encode(part, batch_size=len(part), show_progress_bar=False), dtype=np.float32)
+                for part in passes
+            ]
+        embeddings = np.empty((len(texts), parts[0].shape[1]), dtype=np.float32)
+        embeddings[order] = np.vstack(parts)
+        return embeddings
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
+        self._started = False
+
+    def __str__(self):
+        def overhead(padded):
+            return 100 * (padded - self.tokens) / self.tokens if self.tokens else 0.0
+        return (f"encode: batches of {self.batch_size}, {self.workers} process(es), "
+                f"padding {overhead(self.padded_tokens):.0f}% (unsorted: {overhead(self.unsorted_padded_tokens):.0f}%)")
+
+
+def embed_batches(items, encoder=None, batch_size=None, stats=None):
+    """
+    Consumes (id, chunk) pairs and yields (ids, chunks, embeddings) per batch,
+    so only batch_size chunks are held at once. The model is loaded on the first batch.
+    """
+    batch_size = batch_size or EMBED_BATCH_SIZE
+    stats = stats or StageStats("embed", "vectors")
+    encoder = encoder or Encoder()
+    for batch in _batched(items, batch_size):
+        ids = [chunk_id for chunk_id, _ in batch]
+        chunks = [chunk for _, chunk in batch]
+        with stats.measure(len(batch)):
+            embeddings = encoder.encode([chunk["text"] for chunk in chunks])
+        yield ids, chunks, embeddings
+
+
+def index_description(index_type, dimension, n_train=0):
+    """
+    Maps INDEX_TYPE to a faiss index_factory string.
+    Every type is wrapped in IDMap2 so chunk ids stay stable across re-ingestion.
+    IVF list counts are capped so each list gets ~39 training points, and PQ falls
+    back to plain IVF (or SQ8) when the sample is too small or PQ_M does not divide the dimension.
+    """
+    if index_type == "flat":
+        return "IDMap2,Flat"
+    if index_type == "hnsw":
+        return f"IDMap2,HNSW{HNSW_M}"
+    if index_type == "sq8":
+        return "IDMap2,SQ8"
+    if index_type == "fp16":
+        return "IDMap2,SQfp16"
+    if index_type == "pq":
+        if dimension % PQ_M == 0 and n_train >= 256:
+            return f"IDMap2,PQ{PQ_M}"
+        print(f"Not enough data for PQ{PQ_M} on {dimension} dims ({n_train} vectors), using SQ8.")
+        return "IDMap2,SQ8"
+    if index_type in ("ivf", "ivfpq"):
+        nlist = max(1, min(IVF_NLIST, n_train // 39))
+        if index_type == "ivfpq":
+            if dimension % PQ_M == 0 and n_train >= 256:
+                return f"IDMap2,IVF{nlist},PQ{PQ_M}"
+            print(f"Not enough data for PQ{PQ_M} on {dimension} dims ({n_train} vectors), using IVF without PQ.")
+        return f"IDMap2,IVF{nlist},Flat"
+    raise ValueError(f"Unknown INDEX_TYPE '{index_type}', expected one of {', '.join(INDEX_TYPES)}")
+
 
+def needs_training(index_type):
+    return index_type in ("ivf", "ivfpq", "sq8", "pq")
 
-def build_faiss(chunks):
+
+def new_index(dimension, index_type=None, train_vectors=None):
+    index_type = index_type or INDEX_TYPE
+    n_train = 0 if train_vectors is None else len(train_vectors)
+    description = index_description(index_type, dimension, n_train)
+    index = faiss.index_factory(dimension, description)
+    # Without vectors the index stays empty and untrained; IndexWriter trains it on the first ones
+    if not index.is_trained and n_train:
+        print(f"Training {description} on {n_train} vectors...")
+        index.train(train_vectors)
+    return index
+
+
+def index_vectors(index):
+    """
+    Returns (ids, vectors) stored in an ID-mapped index, or None when the index
+    only keeps compressed codes (PQ, SQ) and the original vectors cannot be recovered.
+    """
+    inner = faiss.downcast_index(index.index)
+    if not isinstance(inner, (faiss.IndexFlat, faiss.IndexIVFFlat, faiss.IndexHNSWFlat)):
+        return None
+    if isinstance(inner, faiss.IndexIVF):
+        inner.make_direct_map()
+    ids = faiss.vector_to_array(index.id_map)
+    return ids, inner.reconstruct_n(0, inner.ntotal)
+
+
+def store_vectors(index, store, keep=None):
+    """
+    Returns (ids, vectors) of the index from the exact vectors kept in the chunk
+    store, or None if the store has none. keep is a boolean mask over the index ids.
+    """
+    if store is None or store.vectors is None:
+        return None
+    ids = faiss.vector_to_array(index.id_map)
+    if keep is not None:
+        ids = ids[keep]
+    rows = store.rows_of(ids)
+    if (rows == -1).any():
+        return None
+    return ids, np.asarray(store.vectors[rows], dtype=np.float32)
+
+
+def rebuild_index(index, index_type, keep=None, store=None):
+    """
+    Rebuilds index as index_type, optionally keeping only the ids in the boolean mask keep.
+    The vectors come from the chunk store when it has them, else from the index itself.
+    Returns None if the vectors cannot be recovered.
+    """
+    if keep is not None and not keep.any():
+        stored = np.zeros(0, dtype=np.int64), np.zeros((0, index.d), dtype=np.float32)
+    else:
+        stored = store_vectors(index, store, keep)
+    if stored is None:
+        stored = index_vectors(index)
+        if stored is None:
+            return None
+        if keep is not None:
+            stored = stored[0][keep], stored[1][keep]
+    ids, vectors = stored
+    train = vectors[:TRAIN_SAMPLE_SIZE] if needs_training(index_type) else None
+    rebuilt = new_index(index.d, index_type, train)
+    if len(ids):
+        rebuilt.add_with_ids(vectors, ids)
+    return rebuilt
+
+
+def removes_in_place(index):
+    """
+    True if ids can be removed from index with remove_ids. Only flat code arrays
+    (Flat, SQ, PQ) qualify: HNSW graphs cannot delete nodes, and IVF lists are not
+    renumbered the way IDMap2 expects, so a later remove would abort the process.
+    """
+    return isinstance(faiss.downcast_index(index.index), faiss.IndexFlatCodes)
+
+
+def remove_vectors(index, ids, index_type=None, store=None):
+    """
+    Removes ids from index, in place where that is safe, otherwise by rebuilding
+    it from the vectors in store (or the index). Returns None if they cannot be recovered.
+    """
+    ids = np.asarray(ids, dtype=np.int64)
+    if removes_in_place(index):
+        index.remove_ids(ids)
+        return index
+    keep = ~np.isin(faiss.vector_to_array(index.id_map), ids)
+    return rebuild_index(index, index_type or INDEX_TYPE, keep, store)
+
+
+def outgrown(index, index_type=None):
+    """
+    True when an index trained on a small first corpus is too coarse for its size now:
+    an IVF with less than half the lists index_description would pick today, or the
+    SQ8 / IVF-Flat stand-ins for PQ once there is enough data to train PQ.
+    """
+    index_type = index_type or INDEX_TYPE
+    if index is None or index_type not in ("ivf", "ivfpq", "pq"):
+        return False
+    inner = faiss.downcast_index(index.index)
+    n_train = min(index.ntotal, TRAIN_SAMPLE_SIZE)
+    pq_possible = index.d % PQ_M == 0 and n_train >= 256
+    if index_type == "pq":
+        return pq_possible and not isinstance(inner, faiss.IndexPQ)
+    if not isinstance(inner, faiss.IndexIVF):
+        return True
+    if index_type == "ivfpq" and pq_possible and not isinstance(inner, faiss.IndexIVFPQ):
+        return True
+    return inner.nlist * 2 <= min(IVF_NLIST, n_train // 39)
+
+
+class IndexWriter:
+    """
+    Adds embedding batches to an index, creating it on first use.
+    For index types that need training, batches are buffered until
+    TRAIN_SAMPLE_SIZE vectors (or the end of the stream) are available as a sample.
+    """
+    def __init__(self, index=None, index_type=None):
+        # An untrained index is empty (see new_index), so it is created afresh like a missing one
+        self.index = index if index is not None and index.is_trained else None
+        self.index_type = index_type or INDEX_TYPE
+        self._pending = []
+        self._pending_count = 0
+
+    def add(self, ids, embeddings):
+        ids = np.asarray(ids, dtype=np.int64)
+        if self.index is not None:
+            self.index.add_with_ids(embeddings, ids)
+            return
+        self._pending.append((ids, embeddings))
+        self._pending_count += len(ids)
+        if not needs_training(self.index_type) or self._pending_count >= TRAIN_SAMPLE_SIZE:
+            self._create()
+
+    def finish(self):
+        if self.index is None and self._pending:
+            self._create()
+        return self.index
+
+    def _create(self):
+        ids = np.concatenate([ids for ids, _ in self._pending])
+        vectors = np.vstack([vectors for _, vectors in self._pending])
+        self._pending = []
+        self._pending_count = 0
+        train = vectors if needs_training(self.index_type) else None
+        self.index = new_index(vectors.shape[1], self.index_type, train)
+        self.index.add_with_ids(vectors, ids)
+
+
+class ShardedIndexWriter:
+    """Routes embedding batches to one IndexWriter per shard by the source of each chunk."""
+    def __init__(self, indexes, index_type=None):
+        self.writers = [IndexWriter(index, index_type) for index in indexes]
+
+    def add(self, ids, embeddings, sources=None):
+        if len(self.writers) == 1:
+            self.writers[0].add(ids, embeddings)
+            return
+        ids = np.asarray(ids, dtype=np.int64)
+        assigned = np.array([shard_of(source, len(self.writers)) for source in sources])
+        for shard, writer in enumerate(self.writers):
+            rows = np.flatnonzero(assigned == shard)
+            if len(rows):
+                writer.add(ids[rows], embeddings[rows])
+
+    def finish(self):
+        return [writer.finish() for writer in self.writers]
+
+
+def rebuild_shards(indexes, index_type, n_shards, store=None):
+    """
+    Rebuilds the shard indexes (None for empty shards) as n_shards indexes of index_type,
+    reassigning chunks by source. Vectors come from the chunk store when it has them,
+    else from the indexes. Returns None if they cannot be recovered.
+    """
+    writer = ShardedIndexWriter([None] * n_shards, index_type)
+    for index in indexes:
+        if index is None:
+            continue
+        stored = store_vectors(index, store) or index_vectors(index)
+        if stored is None:
+            return None
+        ids, vectors = stored
+        sources = None
+        if n_shards > 1:
+            rows = store.rows_of(ids)
+            sources = [store.sources[i] for i in store.source[rows]]
+        for start in range(0, len(ids), EMBED_BATCH_SIZE):
+            end = start + EMBED_BATCH_SIZE
+            writer.add(ids[start:end], vectors[start:end], sources[start:end] if sources else None)
+    return writer.finish()
+
+
+def build_faiss(chunks, ids=None, index=None, model=None):
+    """
+    Encodes chunks in batches and adds them to index under the given ids.
+    A new ID-mapped index is created when none is passed in.
+    """
+    encoder = Encoder(model)
     print(f"Encoding {len(chunks)} chunks with {EMBEDDING_MODEL_NAME}...")
-    model = SentenceTransformer(EMBEDDING_MODEL_NAME)
-    
+
     if not chunks:
         print("No chunks to index.")
-        return None, model
+        return index, model
 
-    texts = [chunk["text"] for chunk in chunks]
-    embeddings = model.encode(texts, show_progress_bar=True)
-    
-    dimension = embeddings.shape[1]
-    index = faiss.IndexFlatL2(dimension)
-    index.add(np.array(embeddings))
-    
-    return index, model
+    if ids is None:
+        ids = range(len(chunks))
+
+    writer = IndexWriter(index)
+    stats = StageStats("embed", "vectors")
+    try:
+        for batch_ids, _, embeddings in embed_batches(zip(ids, chunks), encoder, stats=stats):
+            writer.add(batch_ids, embeddings)
+    finally:
+        encoder.close()
+    print(stats)
+
+    return writer.finish(), encoder.model
+
+
+def new_manifest():
+    return {
+        "embedding_model": EMBEDDING_MODEL_NAME,
+        "chunk_size": CHUNK_SIZE,
+        "chunk_overlap": CHUNK_OVERLAP,
+        "index_type": INDEX_TYPE,
+        "shards": INDEX_SHARDS,
+        "next_id": 0,
+        "files": {}
+    }
 
 
-def save_index(index, chunks):
-    if index is None:
+def manifest_ids(manifest):
+    for entry in manifest["files"].values():
+        for page in entry["pages"].values():
+            yield from page["ids"]
+
+
+def _migrate_legacy_chunks(directory):
+    # Earlier versions pickled a {chunk_id: chunk} dict next to the index
+    try:
+        with open(os.path.join(directory, LEGACY_CHUNKS_FILE), "rb") as f:
+            chunks = pickle.load(f)
+    except Exception:
+        return False
+    if not isinstance(chunks, dict):
+        return False
+    # The pickle has no vectors, so this store cannot serve exact re-scoring until a --full run
+    print(f"Converting {LEGACY_CHUNKS_FILE} to {CHUNK_STORE_DIR}/...")
+    writer = ChunkStoreWriter(os.path.join(directory, CHUNK_STORE_DIR))
+    for chunk_id, chunk in chunks.items():
+        writer.add(chunk_id, chunk)
+    writer.close()
+    return True
+
+
+def load_existing():
+    """
+    Loads the manifest, shard indexes (one per shard, None for empty ones) and chunk
+    store of the current index version.
+    Returns (None, None, None) when anything is missing or out of sync,
+    which makes run_ingestion fall back to a full rebuild.
+    """
+    directory = index_versions.current_dir()
+    if directory is None:
+        return None, None, None
+    manifest_file = os.path.join(directory, MANIFEST_FILE)
+    store_dir = os.path.join(directory, CHUNK_STORE_DIR)
+    if not os.path.exists(manifest_file) or not index_versions.index_files(directory):
+        return None, None, None
+    if not ChunkStore.exists(store_dir) and not _migrate_legacy_chunks(directory):
+        return None, None, None
+    try:
+        with open(manifest_file) as f:
+            manifest = json.load(f)
+        n_shards = manifest.get("shards", 1)
+        names = [INDEX_FILE] if n_shards == 1 else [SHARD_FILE.format(shard) for shard in range(n_shards)]
+        indexes = [
+            faiss.read_index(os.path.join(directory, name)) if os.path.exists(os.path.join(directory, name)) else None
+            for name in names
+        ]
+        store = ChunkStore(store_dir)
+    except Exception as e:
+        print(f"Could not load previous index ({e}), rebuilding.")
+        return None, None, None
+
+    expected = new_manifest()
+    if any(manifest.get(key) != expected[key] for key in ("embedding_model", "chunk_size", "chunk_overlap")):
+        print("Embedding or chunking settings changed, rebuilding.")
+        return None, None, None
+    # Older runs wrote a positional IndexFlatL2
+    if not all(isinstance(index, faiss.IndexIDMap2) for index in indexes if index is not None):
+        print("Previous index is not ID-mapped, rebuilding.")
+        return None, None, None
+    ids = np.sort(np.fromiter(manifest_ids(manifest), dtype=np.int64))
+    ntotal = sum(index.ntotal for index in indexes if index is not None)
+    if not np.array_equal(ids, store.sorted_ids) or ntotal != len(store):
+        print("Manifest does not match the saved index, rebuilding.")
+        return None, None, None
+
+    return manifest, indexes, store
+
+
+def _write_atomic(path, write):
+    tmp = path + ".tmp"
+    write(tmp)
+    os.replace(tmp, path)
+
+
+def save_index(indexes, manifest=None, directory="."):
+    """
+    Writes the index, or the list of shard indexes (one file per non-empty shard),
+    and the manifest into directory. The chunk store is written by its
+    ChunkStoreWriter beforehand; the manifest goes last so a crash in between is
+    caught by the consistency check in load_existing.
+    """
+    if not isinstance(indexes, list):
+        indexes = [indexes]
+    if all(index is None for index in indexes):
         return
-        
-    faiss.write_index(index, "faiss_index.bin")
-    with open("chunks.pkl", "wb") as f:
-        pickle.dump(chunks, f)
+
+    for shard, index in enumerate(indexes):
+        if index is not None:
+            name = INDEX_FILE if len(indexes) == 1 else SHARD_FILE.format(shard)
+            _write_atomic(os.path.join(directory, name), lambda p: faiss.write_index(index, p))
+
+    if manifest is not None:
+        def dump_manifest(p):
+            with open(p, "w") as f:
+                json.dump(manifest, f)
+        _write_atomic(os.path.join(directory, MANIFEST_FILE), dump_manifest)
     print("Index saved to disk.")
 
-def run_ingestion():
+
+def update_indexes(indexes, removed_ids, store):
+    """
+    Removes removed_ids from the shard indexes and retrains those that outgrew
+    their training (see outgrown). Returns None if a rebuild has no vectors to use.
+    """
+    removed = np.asarray(removed_ids, dtype=np.int64)
+    if len(removed):
+        print(f"Removing {len(removed)} stale chunks...")
+    updated = []
+    for index in indexes:
+        if index is not None and len(removed) and np.isin(removed, faiss.vector_to_array(index.id_map)).any():
+            index = remove_vectors(index, removed, INDEX_TYPE, store)
+            if index is None:
+                return None
+        if outgrown(index):
+            print(f"Retraining the {INDEX_TYPE} index for {index.ntotal} vectors...")
+            index = rebuild_index(index, INDEX_TYPE, store=store) or index
+        updated.append(index)
+    return updated
+
+
+def run_ingestion(full=False, workers=None):
+    """
+    Brings the index in line with the PDFs in DATA_FOLDER.
+    Pages stream through chunking, batched embedding and index insertion,
+    so no stage holds the whole corpus at once.
+    Only new or changed files are parsed, and within those only pages whose text
+    changed are re-chunked and re-embedded. Vectors of deleted files and pages
+    are removed from the index. full=True ignores the manifest and rebuilds.
+    The result is written to a new version directory and published atomically,
+    so the API keeps serving the previous version until it is complete.
+    workers overrides INGEST_WORKERS for PDF extraction.
+    """
     print("Starting ingestion pipeline...")
-    documents = load_documents()
-    if not documents:
+    files = list_documents()
+
+    manifest, indexes, old_store = (None, None, None) if full else load_existing()
+    retyped = False
+    if manifest is not None and (manifest.get("index_type", "flat"), manifest.get("shards", 1)) != (INDEX_TYPE, INDEX_SHARDS):
+        print(f"Converting {manifest.get('index_type', 'flat')} index in {manifest.get('shards', 1)} shard(s) to {INDEX_TYPE} in {INDEX_SHARDS}...")
+        indexes = rebuild_shards(indexes, INDEX_TYPE, INDEX_SHARDS, old_store)
+        if indexes is None:
+            print("Stored vectors are compressed and cannot be converted, rebuilding.")
+            manifest = None
+        else:
+            manifest["index_type"] = INDEX_TYPE
+            manifest["shards"] = INDEX_SHARDS
+            retyped = True
+    if manifest is None:
+        manifest, indexes, old_store = new_manifest(), [None] * INDEX_SHARDS, None
+    old_count = len(old_store) if old_store is not None else 0
+
+    if not files and not manifest["files"]:
         print("No documents found in 'data/' folder.")
         return {"status": "error", "message": "No documents found"}
-        
-    chunks = create_chunks(documents)
-    index, model = build_faiss(chunks)
-    save_index(index, chunks)
-    print("Ingestion complete!")
-    return {"status": "success", "chunks_count": len(chunks)}
+
+    hashes = {f: file_hash(os.path.join(DATA_FOLDER, f)) for f in files}
+    removed_ids = []
+
+    for name in list(manifest["files"]):
+        if name not in hashes:
+            print(f"Removing {name}...")
+            entry = manifest["files"].pop(name)
+            for page in entry["pages"].values():
+                removed_ids.extend(page["ids"])
+
+    changed = [f for f in files if manifest["files"].get(f, {}).get("hash") != hashes[f]]
+    print(f"{len(files) - len(changed)} unchanged, {len(changed)} new or changed file(s).")
+
+    if old_store is not None and not changed and not removed_ids and not retyped:
+        lexical_dir = os.path.join(index_versions.current_dir(), LEXICAL_INDEX_DIR)
+        if not LexicalIndex.exists(lexical_dir):
+            build_lexical_index(old_store, lexical_dir)
+        print("Index is up to date.")
+        return {"status": "success", "chunks_count": old_count, "added": 0, "removed": 0}
+
+    stats = [
+        StageStats("extract", "pages"),
+        StageStats("chunk", "chunks"),
+        StageStats("embed", "vectors"),
+        StageStats("insert", "vectors"),
+    ]
+    extract_stats, chunk_stats, embed_stats, insert_stats = stats
+
+    failed = []
+
+    def new_chunks():
+        # Pages -> (id, chunk) pairs; the manifest entry of a file is
+        # updated once all of its pages have been seen.
+        for name, file_pages in extract_stats.timed(iter_files(changed, workers)):
+            if file_pages is None:
+                # Keep serving whatever was indexed for this file before
+                failed.append(name)
+                continue
+            extract_stats.count += len(file_pages)
+            old_pages = manifest["files"].get(name, {}).get("pages", {})
+            pages = {}
+            for page_num, text in file_pages:
+                key = str(page_num)
+                digest = page_hash(text)
+                old = old_pages.pop(key, None)
+                if old is not None and old["hash"] == digest:
+                    pages[key] = old
+                    continue
+                if old is not None:
+                    removed_ids.extend(old["ids"])
+                with chunk_stats.measure():
+                    texts = chunk_text(text)
+                chunk_stats.count += len(texts)
+                ids = []
+                for chunk in texts:
+                    chunk_id = manifest["next_id"]
+                    manifest["next_id"] += 1
+                    ids.append(chunk_id)
+                    yield chunk_id, {"text": chunk, "source": name, "page": page_num}
+                pages[key] = {"hash": digest, "ids": ids}
+            for old in old_pages.values():
+                removed_ids.extend(old["ids"])
+            manifest["files"][name] = {"hash": hashes[name], "pages": pages}
+
+    added = 0
+    writer = ShardedIndexWriter(indexes)
+    version = index_versions.new_version()
+    out_dir = index_versions.create(version)
+    store_writer = ChunkStoreWriter(os.path.join(out_dir, CHUNK_STORE_DIR))
+    encoder = Encoder()
+    try:
+        for ids, batch, embeddings in embed_batches(new_chunks(), encoder, stats=embed_stats):
+            with insert_stats.measure(len(ids)):
+                writer.add(ids, embeddings, [chunk["source"] for chunk in batch])
+                # The exact vectors go to the store too, for re-scoring and lossless conversion
+                for chunk_id, chunk, vector in zip(ids, batch, embeddings):
+                    store_writer.add(chunk_id, chunk, vector)
+            added += len(ids)
+    finally:
+        encoder.close()
+    with insert_stats.measure():
+        indexes = writer.finish()
+
+    if old_store is not None:
+        removed = set(removed_ids)
+        old_store.copy_rows(store_writer, keep=lambda chunk_id: chunk_id not in removed)
+
+    for stage in stats:
+        print(stage)
+    if added:
+        print(encoder)
+
+    if all(index is None for index in indexes):
+        store_writer.abort()
+        index_versions.discard(version)
+        print("No chunks to index.")
+        return {"status": "error", "message": "No text could be extracted"}
+
+    if not added and not removed_ids and not retyped and len(failed) == len(changed):
+        store_writer.abort()
+        index_versions.discard(version)
+        print("Index is unchanged.")
+        return {"status": "success", "chunks_count": old_count, "added": 0, "removed": 0}
+
+    chunks_count = len(store_writer)
+    store_writer.close()
+    store = ChunkStore(os.path.join(out_dir, CHUNK_STORE_DIR))
+    # Indexes that cannot drop ids in place are rebuilt from the new store, which has the vectors of every kept chunk
+    indexes = update_indexes(indexes, removed_ids, store)
+    if indexes is None:
+        store.close()
+        index_versions.discard(version)
+        print("Stored vectors are compressed and cannot be rebuilt, re-ingesting everything.")
+        return run_ingestion(full=True, workers=workers)
+    build_lexical_index(store, os.path.join(out_dir, LEXICAL_INDEX_DIR))
+    store.close()
+    # API caches are keyed on the version
+    manifest["version"] = version
+    save_index(indexes, manifest, out_dir)
+    index_versions.publish(version)
+    print(f"Ingestion complete! Serving version {version}.")
+    return {
+        "status": "success",
+        "chunks_count": chunks_count,
+        "added": added,
+        "removed": len(removed_ids),
+        "version": version,
+        "throughput": {stage.name: round(stage.rate, 1) for stage in stats}
+    }
 
 if __name__ == "__main__":
-    run_ingestion()
+    workers = None
+    if "--workers" in sys.argv:
+        workers = int(sys.argv[sys.argv.index("--workers") + 1])
+    run_ingestion(full="--full" in sys.argv, workers=workers)
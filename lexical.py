@@ -0,0 +1,144 @@
+import os
+import re
+import json
+import shutil
+from array import array
+import numpy as np
+from chunk_store import in_ranges
+
+# Files inside a lexical index directory
+VOCAB_FILE = "vocab.json"       # terms, position = term id
+INDPTR_FILE = "indptr.npy"      # int64[terms + 1], postings of term t are indptr[t]:indptr[t + 1]
+POSTINGS_FILE = "postings.npy"  # int32[postings], chunk store row of each posting
+WEIGHTS_FILE = "weights.npy"    # float32[postings], precomputed BM25 term weight
+IDS_FILE = "ids.npy"            # int64[rows], index id of each chunk store row
+
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+TOKEN_PATTERN = re.compile(r"[a-z0-9]+")
+STOPWORDS = frozenset("""
+a an and are as at be by for from has have in is it its of on or that the this to was were will with
+what which when where who how do does can should if not no than then there these those""".split())
+
+
+def tokenize(text):
+    """Lowercased alphanumeric runs; "MS20995-C32" gives ms20995 and c32, "Vso" gives vso."""
+    return [t for t in TOKEN_PATTERN.findall(text.lower()) if t not in STOPWORDS]
+
+
+def build_lexical_index(store, path):
+    """
+    Builds a BM25 inverted index over every chunk in a ChunkStore and writes it to path.
+    Postings are stored as flat arrays (CSR layout), with the BM25 weight of
+    each (term, chunk) pair computed up front so a query is a gather and a sum.
+    """
+    vocab = {}
+    term_ids = array("i")
+    rows = array("i")
+    tfs = array("f")
+    lengths = np.zeros(len(store), dtype=np.float32)
+    for row in range(len(store)):
+        tokens = tokenize(store.text_bytes(row).decode("utf-8"))
+        lengths[row] = len(tokens)
+        counts = {}
+        for token in tokens:
+            counts[token] = counts.get(token, 0) + 1
+        for token, count in counts.items():
+            term_ids.append(vocab.setdefault(token, len(vocab)))
+            rows.append(row)
+            tfs.append(count)
+
+    term_ids = np.frombuffer(term_ids, dtype=np.int32)
+    order = np.argsort(term_ids, kind="stable")
+    postings = np.frombuffer(rows, dtype=np.int32)[order]
+    tf = np.frombuffer(tfs, dtype=np.float32)[order]
+    df = np.bincount(term_ids, minlength=len(vocab))
+    indptr = np.concatenate([[0], np.cumsum(df)]).astype(np.int64)
+
+    n = max(len(store), 1)
+    idf = np.log(1 + (n - df + 0.5) / (df + 0.5)).astype(np.float32)
+    avg_len = float(lengths.mean()) if len(store) else 1.0
+    norm = BM25_K1 * (1 - BM25_B + BM25_B * lengths[postings] / max(avg_len, 1.0))
+    weights = np.repeat(idf, df) * tf * (BM25_K1 + 1) / (tf + norm)
+
+    tmp_path = path + ".tmp"
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    os.makedirs(tmp_path)
+    with open(os.path.join(tmp_path, VOCAB_FILE), "w") as f:
+        json.dump(list(vocab), f)
+    np.save(os.path.join(tmp_path, INDPTR_FILE), indptr)
+    np.save(os.path.join(tmp_path, POSTINGS_FILE), postings)
+    np.save(os.path.join(tmp_path, WEIGHTS_FILE), weights.astype(np.float32))
+    np.save(os.path.join(tmp_path, IDS_FILE), np.asarray(store.ids, dtype=np.int64))
+
+    old_path = path + ".old"
+    shutil.rmtree(old_path, ignore_errors=True)
+    if os.path.exists(path):
+        os.replace(path, old_path)
+    os.replace(tmp_path, path)
+    shutil.rmtree(old_path, ignore_errors=True)
+    print(f"Lexical index: {len(vocab)} terms, {len(postings)} postings.")
+
+
+class LexicalIndex:
+    """Memory-mapped BM25 index written by build_lexical_index."""
+    def __init__(self, path):
+        self.path = path
+
+        def load(name):
+            return np.load(os.path.join(path, name), mmap_mode="r")
+
+        with open(os.path.join(path, VOCAB_FILE)) as f:
+            self.vocab = {term: i for i, term in enumerate(json.load(f))}
+        self.indptr = load(INDPTR_FILE)
+        self.postings = load(POSTINGS_FILE)
+        self.weights = load(WEIGHTS_FILE)
+        self.ids = load(IDS_FILE)
+
+    @staticmethod
+    def exists(path):
+        return os.path.exists(os.path.join(path, IDS_FILE))
+
+    def search(self, query, k, ranges=None):
+        """
+        Returns (scores, ids) of the top k chunks by BM25 score, best first.
+        ranges: only consider chunks with ids in these [first, end) ranges.
+        """
+        terms = [self.vocab[t] for t in set(tokenize(query)) if t in self.vocab]
+        if not terms:
+            return np.zeros(0, dtype=np.float32), np.zeros(0, dtype=np.int64)
+        rows = np.concatenate([self.postings[self.indptr[t]:self.indptr[t + 1]] for t in terms])
+        weights = np.concatenate([self.weights[self.indptr[t]:self.indptr[t + 1]] for t in terms])
+        # Sum the weights per chunk without touching chunks that match no term
+        unique_rows, inverse = np.unique(rows, return_inverse=True)
+        scores = np.bincount(inverse, weights=weights).astype(np.float32)
+        if ranges is not None:
+            allowed = in_ranges(np.asarray(self.ids)[unique_rows], ranges)
+            unique_rows, scores = unique_rows[allowed], scores[allowed]
+        if len(scores) > k:
+            top = np.argpartition(-scores, k)[:k]
+        else:
+            top = np.arange(len(scores))
+        top = top[np.argsort(-scores[top], kind="stable")]
+        return scores[top], np.asarray(self.ids)[unique_rows[top]]
+
+
+def reciprocal_rank_fusion(rankings, k, rrf_k=60):
+    """
+    Fuses several ranked id arrays into one: score(id) = sum of 1 / (rrf_k + rank).
+    Returns (fused scores, ids) of the top k, best first.
+    """
+    rankings = [np.asarray(r, dtype=np.int64) for r in rankings]
+    rankings = [r[r != -1] for r in rankings]
+    if not any(len(r) for r in rankings):
+        return np.zeros(0), np.zeros(0, dtype=np.int64)
+    ids = np.concatenate(rankings)
+    contributions = np.concatenate([1.0 / (rrf_k + 1 + np.arange(len(r))) for r in rankings])
+    unique_ids, inverse = np.unique(ids, return_inverse=True)
+    scores = np.bincount(inverse, weights=contributions)
+    # Ties go to whichever id appears first, i.e. to the earlier ranking
+    first = np.full(len(unique_ids), len(ids))
+    np.minimum.at(first, inverse, np.arange(len(ids)))
+    top = np.lexsort((first, -scores))[:k]
+    return scores[top], unique_ids[top]
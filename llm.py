@@ -1,10 +1,104 @@
 import os
-from groq import Groq
+import time
+import asyncio
+from types import SimpleNamespace
+from groq import Groq, AsyncGroq
 from dotenv import load_dotenv
+import metrics
 
 load_dotenv()
 
-client = Groq(api_key=os.getenv("GROQ_API_KEY"))
+# Prompt context is packed into this many (estimated) tokens
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "1500"))
+# Chunks whose word 3-gram sets overlap at least this much (Jaccard) with a better chunk are dropped
+NEAR_DUPLICATE_THRESHOLD = float(os.getenv("CONTEXT_DEDUP_THRESHOLD", "0.8"))
+# Shortest suffix/prefix match treated as chunk overlap when merging neighbours
+MIN_MERGE_OVERLAP = 20
+
+# Set to answer every prompt locally after this many milliseconds instead of calling Groq,
+# for load tests of retrieval and server overhead (see evaluate.py --load --stub-llm)
+LLM_STUB_MS = os.getenv("LLM_STUB_MS")
+# Delay between streamed tokens of the stub
+LLM_STUB_TOKEN_MS = float(os.getenv("LLM_STUB_TOKEN_MS", "10"))
+STUB_ANSWER = "Answer: This is a stub answer for load testing.\nCitations: Stub, Page 1"
+
+
+class _StubCompletions:
+    """Mimics client.chat.completions.create of the Groq SDK with a fixed answer and latency."""
+    def __init__(self, asynchronous):
+        self.asynchronous = asynchronous
+        self.delay = float(LLM_STUB_MS or 0) / 1000
+
+    def _usage(self, kwargs):
+        prompt = "".join(m["content"] for m in kwargs["messages"])
+        return SimpleNamespace(prompt_tokens=estimate_tokens(prompt), completion_tokens=estimate_tokens(STUB_ANSWER))
+
+    def _completion(self, kwargs):
+        message = SimpleNamespace(content=STUB_ANSWER)
+        return SimpleNamespace(choices=[SimpleNamespace(message=message)], usage=self._usage(kwargs))
+
+    def _chunks(self, kwargs):
+        for i, token in enumerate(STUB_ANSWER.split(" ")):
+            delta = SimpleNamespace(content=token if i == 0 else " " + token)
+            yield SimpleNamespace(choices=[SimpleNamespace(delta=delta)], usage=None)
+        yield SimpleNamespace(choices=[], usage=self._usage(kwargs))
+
+    def create(self, **kwargs):
+        if self.asynchronous:
+            return self._create_async(kwargs)
+        time.sleep(self.delay)
+        if not kwargs.get("stream"):
+            return self._completion(kwargs)
+
+        def stream():
+            for chunk in self._chunks(kwargs):
+                yield chunk
+                time.sleep(LLM_STUB_TOKEN_MS / 1000)
+        return stream()
+
+    async def _create_async(self, kwargs):
+        await asyncio.sleep(self.delay)
+        if not kwargs.get("stream"):
+            return self._completion(kwargs)
+
+        async def stream():
+            for chunk in self._chunks(kwargs):
+                yield chunk
+                await asyncio.sleep(LLM_STUB_TOKEN_MS / 1000)
+        return stream()
+
+
+class StubClient:
+    def __init__(self, asynchronous=False):
+        self.chat = SimpleNamespace(completions=_StubCompletions(asynchronous))
+
+    def with_options(self, **kwargs):
+        return self
+
+
+if LLM_STUB_MS:
+    print(f"LLM_STUB_MS is set: answering locally after {LLM_STUB_MS} ms instead of calling Groq.")
+    client = StubClient()
+    async_client = StubClient(asynchronous=True)
+else:
+    client = Groq(api_key=os.getenv("GROQ_API_KEY"))
+    # Used by the API so waiting on Groq does not block the event loop
+    async_client = AsyncGroq(api_key=os.getenv("GROQ_API_KEY"))
+
+# Start of the text ask_llm and ask_llm_async return instead of an answer when Groq fails
+LLM_ERROR_PREFIX = "Error communicating with LLM"
+
+
+class LLMError(Exception):
+    """Groq failed; raised by stream_llm and stream_llm_async, possibly after some tokens were already yielded."""
+
+
+def is_llm_error(response_text):
+    """True when response_text is the error text of ask_llm/ask_llm_async rather than an answer."""
+    return response_text.startswith(LLM_ERROR_PREFIX)
+
+# Answer to questions the documents do not cover; also given without an LLM call when retrieval finds nothing
+REFUSAL_ANSWER = "This information is not available in the provided document(s)."
 
 SYSTEM_PROMPT = """You are an aviation assistant.
 You answer questions ONLY based on the provided context.
@@ -18,30 +112,218 @@ Answer: [Your answer here]
 Citations: [List of citations separated by semicolon, e.g. "Book 1, Page 23; Manual, Page 10"]
 """
 
+def _completion_args(prompt, model, stream=False, system_prompt=None):
+    return dict(
+        model=model,
+        messages=[
+            {"role": "system", "content": system_prompt or SYSTEM_PROMPT},
+            {"role": "user", "content": prompt}
+        ],
+        temperature=0,
+        max_completion_tokens=8192,
+        top_p=1,
+        stream=stream
+    )
+
+def _stream_usage(chunk):
+    # Groq reports usage on the last chunk of a stream, under x_groq
+    return getattr(getattr(chunk, "x_groq", None), "usage", None) or getattr(chunk, "usage", None)
+
 def ask_llm(prompt, model="openai/gpt-oss-120b"):
     try:
-        completion = client.chat.completions.create(
-            model=model,
-            messages=[
-                {"role": "system", "content": SYSTEM_PROMPT},
-                {"role": "user", "content": prompt}
-            ],
-            temperature=0,
-            max_completion_tokens=8192,
-            top_p=1,
-            stream=False
-        )
+        with metrics.stage("llm"):
+            completion = client.chat.completions.create(**_completion_args(prompt, model))
+        metrics.record_usage(completion.usage)
         return completion.choices[0].message.content
     except Exception as e:
-        return f"Error communicating with LLM: {str(e)}"
+        return f"{LLM_ERROR_PREFIX}: {str(e)}"
+
+async def complete_async(prompt, model="openai/gpt-oss-120b", client=None, system_prompt=None):
+    """
+    Awaits one completion and returns its text. Errors propagate (e.g. groq.RateLimitError),
+    so callers can retry; client overrides the shared async_client and system_prompt
+    the RAG answering one.
+    """
+    with metrics.stage("llm"):
+        completion = await (client or async_client).chat.completions.create(**_completion_args(prompt, model, system_prompt=system_prompt))
+    metrics.record_usage(completion.usage)
+    return completion.choices[0].message.content
 
-def build_prompt(question, retrieved_chunks):
+async def ask_llm_async(prompt, model="openai/gpt-oss-120b"):
+    """
+    Same as ask_llm, but awaits the Groq call instead of blocking the thread.
+    """
+    try:
+        return await complete_async(prompt, model)
+    except Exception as e:
+        return f"{LLM_ERROR_PREFIX}: {str(e)}"
+
+def stream_llm(prompt, model="openai/gpt-oss-120b"):
+    """
+    Yields answer tokens as Groq produces them. A Groq failure raises LLMError
+    instead of being yielded as text, so it cannot pass for (the end of) an answer.
+    """
+    try:
+        with metrics.stage("llm"):
+            start = time.perf_counter()
+            stream = client.chat.completions.create(**_completion_args(prompt, model, stream=True))
+            for chunk in stream:
+                metrics.record_usage(_stream_usage(chunk))
+                content = chunk.choices[0].delta.content if chunk.choices else None
+                if content:
+                    if start is not None:
+                        metrics.observe("llm_first_token", time.perf_counter() - start)
+                        start = None
+                    yield content
+    except Exception as e:
+        raise LLMError(f"{LLM_ERROR_PREFIX}: {str(e)}") from e
+
+async def stream_llm_async(prompt, model="openai/gpt-oss-120b"):
+    """
+    Async version of stream_llm for the API.
+    """
+    try:
+        with metrics.stage("llm"):
+            start = time.perf_counter()
+            stream = await async_client.chat.completions.create(**_completion_args(prompt, model, stream=True))
+            async for chunk in stream:
+                metrics.record_usage(_stream_usage(chunk))
+                content = chunk.choices[0].delta.content if chunk.choices else None
+                if content:
+                    if start is not None:
+                        metrics.observe("llm_first_token", time.perf_counter() - start)
+                        start = None
+                    yield content
+    except Exception as e:
+        raise LLMError(f"{LLM_ERROR_PREFIX}: {str(e)}") from e
+
+@metrics.timed("parse")
+def parse_response(response_text):
+    """
+    Splits an "Answer: ... Citations: a; b" completion into (answer, citations).
+    Refusals are normalized to the exact guardrail sentence with no citations.
+    """
+    answer = response_text
+    citations = []
+
+    if "Citations:" in response_text:
+        parts = response_text.split("Citations:")
+        answer = parts[0].replace("Answer:", "").strip()
+        citations_text = parts[1].strip()
+        citations = [c.strip() for c in citations_text.split(";") if c.strip()]
+    else:
+        answer = response_text.replace("Answer:", "").strip()
+
+    if "This information is not available" in answer:
+        answer = REFUSAL_ANSWER
+        citations = []
+
+    return answer, citations
+
+def estimate_tokens(text):
+    """Rough token count (about 4 characters per token) for budgeting; no tokenizer needed."""
+    return (len(text) + 3) // 4
+
+def _overlap(a, b):
+    """Length of the longest suffix of a that is a prefix of b (at least MIN_MERGE_OVERLAP), else 0."""
+    probe = b[:MIN_MERGE_OVERLAP]
+    if len(probe) < MIN_MERGE_OVERLAP:
+        return 0
+    pos = a.find(probe, max(0, len(a) - len(b)))
+    while pos != -1:
+        if b.startswith(a[pos:]):
+            return len(a) - pos
+        pos = a.find(probe, pos + 1)
+    return 0
+
+def _merge_neighbours(chunks):
+    """Joins chunks of the same source and page whose texts overlap, as ingest's chunk overlap produces."""
+    by_page = {}
+    for c in chunks:
+        by_page.setdefault((c['source'], c['page']), []).append(c)
+    merged = []
+    for page_chunks in by_page.values():
+        # Ingest numbers the chunks of a page in text order
+        page_chunks = sorted(page_chunks, key=lambda c: c.get('id', 0))
+        current = dict(page_chunks[0])
+        for c in page_chunks[1:]:
+            if c['text'] in current['text']:
+                _merge_scores(current, c)
+                continue
+            overlap = _overlap(current['text'], c['text'])
+            if overlap:
+                current['text'] += c['text'][overlap:]
+                _merge_scores(current, c)
+            else:
+                merged.append(current)
+                current = dict(c)
+        merged.append(current)
+    return merged
+
+def _merge_scores(current, c):
+    current['score'] = min(current.get('score', 0.0), c.get('score', 0.0))
+    if 'rerank_score' in c:
+        current['rerank_score'] = max(current.get('rerank_score', c['rerank_score']), c['rerank_score'])
+
+def _rank_key(c):
+    """Best first: reranked chunks by cross-encoder score, then the rest by L2 distance."""
+    if 'rerank_score' in c:
+        return (0, -c['rerank_score'])
+    return (1, c.get('score', 0.0))
+
+def _shingles(text):
+    words = text.lower().split()
+    return {tuple(words[i:i + 3]) for i in range(max(1, len(words) - 2))}
+
+def _format_chunk(i, c):
+    return f"--- Chunk {i+1} ---\nSource: {c['source']}\nPage: {c['page']}\nText: {c['text']}\n\n"
+
+def pack_context(retrieved_chunks, token_budget=None):
+    """
+    Selects the prompt context from retrieved chunks:
+    overlapping neighbours from the same source and page are merged, near-duplicates
+    of a better-scored chunk are dropped, and the rest are added best score first
+    (reranked chunks by cross-encoder score) while they fit in token_budget
+    (CONTEXT_TOKEN_BUDGET by default).
+    Returns (chunks, stats) where stats compares against sending every chunk verbatim.
+    """
+    budget = CONTEXT_TOKEN_BUDGET if token_budget is None else token_budget
+    tokens_before = sum(estimate_tokens(_format_chunk(i, c)) for i, c in enumerate(retrieved_chunks))
+
+    candidates = sorted(_merge_neighbours(retrieved_chunks), key=_rank_key)
+    packed, kept_shingles, used = [], [], 0
+    for c in candidates:
+        shingles = _shingles(c['text'])
+        if any(len(shingles & kept) / len(shingles | kept) >= NEAR_DUPLICATE_THRESHOLD for kept in kept_shingles):
+            continue
+        cost = estimate_tokens(_format_chunk(len(packed), c))
+        if used + cost > budget:
+            if packed:
+                continue
+            # Never send an empty context because the best chunk alone is too long
+            header = len(_format_chunk(0, dict(c, text="")))
+            c = dict(c, text=c['text'][:max(0, budget * 4 - header)])
+            cost = estimate_tokens(_format_chunk(0, c))
+        packed.append(c)
+        kept_shingles.append(shingles)
+        used += cost
+
+    return packed, {
+        "chunks_in": len(retrieved_chunks),
+        "chunks_out": len(packed),
+        "tokens_before": tokens_before,
+        "tokens_after": used,
+        "tokens_saved": tokens_before - used
+    }
+
+@metrics.timed("build_prompt")
+def build_prompt_with_stats(question, retrieved_chunks, token_budget=None):
+    """build_prompt that also returns the packing stats of pack_context."""
     if not retrieved_chunks:
-        return "Context: None\n\nQuestion: " + question
-        
-    context_str = ""
-    for i, c in enumerate(retrieved_chunks):
-        context_str += f"--- Chunk {i+1} ---\nSource: {c['source']}\nPage: {c['page']}\nText: {c['text']}\n\n"
+        return "Context: None\n\nQuestion: " + question, pack_context([], token_budget)[1]
+
+    packed, stats = pack_context(retrieved_chunks, token_budget)
+    context_str = "".join(_format_chunk(i, c) for i, c in enumerate(packed))
 
     prompt = f"""
 CONTEXT:
@@ -54,4 +336,7 @@ Based strictly on the context above, answer the question.
 Remember to provide citations in the format "Source, Page" separated by semicolon.
 If the answer is not in the context, say "This information is not available in the provided document(s)."
 """
-    return prompt
+    return prompt, stats
+
+def build_prompt(question, retrieved_chunks, token_budget=None):
+    return build_prompt_with_stats(question, retrieved_chunks, token_budget)[0]
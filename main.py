@@ -1,15 +1,158 @@
 from fastapi import FastAPI, HTTPException, BackgroundTasks
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import FileResponse
+from fastapi.responses import FileResponse, StreamingResponse, JSONResponse, PlainTextResponse
 from pydantic import BaseModel
-from typing import List, Optional
+from typing import List, Optional, Tuple
 import uvicorn
-import ingest
+import asyncio
+import functools
+import json
+import time
+import contextvars
+from contextlib import asynccontextmanager
+from concurrent.futures import ThreadPoolExecutor
 import rag
 import llm
 import os
+import metrics
+from cache import AnswerCache
 
-app = FastAPI(title="Aviation RAG Chatbot")
+
+# Embedding + FAISS search are CPU-bound and run on this pool instead of the event loop.
+# torch and faiss release the GIL, so threads overlap well.
+RETRIEVAL_WORKERS = int(os.getenv("RETRIEVAL_WORKERS", "4"))
+# Requests beyond this limit wait for a free slot
+MAX_CONCURRENT_REQUESTS = int(os.getenv("MAX_CONCURRENT_REQUESTS", "64"))
+# /ask_batch: questions per request, and Groq calls in flight per batch
+ASK_BATCH_MAX_QUESTIONS = int(os.getenv("ASK_BATCH_MAX_QUESTIONS", "1000"))
+ASK_BATCH_CONCURRENCY = int(os.getenv("ASK_BATCH_CONCURRENCY", "8"))
+
+# Load and warm the index and model at startup instead of on the first /ask (RAG_WARM_UP=0 disables)
+WARM_UP_ON_STARTUP = os.getenv("RAG_WARM_UP", "1") != "0"
+
+retrieval_executor = ThreadPoolExecutor(max_workers=RETRIEVAL_WORKERS, thread_name_prefix="retrieval")
+request_slots = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+
+
+async def run_in_retrieval_pool(func, *args, **kwargs):
+    loop = asyncio.get_running_loop()
+    # Carry the request's context (its metrics trace) into the worker thread
+    context = contextvars.copy_context()
+    return await loop.run_in_executor(retrieval_executor, context.run, functools.partial(func, *args, **kwargs))
+
+
+@asynccontextmanager
+async def request_slot():
+    with metrics.stage("queue"):
+        await request_slots.acquire()
+    try:
+        yield
+    finally:
+        request_slots.release()
+
+
+# Final answers, keyed on the normalized question (exact) and its embedding (semantic).
+# ANSWER_CACHE_SIZE=0 disables the cache.
+answer_cache = AnswerCache(
+    max_entries=int(os.getenv("ANSWER_CACHE_SIZE", "1024")),
+    ttl=float(os.getenv("ANSWER_CACHE_TTL", "3600")),
+    max_distance=float(os.getenv("ANSWER_CACHE_MAX_DISTANCE", "0.05"))
+)
+
+
+def _answer_cache_metrics():
+    stats = answer_cache.stats()
+    return metrics.gauge_lines(
+        "rag_answer_cache", "Answer cache: entries, exact/semantic hits, misses and hit ratio.",
+        {key: stats[key] for key in ("entries", "exact_hits", "semantic_hits", "misses", "hit_ratio")}
+    )
+
+metrics.COLLECTORS.append(_answer_cache_metrics)
+
+# Questions refused right after retrieval because no chunk was left (e.g. by RAG_ADAPTIVE_K)
+LLM_SKIPPED = metrics.Counter("rag_llm_skipped_total", "Questions refused without an LLM call because retrieval returned no chunk.")
+
+
+async def lookup_cached_answer(question, filters=None):
+    """
+    Returns (cached, embedding, version). The question is only embedded when the
+    exact lookup misses; the embedding is then reused for retrieval.
+    Answers are cached for the whole corpus, so filtered questions always miss.
+    """
+    version = rag.index_version()
+    if filters:
+        return None, None, version
+    cached = answer_cache.get(question, version)
+    if cached is not None:
+        return cached, None, version
+    embedding = None
+    if answer_cache.enabled:
+        future = rag.submit_embed_query(question)
+        if future is not None:
+            embedding = await asyncio.wrap_future(future)
+        else:
+            embedding = await run_in_retrieval_pool(rag.embed_query, question)
+    return answer_cache.get_similar(embedding, version), embedding, version
+
+
+async def retrieve(question, embedding, filters):
+    """
+    rag.retrieve for one request. With batching on, the query waits for its batch on the
+    event loop instead of holding a retrieval pool thread, so batches are not capped at
+    RETRIEVAL_WORKERS queries; only adaptive k and reranking run in the pool.
+    """
+    submitted = rag.submit_retrieve(question, query_embedding=embedding, **filters)
+    if submitted is None:
+        return await run_in_retrieval_pool(rag.retrieve, question, query_embedding=embedding, **filters)
+    future, finish = submitted
+    hits = await asyncio.wrap_future(future)
+    return hits if finish is None else await run_in_retrieval_pool(finish, hits)
+
+
+def cache_answer(question, embedding, version, answer, citations, chunks, filters=None):
+    """Caches an answer; callers only pass answers the LLM (or the refusal) actually gave, never errors."""
+    if filters:
+        return
+    answer_cache.put(question, embedding, {"answer": answer, "citations": citations, "chunks": chunks}, version)
+
+
+def run_ingestion_task():
+    # Query-only workers never import ingest (and its PDF/embedding dependencies) otherwise
+    import ingest
+    result = ingest.run_ingestion()
+    if result.get("status") == "success":
+        # Swap the new version in; requests in flight finish on the old one
+        rag.reload_index()
+        answer_cache.clear()
+        if not rag.is_ready():
+            rag.warm_up()
+    return result
+
+
+async def warm_up():
+    start = time.perf_counter()
+    try:
+        timings = await run_in_retrieval_pool(rag.warm_up)
+    except Exception as e:
+        print(f"Warm-up failed: {e}")
+        return
+    if timings is None:
+        print("Warm-up skipped: no index yet. Run ingestion first.")
+    else:
+        steps = ", ".join(f"{name} {seconds:.2f}s" for name, seconds in timings.items())
+        print(f"Warm-up done in {time.perf_counter() - start:.2f}s ({steps}).")
+
+
+@asynccontextmanager
+async def lifespan(app):
+    # Runs in the background: /health answers at once, /ready once warm-up is done
+    task = asyncio.create_task(warm_up()) if WARM_UP_ON_STARTUP else None
+    yield
+    if task is not None:
+        task.cancel()
+
+
+app = FastAPI(title="Aviation RAG Chatbot", lifespan=lifespan)
 
 
 if not os.path.exists("static"):
@@ -21,6 +164,13 @@ app.mount("/static", StaticFiles(directory="static"), name="static")
 class AskRequest(BaseModel):
     question: str
     debug: bool = False
+    # Optional filters: only chunks from these documents (file names) and/or pages (first, last; inclusive)
+    sources: Optional[List[str]] = None
+    page_range: Optional[Tuple[int, int]] = None
+
+    def filters(self):
+        """The filters as retrieve() keyword arguments; empty when the whole corpus is searched."""
+        return {name: value for name, value in (("sources", self.sources), ("page_range", self.page_range)) if value is not None}
 
 class ChunkInfo(BaseModel):
     text: str
@@ -32,6 +182,16 @@ class AskResponse(BaseModel):
     answer: str
     citations: List[str]
     retrieved_chunks: Optional[List[ChunkInfo]] = None
+    # Debug mode: prompt context packing, see llm.pack_context
+    context_stats: Optional[dict] = None
+    # Debug mode: milliseconds spent per pipeline stage
+    timings_ms: Optional[dict] = None
+    # Set when the LLM call failed; answer then holds the same text and nothing is cached
+    error: Optional[str] = None
+
+class AskBatchRequest(BaseModel):
+    questions: List[str]
+    debug: bool = False
 
 @app.get("/")
 async def read_root():
@@ -42,7 +202,7 @@ async def trigger_ingestion(background_tasks: BackgroundTasks):
     """
     Triggers document ingestion in the background.
     """
-    background_tasks.add_task(ingest.run_ingestion)
+    background_tasks.add_task(run_ingestion_task)
     return {"message": "Ingestion started in background"}
 
 @app.get("/ask")
@@ -55,30 +215,37 @@ async def ask_question(request: AskRequest):
     Asks a question to the RAG system.
     """
     try:
-        # 1. Retrieve chunks
-        chunks = rag.retrieve(request.question, k=5)
-        
-        # 2. Build prompt
-        prompt = llm.build_prompt(request.question, chunks)
-        
-        # 3. Ask LLM
-        response_text = llm.ask_llm(prompt)
-        
-        # 4. Parse response
-        answer = response_text
-        citations = []
-        
-        if "Citations:" in response_text:
-            parts = response_text.split("Citations:")
-            answer = parts[0].replace("Answer:", "").strip()
-            citations_text = parts[1].strip()
-            citations = [c.strip() for c in citations_text.split(";") if c.strip()]
-        else:
-             answer = response_text.replace("Answer:", "").strip()
+        trace = metrics.start_trace()
+        with metrics.stage("ask"):
+            async with request_slot():
+                filters = request.filters()
+                # 0. Answer from cache when the same (or a near-identical) question was asked
+                cached, embedding, version = await lookup_cached_answer(request.question, filters)
+                context_stats = None
+                error = None
+                if cached is not None:
+                    answer, citations, chunks = cached["answer"], cached["citations"], cached["chunks"]
+                else:
+                    # 1. Retrieve chunks
+                    with metrics.stage("retrieve"):
+                        chunks = await retrieve(request.question, embedding, filters)
+
+                    if not chunks:
+                        # Nothing relevant was found: refuse without a Groq round trip
+                        response_text = refuse_without_llm()
+                    else:
+                        # 2. Build prompt
+                        prompt, context_stats = llm.build_prompt_with_stats(request.question, chunks)
+
+                        # 3. Ask LLM
+                        response_text = await llm.ask_llm_async(prompt)
 
-        if "This information is not available" in answer:
-            answer = "This information is not available in the provided document(s)."
-            citations = []
+                    # 4. Parse response
+                    answer, citations = llm.parse_response(response_text)
+                    if llm.is_llm_error(response_text):
+                        error = response_text
+                    else:
+                        cache_answer(request.question, embedding, version, answer, citations, chunks, filters)
         
         retrieved_chunks = None
         if request.debug:
@@ -94,15 +261,205 @@ async def ask_question(request: AskRequest):
         return AskResponse(
             answer=answer, 
             citations=citations, 
-            retrieved_chunks=retrieved_chunks
+            retrieved_chunks=retrieved_chunks,
+            context_stats=context_stats if request.debug else None,
+            timings_ms={name: round(seconds * 1000, 2) for name, seconds in trace.items()} if request.debug else None,
+            error=error
         )
 
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+def refuse_without_llm():
+    LLM_SKIPPED.inc()
+    return llm.REFUSAL_ANSWER
+
+def sse_event(event, data):
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+@app.post("/ask/stream")
+async def ask_question_stream(request: AskRequest):
+    """
+    Streams the answer as server-sent events:
+    'chunks' with the retrieved chunk metadata first, then one 'token' event per
+    piece of LLM output as it arrives, then 'done' with the parsed answer and citations.
+    A failure ends the stream with 'error' instead of 'done', even after some tokens.
+    Chunk texts are only included in debug mode.
+    """
+    async def events():
+        trace = metrics.start_trace()
+        with metrics.stage("ask_stream"):
+            async with request_slot():
+                try:
+                    filters = request.filters()
+                    cached, embedding, version = await lookup_cached_answer(request.question, filters)
+                    if cached is not None:
+                        chunks = cached["chunks"]
+                    else:
+                        with metrics.stage("retrieve"):
+                            chunks = await retrieve(request.question, embedding, filters)
+                    yield sse_event("chunks", {"chunks": [
+                        {
+                            "source": c['source'],
+                            "page": c['page'],
+                            "score": c.get('score', 0.0),
+                            **({"text": c['text']} if request.debug else {})
+                        } for c in chunks
+                    ]})
+
+                    if cached is not None:
+                        yield sse_event("token", {"text": cached["answer"]})
+                        yield sse_event("done", {"answer": cached["answer"], "citations": cached["citations"]})
+                        return
+                    if not chunks:
+                        response_text = refuse_without_llm()
+                        cache_answer(request.question, embedding, version, response_text, [], chunks, filters)
+                        yield sse_event("token", {"text": response_text})
+                        yield sse_event("done", {"answer": response_text, "citations": []})
+                        return
+
+                    prompt, context_stats = llm.build_prompt_with_stats(request.question, chunks)
+                    parts = []
+                    # A Groq failure raises llm.LLMError, possibly after some tokens: the client
+                    # gets an 'error' event instead of 'done' and the partial answer is not cached
+                    async for token in llm.stream_llm_async(prompt):
+                        parts.append(token)
+                        yield sse_event("token", {"text": token})
+
+                    response_text = "".join(parts)
+                    answer, citations = llm.parse_response(response_text)
+                    cache_answer(request.question, embedding, version, answer, citations, chunks, filters)
+                    done = {"answer": answer, "citations": citations}
+                    if request.debug:
+                        done["context_stats"] = context_stats
+                        done["timings_ms"] = {name: round(seconds * 1000, 2) for name, seconds in trace.items()}
+                    yield sse_event("done", done)
+                except Exception as e:
+                    yield sse_event("error", {"detail": str(e)})
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+async def retrieve_for_batch(questions):
+    """
+    Cache lookups and retrieval for a whole batch. Questions missing the exact
+    cache are embedded as one matrix, checked against the semantic cache, and
+    the rest are searched together.
+    Returns (items, version); each item is (cached answer or None, chunks, embedding).
+    """
+    version = rag.index_version()
+    items = [(answer_cache.get(q, version), None, None) for q in questions]
+    pending = [i for i, item in enumerate(items) if item[0] is None]
+    if not pending:
+        return items, version
+
+    embeddings = await run_in_retrieval_pool(rag.embed_queries, [questions[i] for i in pending])
+    if embeddings is None:
+        return [(item[0], [], None) for item in items], version
+    to_search = []
+    for row, i in enumerate(pending):
+        cached = answer_cache.get_similar(embeddings[row], version)
+        items[i] = (cached, None, embeddings[row])
+        if cached is None:
+            to_search.append(row)
+    if to_search:
+        results = await run_in_retrieval_pool(
+            rag.retrieve_batch, [questions[pending[row]] for row in to_search], embeddings=embeddings[to_search]
+        )
+        for row, chunks in zip(to_search, results):
+            items[pending[row]] = (None, chunks, embeddings[row])
+    return items, version
+
+@app.post("/ask_batch")
+async def ask_batch(request: AskBatchRequest):
+    """
+    Answers many questions in one request.
+    Retrieval runs once for the whole batch, then up to ASK_BATCH_CONCURRENCY
+    LLM calls run at a time. Results are streamed as newline-delimited JSON in
+    completion order, each tagged with the index of its question; a failing
+    question yields an object with "error" and does not affect the others.
+    """
+    questions = request.questions
+    if len(questions) > ASK_BATCH_MAX_QUESTIONS:
+        raise HTTPException(status_code=400, detail=f"At most {ASK_BATCH_MAX_QUESTIONS} questions per batch")
+
+    async def answer(i, item, version, llm_slots):
+        cached, chunks, embedding = item
+        result = {"index": i, "question": questions[i]}
+        # Each task runs in its own context, so this trace only sees this question's LLM work
+        trace = metrics.start_trace()
+        try:
+            if cached is not None:
+                answer_text, citations, chunks = cached["answer"], cached["citations"], cached["chunks"]
+            elif not chunks:
+                answer_text, citations = refuse_without_llm(), []
+                cache_answer(questions[i], embedding, version, answer_text, citations, chunks)
+            else:
+                prompt, context_stats = llm.build_prompt_with_stats(questions[i], chunks)
+                if request.debug:
+                    result["context_stats"] = context_stats
+                async with llm_slots, request_slots:
+                    response_text = await llm.ask_llm_async(prompt)
+                if llm.is_llm_error(response_text):
+                    raise RuntimeError(response_text)
+                answer_text, citations = llm.parse_response(response_text)
+                cache_answer(questions[i], embedding, version, answer_text, citations, chunks)
+            result.update(answer=answer_text, citations=citations)
+            if request.debug:
+                result["retrieved_chunks"] = [
+                    {"text": c['text'], "source": c['source'], "page": c['page'], "score": c.get('score', 0.0)}
+                    for c in chunks
+                ]
+                result["timings_ms"] = {name: round(seconds * 1000, 2) for name, seconds in trace.items()}
+        except Exception as e:
+            result["error"] = str(e)
+        return result
+
+    async def lines():
+        try:
+            with metrics.stage("retrieve"):
+                items, version = await retrieve_for_batch(questions)
+        except Exception as e:
+            for i, question in enumerate(questions):
+                yield json.dumps({"index": i, "question": question, "error": str(e)}) + "\n"
+            return
+        llm_slots = asyncio.Semaphore(ASK_BATCH_CONCURRENCY)
+        tasks = [asyncio.create_task(answer(i, item, version, llm_slots)) for i, item in enumerate(items)]
+        try:
+            for task in asyncio.as_completed(tasks):
+                yield json.dumps(await task) + "\n"
+        finally:
+            # Client went away: stop the remaining LLM calls
+            for task in tasks:
+                task.cancel()
+
+    return StreamingResponse(lines(), media_type="application/x-ndjson")
+
 @app.get("/health")
 def health_check():
     return {"status": "ok"}
 
+@app.get("/metrics")
+def metrics_endpoint():
+    """
+    Prometheus text format: per-stage latency histograms and in-flight gauges
+    (queue, retrieve, encode, search, build_prompt, llm, parse, ...), Groq token
+    counts, and answer/embedding cache hit ratios.
+    """
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+@app.get("/ready")
+def readiness_check():
+    """
+    200 once the index and model are loaded and warmed, 503 before that
+    (or while there is no index). /health only says the process is up.
+    """
+    if rag.is_ready():
+        return {"status": "ready", "index_version": rag.index_version()}
+    return JSONResponse(status_code=503, content={"status": "not ready", "index_version": rag.index_version()})
+
 if __name__ == "__main__":
     uvicorn.run(app, host="0.0.0.0", port=8000)
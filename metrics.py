@@ -0,0 +1,185 @@
+import time
+import bisect
+import functools
+import threading
+import contextvars
+from contextlib import contextmanager
+
+# Latency buckets in seconds, from a cached embedding to a slow LLM answer
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+def _format_labels(names, values, extra=""):
+    parts = [f'{name}="{value}"' for name, value in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+def _format_value(value):
+    return repr(float(value)) if value != int(value) else str(int(value))
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def _key(self, labels):
+        return tuple(str(labels[name]) for name in self.labels)
+
+    def header(self):
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+
+    def render(self):
+        lines = self.header()
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_format_labels(self.labels, key)} {_format_value(value)}")
+        return lines
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts, total = self._values.get(key, ([0] * (len(self.buckets) + 1), 0.0))
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            self._values[key] = (counts, total + value)
+
+    def render(self):
+        lines = self.header()
+        with self._lock:
+            for key, (counts, total) in sorted(self._values.items()):
+                cumulative = 0
+                for bound, count in zip(self.buckets + (float("inf"),), counts):
+                    cumulative += count
+                    le = 'le="+Inf"' if bound == float("inf") else f'le="{bound!r}"'
+                    lines.append(f"{self.name}_bucket{_format_labels(self.labels, key, le)} {cumulative}")
+                lines.append(f"{self.name}_sum{_format_labels(self.labels, key)} {total!r}")
+                lines.append(f"{self.name}_count{_format_labels(self.labels, key)} {cumulative}")
+        return lines
+
+
+REGISTRY = []
+# Callables returning extra exposition lines at scrape time (e.g. cache statistics)
+COLLECTORS = []
+
+STAGE_SECONDS = Histogram("rag_stage_seconds", "Time spent per pipeline stage.", labels=("stage",))
+IN_FLIGHT = Gauge("rag_stage_in_flight", "Pipeline stages currently running.", labels=("stage",))
+LLM_TOKENS = Counter("rag_llm_tokens_total", "Tokens reported in the usage field of Groq responses.", labels=("type",))
+
+# The request traces that stage() adds its timings to. A request sets one; the
+# QueryBatcher sets all traces of the requests it serves with one encode + search.
+_traces = contextvars.ContextVar("traces", default=())
+
+
+def start_trace():
+    """Starts a per-request {stage: seconds} breakdown in the current context and returns it."""
+    trace = {}
+    _traces.set((trace,))
+    return trace
+
+
+def current_traces():
+    return _traces.get()
+
+
+@contextmanager
+def tracing(traces):
+    token = _traces.set(tuple(traces))
+    try:
+        yield
+    finally:
+        _traces.reset(token)
+
+
+@contextmanager
+def stage(name):
+    """Times a block into STAGE_SECONDS, IN_FLIGHT and the active request traces."""
+    IN_FLIGHT.inc(stage=name)
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        IN_FLIGHT.dec(stage=name)
+        observe(name, time.perf_counter() - start)
+
+
+def timed(name):
+    """Decorator form of stage()."""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with stage(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def observe(name, seconds):
+    """Records a stage duration measured by the caller."""
+    STAGE_SECONDS.observe(seconds, stage=name)
+    for trace in _traces.get():
+        trace[name] = trace.get(name, 0.0) + seconds
+
+
+def record_usage(usage):
+    """Counts prompt/completion tokens from a Groq usage object (ignored when missing)."""
+    if usage is None:
+        return
+    for kind in ("prompt_tokens", "completion_tokens"):
+        value = getattr(usage, kind, None)
+        if value:
+            LLM_TOKENS.inc(value, type=kind.replace("_tokens", ""))
+
+
+def gauge_lines(name, help, samples, label="kind"):
+    """Exposition lines for a gauge computed at scrape time; samples maps label value -> number."""
+    lines = [f"# HELP {name} {help}", f"# TYPE {name} gauge"]
+    for value, number in samples.items():
+        lines.append(f'{name}{{{label}="{value}"}} {_format_value(number)}')
+    return lines
+
+
+def render():
+    """All metrics in the Prometheus text exposition format."""
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    for collect in COLLECTORS:
+        lines.extend(collect())
+    return "\n".join(lines) + "\n"
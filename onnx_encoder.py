@@ -0,0 +1,156 @@
+"""
+ONNX Runtime backend for the query encoder (RAG_ENCODER_BACKEND=onnx or onnx-int8 in rag.py).
+
+    python onnx_encoder.py export                # exports EMBEDDING_MODEL_NAME to RAG_ONNX_DIR, plus an int8 copy
+    python onnx_encoder.py export --no-quantize
+
+Encoding needs only onnxruntime, tokenizers and numpy, so processes using this backend
+never import torch. Exporting loads the sentence-transformers model once, with torch.
+"""
+import os
+import json
+import argparse
+import numpy as np
+
+EMBEDDING_MODEL_NAME = 'all-MiniLM-L6-v2'
+ONNX_DIR = os.getenv("RAG_ONNX_DIR", os.path.join("models", EMBEDDING_MODEL_NAME + "-onnx"))
+# Threads per inference session (0 lets onnxruntime use all cores)
+ONNX_THREADS = int(os.getenv("RAG_ONNX_THREADS", "0"))
+ENCODE_BATCH_SIZE = 32
+
+# Names inside ONNX_DIR
+MODEL_FILE = "model.onnx"
+QUANTIZED_MODEL_FILE = "model_int8.onnx"
+TOKENIZER_FILE = "tokenizer.json"
+CONFIG_FILE = "encoder.json"
+
+
+class OnnxEncoder:
+    """
+    Drop-in for SentenceTransformer.encode on exported models: runs the transformer
+    with onnxruntime, then applies the same mean pooling (and normalization) in numpy.
+    quantized: use the int8 copy written by export().
+    """
+    def __init__(self, directory=None, quantized=False, threads=None):
+        import onnxruntime
+        from tokenizers import Tokenizer
+        directory = directory or ONNX_DIR
+        with open(os.path.join(directory, CONFIG_FILE)) as f:
+            self.config = json.load(f)
+        self.tokenizer = Tokenizer.from_file(os.path.join(directory, TOKENIZER_FILE))
+        self.tokenizer.enable_truncation(self.config["max_seq_length"])
+        self.tokenizer.enable_padding(pad_id=self.config["pad_token_id"], pad_token=self.config["pad_token"])
+
+        options = onnxruntime.SessionOptions()
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        threads = ONNX_THREADS if threads is None else threads
+        if threads:
+            options.intra_op_num_threads = threads
+        path = os.path.join(directory, QUANTIZED_MODEL_FILE if quantized else MODEL_FILE)
+        self.session = onnxruntime.InferenceSession(path, options, providers=["CPUExecutionProvider"])
+        self.input_names = {i.name for i in self.session.get_inputs()}
+
+    def get_sentence_embedding_dimension(self):
+        return self.config["dimension"]
+
+    def encode(self, texts, batch_size=ENCODE_BATCH_SIZE, **kwargs):
+        single = isinstance(texts, str)
+        texts = [texts] if single else list(texts)
+        embeddings = np.zeros((len(texts), self.config["dimension"]), dtype=np.float32)
+        # Texts of similar length share a batch, so less padding is computed
+        order = np.argsort([-len(text) for text in texts], kind="stable")
+        for start in range(0, len(texts), batch_size):
+            rows = order[start:start + batch_size]
+            encodings = self.tokenizer.encode_batch([texts[i] for i in rows])
+            mask = np.array([e.attention_mask for e in encodings], dtype=np.int64)
+            feeds = {"input_ids": np.array([e.ids for e in encodings], dtype=np.int64), "attention_mask": mask}
+            if "token_type_ids" in self.input_names:
+                feeds["token_type_ids"] = np.array([e.type_ids for e in encodings], dtype=np.int64)
+            hidden = self.session.run(None, feeds)[0]
+            weights = mask[:, :, None].astype(np.float32)
+            pooled = (hidden * weights).sum(axis=1) / np.clip(weights.sum(axis=1), 1e-9, None)
+            if self.config["normalize"]:
+                pooled /= np.clip(np.linalg.norm(pooled, axis=1, keepdims=True), 1e-12, None)
+            embeddings[rows] = pooled
+        return embeddings[0] if single else embeddings
+
+
+def export(model_name=EMBEDDING_MODEL_NAME, directory=None, quantize=True, opset=17):
+    """
+    Writes the transformer of a sentence-transformers model as ONNX, its tokenizer,
+    and the pooling settings to directory; with quantize, also an int8 copy with
+    dynamically quantized weights. Only Transformer + mean Pooling (+ Normalize) models are supported.
+    """
+    import torch
+    from sentence_transformers import SentenceTransformer
+    directory = directory or ONNX_DIR
+    model = SentenceTransformer(model_name, device="cpu")
+    transformer, modules = model[0], [type(module).__name__ for module in list(model)[1:]]
+    pooling_mode = getattr(model[1], "pooling_mode", None) if len(model) > 1 else None
+    if modules not in (["Pooling"], ["Pooling", "Normalize"]) or pooling_mode not in ("mean", ("mean",), ["mean"]):
+        raise ValueError(f"{model_name} is not a Transformer + mean Pooling model ({', '.join(modules)})")
+
+    os.makedirs(directory, exist_ok=True)
+    tokenizer = transformer.tokenizer
+    tokenizer.backend_tokenizer.save(os.path.join(directory, TOKENIZER_FILE))
+    with open(os.path.join(directory, CONFIG_FILE), "w") as f:
+        json.dump({
+            "model": model_name,
+            "dimension": model.get_sentence_embedding_dimension(),
+            "max_seq_length": transformer.max_seq_length,
+            "normalize": "Normalize" in modules,
+            "pad_token": tokenizer.pad_token,
+            "pad_token_id": tokenizer.pad_token_id
+        }, f, indent=2)
+
+    sample = tokenizer(["warm-up query", "a longer warm-up query"], padding=True, return_tensors="pt")
+    input_names = [name for name in ("input_ids", "attention_mask", "token_type_ids") if name in sample]
+
+    class LastHiddenState(torch.nn.Module):
+        def __init__(self, auto_model):
+            super().__init__()
+            self.auto_model = auto_model
+
+        def forward(self, *inputs):
+            return self.auto_model(**dict(zip(input_names, inputs))).last_hidden_state
+
+    path = os.path.join(directory, MODEL_FILE)
+    dynamic_axes = {name: {0: "batch", 1: "sequence"} for name in input_names + ["last_hidden_state"]}
+    with torch.no_grad():
+        torch.onnx.export(
+            LastHiddenState(transformer.auto_model.eval()), tuple(sample[name] for name in input_names), path,
+            input_names=input_names, output_names=["last_hidden_state"], dynamic_axes=dynamic_axes,
+            opset_version=opset, dynamo=False
+        )
+    print(f"Exported {model_name} to {path}")
+
+    if quantize:
+        from onnxruntime.quantization import quantize_dynamic, QuantType
+        quantized_path = os.path.join(directory, QUANTIZED_MODEL_FILE)
+        quantize_dynamic(path, quantized_path, weight_type=QuantType.QInt8)
+        print(f"Wrote int8 model to {quantized_path}")
+
+    # The ONNX embeddings must land next to the torch ones in the existing index
+    texts = ["What is the stall speed in landing configuration?", "Engine failure during takeoff run"]
+    expected = model.encode(texts)
+    for quantized in ([False, True] if quantize else [False]):
+        embeddings = OnnxEncoder(directory, quantized=quantized).encode(texts)
+        print(f"{'int8' if quantized else 'fp32'} cosine similarity to torch: {cosine_parity(expected, embeddings):.5f}")
+
+
+def cosine_parity(expected, embeddings):
+    """Lowest cosine similarity between matching rows of two embedding matrices."""
+    expected, embeddings = np.asarray(expected, dtype=np.float32), np.asarray(embeddings, dtype=np.float32)
+    dots = (expected * embeddings).sum(axis=1)
+    return float((dots / (np.linalg.norm(expected, axis=1) * np.linalg.norm(embeddings, axis=1))).min())
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = parser.add_subparsers(dest="command", required=True)
+    export_parser = sub.add_parser("export", help="export the embedding model to ONNX (and int8)")
+    export_parser.add_argument("--model", default=EMBEDDING_MODEL_NAME)
+    export_parser.add_argument("--dir", default=None, help=f"output directory (default {ONNX_DIR})")
+    export_parser.add_argument("--no-quantize", action="store_true", help="skip the int8 copy")
+    args = parser.parse_args()
+    export(args.model, args.dir, not args.no_quantize)
@@ -1,64 +1,662 @@
 import faiss
-import pickle
 import numpy as np
-from sentence_transformers import SentenceTransformer
 import os
+import json
+import atexit
+import queue
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import Future
+from contextlib import contextmanager
+from chunk_store import ChunkStore, ids_in_ranges
+import index_versions
+from index_versions import INDEX_FILE, CHUNK_STORE_DIR, LEXICAL_INDEX_DIR, MANIFEST_FILE
+import shards
+from shards import ShardedIndex, is_quantized, is_approximate, exact_search
+from cache import EmbeddingCache
+import metrics
+import rerank
+from lexical import LexicalIndex, reciprocal_rank_fusion
 
 
 EMBEDDING_MODEL_NAME = 'all-MiniLM-L6-v2'
-INDEX_FILE = "faiss_index.bin"
-CHUNKS_FILE = "chunks.pkl"
+# Query encoder: "torch" (sentence-transformers), or "onnx" / "onnx-int8" (onnxruntime on a
+# model exported with `python onnx_encoder.py export`; no torch in the process)
+ENCODER_BACKENDS = ("torch", "onnx", "onnx-int8")
+ENCODER_BACKEND = os.getenv("RAG_ENCODER_BACKEND", "torch")
+# How often retrieve() looks for a newly published index version (0 disables; reload() still works)
+RELOAD_CHECK_SECONDS = float(os.getenv("RAG_RELOAD_CHECK_SECONDS", "5"))
+# Chunks retrieved per question (the most, with adaptive k)
+TOP_K = int(os.getenv("RAG_TOP_K", "5"))
+# Adaptive k: search RAG_ADAPTIVE_CANDIDATES hits, drop those with a distance above
+# RAG_SCORE_THRESHOLD (squared L2; MiniLM vectors have unit length, so 1.5 means cosine
+# similarity above 0.25), and cut the rest at the first jump of RAG_ELBOW_MIN_GAP between
+# consecutive distances. Questions left with no chunk are refused without an LLM call.
+ADAPTIVE_K = os.getenv("RAG_ADAPTIVE_K", "0") == "1"
+ADAPTIVE_CANDIDATES = int(os.getenv("RAG_ADAPTIVE_CANDIDATES", "20"))
+SCORE_THRESHOLD = float(os.getenv("RAG_SCORE_THRESHOLD", "1.5"))
+ELBOW_MIN_GAP = float(os.getenv("RAG_ELBOW_MIN_GAP", "0.15"))
+# Rerank stage: the top RAG_RERANK_CANDIDATES first-stage hits are re-scored with a
+# cross-encoder (see rerank.py) and the best k are kept
+RERANK = os.getenv("RAG_RERANK", "0") == "1"
+RERANK_CANDIDATES = int(os.getenv("RAG_RERANK_CANDIDATES", "20"))
+# Sharded indexes (INDEX_SHARDS in ingest.py): search each shard in its own worker process
+# instead of on a thread of this one, with RAG_SHARD_THREADS OpenMP threads each (0 splits the cores)
+SHARD_PROCESSES = os.getenv("RAG_SHARD_PROCESSES", "0") == "1"
+SHARD_THREADS = int(os.getenv("RAG_SHARD_THREADS", "0"))
+# Query-time defaults for approximate indexes (see INDEX_TYPE in ingest.py)
+DEFAULT_NPROBE = int(os.getenv("RAG_NPROBE", "16"))
+DEFAULT_EF_SEARCH = int(os.getenv("RAG_EF_SEARCH", "64"))
+# Concurrent queries arriving within this window are embedded and searched together (0 disables)
+BATCH_WINDOW_MS = float(os.getenv("RAG_BATCH_WINDOW_MS", "2"))
+BATCH_MAX_SIZE = int(os.getenv("RAG_BATCH_MAX_SIZE", "32"))
+# "vector" (FAISS only) or "hybrid" (FAISS + BM25, fused with reciprocal rank fusion)
+RETRIEVAL_MODE = os.getenv("RAG_RETRIEVAL_MODE", "vector")
+# Each side of a hybrid search contributes at least this many candidates to the fusion
+HYBRID_CANDIDATES = int(os.getenv("RAG_HYBRID_CANDIDATES", "20"))
+# Query embeddings are cached in memory (0 disables) and, if a file is given, kept across restarts
+EMBEDDING_CACHE_SIZE = int(os.getenv("RAG_EMBEDDING_CACHE_SIZE", "10000"))
+EMBEDDING_CACHE_FILE = os.getenv("RAG_EMBEDDING_CACHE_FILE", "")
+# Quantized indexes (sq8, fp16, pq, ivfpq) fetch this many times more candidates and re-rank
+# them by exact L2 distance to the float vectors in the chunk store (0 disables)
+RESCORE_FACTOR = int(os.getenv("RAG_RESCORE_FACTOR", "4"))
+# Filtered retrieval (sources / page_range): up to this many matching chunks are compared
+# exactly with their vectors from the chunk store; larger subsets are searched in the index
+# with an ID selector, which skips the distance computation for everything else.
+# On IVF and HNSW indexes the selector costs recall: the probed lists and the graph walk are
+# the unfiltered ones, so a selective filter leaves few matching candidates in them
+# (python benchmark.py filter: 0.22 recall@5 for HNSW and 0.90 for IVF at 2% of the corpus).
+# shards.search_params widens nprobe / efSearch for filtered calls (up to
+# RAG_FILTER_SEARCH_BOOST_MAX times), which recovers IVF but not HNSW, so on these indexes
+# subsets of up to this fraction of the corpus are also compared exactly
+FILTER_EXACT_MAX = int(os.getenv("RAG_FILTER_EXACT_MAX", "20000"))
+FILTER_EXACT_FRACTION = float(os.getenv("RAG_FILTER_EXACT_FRACTION", "0.05"))
+
+def load_model(backend=None):
+    backend = backend or ENCODER_BACKEND
+    if backend == "torch":
+        # torch comes in with sentence_transformers; import it only when a model is needed
+        from sentence_transformers import SentenceTransformer
+        return SentenceTransformer(EMBEDDING_MODEL_NAME)
+    if backend in ("onnx", "onnx-int8"):
+        from onnx_encoder import OnnxEncoder
+        return OnnxEncoder(quantized=backend == "onnx-int8")
+    raise ValueError(f"Unknown RAG_ENCODER_BACKEND '{backend}', expected one of {', '.join(ENCODER_BACKENDS)}")
+
+
+def embedding_cache_key(backend=None):
+    """Cache namespace of the query embeddings; int8 vectors differ slightly from the others."""
+    backend = backend or ENCODER_BACKEND
+    return EMBEDDING_MODEL_NAME + "/int8" if backend == "onnx-int8" else EMBEDDING_MODEL_NAME
+
+
+def rescore(queries, candidate_ids, vectors_of, k):
+    """
+    Re-ranks each row of candidate ids by exact L2 distance between the query and
+    vectors_of(ids), keeping the best k. Returns (distances, ids) shaped like index.search.
+    """
+    distances = np.full((len(queries), k), np.finfo(np.float32).max, dtype=np.float32)
+    ids = np.full((len(queries), k), -1, dtype=np.int64)
+    for row, (query, candidates) in enumerate(zip(queries, candidate_ids)):
+        candidates = candidates[candidates != -1]
+        if not len(candidates):
+            continue
+        exact = ((vectors_of(candidates) - query) ** 2).sum(axis=1)
+        top = np.argsort(exact, kind="stable")[:k]
+        distances[row, :len(top)] = exact[top]
+        ids[row, :len(top)] = candidates[top]
+    return distances, ids
+
+
+def select_hits(hits, k, score_threshold=None, min_gap=None):
+    """
+    Adaptive k: keeps the hits within score_threshold, cuts them at the first gap of at
+    least min_gap between consecutive distances (the elbow), and returns at most k,
+    in their original order. May return nothing.
+    """
+    threshold = SCORE_THRESHOLD if score_threshold is None else score_threshold
+    min_gap = ELBOW_MIN_GAP if min_gap is None else min_gap
+    passing = [hit for hit in hits if hit["score"] <= threshold]
+    distances = sorted(hit["score"] for hit in passing)
+    cutoff = threshold
+    for closer, further in zip(distances, distances[1:]):
+        if further - closer >= min_gap:
+            cutoff = closer
+            break
+    return [hit for hit in passing if hit["score"] <= cutoff][:k]
+
+
+# Everything that belongs to one index version. Replaced as a whole on reload, so a
+# query that picked up one state uses a consistent index and chunk store throughout.
+IndexState = namedtuple("IndexState", ["index", "chunks", "lexical", "version"])
+
+
+def load_index_state(version=None):
+    """Loads an index version (the current one by default), or returns None."""
+    version = version or index_versions.current_version()
+    directory = index_versions.version_dir(version) if version else index_versions.current_dir()
+    if directory is None:
+        return None
+    index_files = index_versions.index_files(directory)
+    store_dir = os.path.join(directory, CHUNK_STORE_DIR)
+    lexical_dir = os.path.join(directory, LEXICAL_INDEX_DIR)
+    if not index_files or not ChunkStore.exists(store_dir):
+        return None
+    if os.path.basename(index_files[0]) == INDEX_FILE:
+        index = faiss.read_index(index_files[0])
+    else:
+        # Searched shard by shard in parallel; see shards.py
+        numbers = [number for number, _ in index_versions.shard_files(directory)]
+        index = shards.open_shards(index_files, SHARD_PROCESSES, SHARD_THREADS, numbers, index_versions.shard_count(directory))
+    # Memory-mapped: texts are only read for the hits we return
+    chunks = ChunkStore(store_dir)
+    lexical = None
+    if LexicalIndex.exists(lexical_dir):
+        lexical = LexicalIndex(lexical_dir)
+    else:
+        print("No lexical index found; hybrid retrieval falls back to vector search.")
+    return IndexState(index, chunks, lexical, version or read_index_version(directory))
+
+
+def close_index_state(state):
+    """Releases what load_index_state opened: shard threads and processes, and the chunk texts mapping."""
+    if isinstance(state.index, ShardedIndex):
+        state.index.close()
+    state.chunks.close()
+
 
 class RAGSystem:
     def __init__(self):
-        self.index = None
-        self.chunks = None
+        self.state = None
         self.model = None
+        # Set once the model has encoded something, see warm_up()
+        self.warmed = False
+        # retrieve() runs on several API threads; load only once
+        self._load_lock = threading.Lock()
+        # Serializes reloads; readers never take it
+        self._reload_lock = threading.Lock()
+        # Queries using each state, and replaced states waiting for theirs to finish (by id)
+        self._state_lock = threading.Lock()
+        self._state_users = {}
+        self._retired_states = {}
+        self._next_reload_check = 0.0
+        self.batcher = QueryBatcher(self) if BATCH_WINDOW_MS > 0 else None
+        self.embedding_cache = EmbeddingCache(EMBEDDING_CACHE_SIZE, EMBEDDING_CACHE_FILE or None)
+        self.reranker = rerank.reranker
         # self.load_resources() 
 
+    # Views of the current state
+    @property
+    def index(self):
+        return self.state.index if self.state else None
+
+    @property
+    def chunks(self):
+        return self.state.chunks if self.state else None
+
+    @property
+    def lexical(self):
+        return self.state.lexical if self.state else None
+
+    @property
+    def version(self):
+        # Changes whenever ingestion publishes a new index; used to invalidate caches
+        return self.state.version if self.state else None
+
     def load_resources(self):
-        if os.path.exists(INDEX_FILE) and os.path.exists(CHUNKS_FILE):
-            print("Loading FAISS index and chunks...")
-            self.index = faiss.read_index(INDEX_FILE)
-            with open(CHUNKS_FILE, "rb") as f:
-                self.chunks = pickle.load(f)
-            print("Loading embedding model...")
-            self.model = SentenceTransformer(EMBEDDING_MODEL_NAME)
+        state = load_index_state()
+        if state is not None:
+            print(f"Loaded FAISS index and chunks (version {state.version}).")
+            self.state = state
+            if self.model is None:
+                print(f"Loading embedding model ({ENCODER_BACKEND})...")
+                self.model = load_model()
         else:
             print("Index or chunks not found. Please run ingestion first.")
 
-    def retrieve(self, query, k=5, score_threshold=1.5):
+    def reload(self):
         """
-        Retrieves top k chunks.
-        score_threshold: FAISS uses L2 distance (lower is better).
-        If distance is too high, it might be irrelevant.
+        Switches to the current index version if it changed. The new version is
+        loaded on the side and swapped in with one assignment; queries already
+        running keep the state they started with.
+        Returns True if a new version was loaded.
         """
-        if not self.index or not self.model:
-            self.load_resources()
-            if not self.index:
-                return []
+        with self._reload_lock:
+            version = index_versions.current_version()
+            if version is None or version == self.version:
+                return False
+            state = load_index_state(version)
+            if state is None:
+                return False
+            with self._state_lock:
+                old, self.state = self.state, state
+                # The old state is closed by the last query still using it, or right away
+                in_use = old is not None and self._state_users.get(id(old))
+                if in_use:
+                    self._retired_states[id(old)] = old
+            if old is not None and not in_use:
+                close_index_state(old)
+            print(f"Switched to index version {state.version}.")
+            return True
+
+    @contextmanager
+    def using_state(self):
+        """The current state, kept open until the block exits even if a reload replaces it meanwhile."""
+        with self._state_lock:
+            state = self.state
+            if state is not None:
+                self._state_users[id(state)] = self._state_users.get(id(state), 0) + 1
+        try:
+            yield state
+        finally:
+            if state is not None:
+                with self._state_lock:
+                    self._state_users[id(state)] -= 1
+                    retired = None
+                    if not self._state_users[id(state)]:
+                        del self._state_users[id(state)]
+                        retired = self._retired_states.pop(id(state), None)
+                if retired is not None:
+                    close_index_state(retired)
 
-        query_embedding = self.model.encode([query])
-        D, I = self.index.search(query_embedding, k)
-        
+    def check_for_update(self):
+        """Cheap, rate-limited check for a newly published version; reloads if there is one."""
+        if RELOAD_CHECK_SECONDS <= 0 or time.monotonic() < self._next_reload_check:
+            return
+        self._next_reload_check = time.monotonic() + RELOAD_CHECK_SECONDS
+        version = index_versions.current_version()
+        if version is not None and version != self.version and not self._reload_lock.locked():
+            try:
+                self.reload()
+            except Exception as e:
+                print(f"Could not load index version {version}: {e}")
+
+    def search_params(self, nprobe=None, ef_search=None, index=None):
+        """
+        Builds per-call faiss search parameters for IVF (nprobe) and HNSW (efSearch) indexes.
+        Returns None for exact indexes.
+        """
+        return shards.search_params(index if index is not None else self.index, nprobe or DEFAULT_NPROBE, ef_search or DEFAULT_EF_SEARCH)
+
+    def search(self, index, queries, k, nprobe=None, ef_search=None, ranges=None, sources=None):
+        """
+        index.search with the query-time knobs; a ShardedIndex builds its parameters per shard.
+        ranges: [first, end) id ranges to restrict the search to; sources lets a ShardedIndex
+        skip the shards that cannot hold them.
+        """
+        nprobe, ef_search = nprobe or DEFAULT_NPROBE, ef_search or DEFAULT_EF_SEARCH
+        if isinstance(index, ShardedIndex):
+            return index.search(queries, k, nprobe, ef_search, ranges, sources)
+        return shards.search_index(index, queries, k, nprobe, ef_search, ranges)
+
+    def warm_up(self):
+        """
+        Loads the index and model, then runs one dummy encode and search so the
+        first real query does not pay for lazy initialization.
+        Returns the seconds spent per step, or None if there is no index yet.
+        """
+        timings = {}
+        start = time.perf_counter()
+        if not self.ensure_loaded():
+            return None
+        timings["load"] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        embedding = np.asarray(self.model.encode(["warm-up query"]), dtype=np.float32)
+        timings["encode"] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        with self.using_state() as state:
+            self.search(state.index, embedding, 1)
+        timings["search"] = time.perf_counter() - start
+
+        if RERANK:
+            start = time.perf_counter()
+            self.reranker.ensure_loaded().predict([("warm-up query", "warm-up chunk")], show_progress_bar=False)
+            timings["rerank"] = time.perf_counter() - start
+        self.warmed = True
+        return timings
+
+    def ensure_loaded(self):
+        if self.state is None or self.model is None:
+            with self._load_lock:
+                if self.state is None or self.model is None:
+                    self.load_resources()
+        else:
+            self.check_for_update()
+        return self.state is not None and self.model is not None
+
+    def embed(self, texts):
+        """Embeds texts as a float32 matrix, or returns None if no index is available."""
+        if not self.ensure_loaded():
+            return None
+        texts = list(texts)
+        cache_key = embedding_cache_key()
+        cached = self.embedding_cache.get_many(cache_key, texts)
+        missing = [i for i, vector in enumerate(cached) if vector is None]
+        if missing:
+            # Duplicates within one batch are encoded once
+            unique = list(dict.fromkeys(texts[i] for i in missing))
+            start = time.perf_counter()
+            with metrics.stage("encode"):
+                encoded = np.asarray(self.model.encode(unique), dtype=np.float32)
+            self.warmed = True
+            self.embedding_cache.put_many(cache_key, unique, encoded, time.perf_counter() - start)
+            by_text = dict(zip(unique, encoded))
+            for i in missing:
+                cached[i] = by_text[texts[i]]
+        return np.stack(cached) if cached else np.zeros((0, self.model.get_sentence_embedding_dimension()), dtype=np.float32)
+
+    def embed_query(self, query):
+        """Embedding of one query, or None without an index; coalesced with concurrent calls by the batcher."""
+        future = self.submit_embed_query(query)
+        if future is not None:
+            return future.result()
+        embeddings = self.embed([query])
+        return None if embeddings is None else embeddings[0]
+
+    def submit_embed_query(self, query):
+        """embed_query as a Future, for callers that must not block a thread while it is batched; None without a batcher."""
+        return self.batcher.embed(query) if self.batcher is not None else None
+
+    def submit_retrieve(self, query, k=None, score_threshold=None, nprobe=None, ef_search=None, query_embedding=None, mode=None, adaptive=None, rerank=None, sources=None, page_range=None):
+        """
+        retrieve() for callers that must not block a thread while the query waits in the
+        batcher (e.g. awaited with asyncio.wrap_future). Returns (future of the first-stage
+        hits, finish), where finish(hits) runs adaptive k and reranking and is None when
+        neither applies; or None without a batcher, in which case call retrieve().
+        """
+        if self.batcher is None:
+            return None
+        k = k or TOP_K
+        adaptive = ADAPTIVE_K if adaptive is None else adaptive
+        rerank = RERANK if rerank is None else rerank
+        # Hashable, so the batcher can group queries with the same filters
+        sources = tuple(sorted(set(sources))) if sources is not None else None
+        page_range = tuple(page_range) if page_range is not None else None
+        if query_embedding is not None:
+            query_embedding = np.asarray(query_embedding, dtype=np.float32).reshape(-1)
+        future = self.batcher.submit(query, self._first_stage_size(k, adaptive, rerank), nprobe, ef_search, mode, sources, page_range, query_embedding)
+        finish = None
+        if adaptive or rerank:
+            finish = lambda hits: self._second_stage(query, hits, k, score_threshold, adaptive, rerank)
+        return future, finish
+
+    def retrieve(self, query, k=None, score_threshold=None, nprobe=None, ef_search=None, query_embedding=None, mode=None, adaptive=None, rerank=None, sources=None, page_range=None):
+        """
+        Retrieves top k chunks (RAG_TOP_K by default).
+        adaptive: choose k per query with select_hits (defaults to RAG_ADAPTIVE_K); k is then the maximum.
+        rerank: reorder the top RAG_RERANK_CANDIDATES with the cross-encoder before
+        keeping k (defaults to RAG_RERANK).
+        score_threshold: FAISS uses L2 distance (lower is better); with adaptive k,
+        hits above it are dropped (defaults to RAG_SCORE_THRESHOLD).
+        nprobe / ef_search: recall vs latency knobs for IVF / HNSW indexes.
+        Concurrent calls are coalesced by the QueryBatcher when batching is enabled.
+        query_embedding: reuse an embedding the caller already computed.
+        mode: "vector" or "hybrid", defaults to RAG_RETRIEVAL_MODE.
+        sources / page_range: only search chunks from these documents (file names) and/or
+        pages (first, last; inclusive), using the chunk store's id ranges.
+        """
+        if not self.ensure_loaded():
+            return []
+        submitted = self.submit_retrieve(query, k, score_threshold, nprobe, ef_search, query_embedding, mode, adaptive, rerank, sources, page_range)
+        if submitted is not None:
+            future, finish = submitted
+            hits = future.result()
+            return hits if finish is None else finish(hits)
+        k = k or TOP_K
+        adaptive = ADAPTIVE_K if adaptive is None else adaptive
+        rerank = RERANK if rerank is None else rerank
+        embeddings = None if query_embedding is None else np.asarray(query_embedding, dtype=np.float32).reshape(1, -1)
+        hits = self.retrieve_batch([query], self._first_stage_size(k, adaptive, rerank), nprobe=nprobe, ef_search=ef_search, embeddings=embeddings, mode=mode, adaptive=False, rerank=False, sources=sources, page_range=page_range)[0]
+        return self._second_stage(query, hits, k, score_threshold, adaptive, rerank)
+
+    def retrieve_batch(self, queries, k=None, nprobe=None, ef_search=None, embeddings=None, mode=None, score_threshold=None, adaptive=None, rerank=None, sources=None, page_range=None):
+        """
+        Retrieves top k chunks for each query, embedding all queries in one
+        encode call (unless embeddings are given) and searching them as one matrix.
+        adaptive, rerank, score_threshold, sources and page_range work as in retrieve().
+        """
+        if not self.ensure_loaded():
+            return [[] for _ in queries]
+        k = k or TOP_K
+        adaptive = ADAPTIVE_K if adaptive is None else adaptive
+        rerank = RERANK if rerank is None else rerank
+        if adaptive or rerank:
+            n_hits = self._first_stage_size(k, adaptive, rerank)
+            results = self.retrieve_batch(queries, n_hits, nprobe, ef_search, embeddings, mode, adaptive=False, rerank=False, sources=sources, page_range=page_range)
+            return [self._second_stage(query, hits, k, score_threshold, adaptive, rerank) for query, hits in zip(queries, results)]
+
+        # One state for the whole call: a concurrent reload neither affects it nor closes it under us
+        with self.using_state() as state:
+            return self._search_batch(state, queries, k, nprobe, ef_search, embeddings, mode, sources, page_range)
+
+    def _search_batch(self, state, queries, k, nprobe, ef_search, embeddings, mode, sources, page_range):
+        chunks = state.chunks
+        ranges = None
+        if sources is not None or page_range is not None:
+            ranges = chunks.id_ranges(sources, page_range)
+            if not len(ranges):
+                return [[] for _ in queries]
+        hybrid = (mode or RETRIEVAL_MODE) == "hybrid" and state.lexical is not None
+        query_embeddings = embeddings if embeddings is not None else self.embed(queries)
+        n_candidates = max(k, HYBRID_CANDIDATES) if hybrid else k
+        if ranges is not None and chunks.vectors is not None and self._filter_is_exact(state.index, ranges):
+            # Few enough chunks to compare the queries with each of them, without the index
+            ids = ids_in_ranges(ranges)
+            with metrics.stage("search"):
+                D, I = exact_search(query_embeddings, chunks.vectors[chunks.rows_of(ids)], ids, n_candidates)
+        else:
+            rescoring = RESCORE_FACTOR > 0 and chunks.vectors is not None and is_quantized(state.index)
+            n_search = n_candidates * RESCORE_FACTOR if rescoring else n_candidates
+            with metrics.stage("search"):
+                D, I = self.search(state.index, query_embeddings, n_search, nprobe, ef_search, ranges, sources)
+            if rescoring:
+                with metrics.stage("rescore"):
+                    D, I = rescore(query_embeddings, I, lambda ids: chunks.vectors[chunks.rows_of(ids)], n_candidates)
+        if not hybrid:
+            return [self._hits(state, D[row], I[row]) for row in range(len(queries))]
+        return [self._fused_hits(state, query, D[row], I[row], k, ranges) for row, query in enumerate(queries)]
+
+    @staticmethod
+    def _filter_is_exact(index, ranges):
+        """True if the chunks in ranges are few enough to compare exactly instead of searching the index."""
+        matched = (ranges[:, 1] - ranges[:, 0]).sum()
+        return matched <= FILTER_EXACT_MAX or (is_approximate(index) and matched <= FILTER_EXACT_FRACTION * index.ntotal)
+
+    @staticmethod
+    def _first_stage_size(k, adaptive, rerank):
+        n_hits = max(k, RERANK_CANDIDATES) if rerank else k
+        return max(n_hits, ADAPTIVE_CANDIDATES) if adaptive else n_hits
+
+    def _second_stage(self, query, hits, k, score_threshold, adaptive, rerank):
+        """Adaptive k selection and/or cross-encoder reranking of first-stage hits, down to at most k."""
+        if adaptive:
+            hits = select_hits(hits, max(k, RERANK_CANDIDATES) if rerank else k, score_threshold)
+        if rerank:
+            hits = self.reranker.rerank(query, hits, k)
+        return hits
+
+    def _fused_hits(self, state, query, distances, ids, k, ranges=None):
+        """
+        Fuses the vector candidates with the BM25 ranking of the same query.
+        Each hit keeps its L2 distance as score; chunks found only by BM25 get the
+        largest candidate distance, a lower bound on their real distance.
+        """
+        with metrics.stage("lexical"):
+            _, lexical_ids = state.lexical.search(query, len(ids), ranges)
+        _, fused_ids = reciprocal_rank_fusion([ids, lexical_ids], k)
+        found = ids != -1
+        distance_of = dict(zip(ids[found].tolist(), distances[found].tolist()))
+        floor = float(distances[found].max()) if found.any() else 0.0
+        fused_distances = np.array([distance_of.get(int(i), floor) for i in fused_ids], dtype=np.float32)
+        return self._hits(state, fused_distances, fused_ids)
+
+    def _hits(self, state, distances, ids):
         results = []
-        for i, idx in enumerate(I[0]):
+        for distance, idx in zip(distances, ids):
             if idx != -1: # FAISS returns -1 if not found
-                distance = D[0][i]
-                
-                
-                chunk = self.chunks[idx].copy()
+                chunk = state.chunks.get(idx)
+                if chunk is None:
+                    continue
                 chunk['score'] = float(distance)
                 chunk['id'] = int(idx)
                 results.append(chunk)
 
         return results
 
+
+def read_index_version(directory="."):
+    """Version of an unversioned index: from its manifest, or the index mtime for older ones."""
+    try:
+        with open(os.path.join(directory, MANIFEST_FILE)) as f:
+            version = json.load(f).get("version")
+        if version:
+            return version
+    except (OSError, ValueError):
+        pass
+    index_file = os.path.join(directory, INDEX_FILE)
+    return str(os.path.getmtime(index_file)) if os.path.exists(index_file) else None
+
+
+# One queued request. k is None for an embed-only request; params are
+# (nprobe, ef_search, mode, sources, page_range); embedding is the caller's, if it has one.
+BatchItem = namedtuple("BatchItem", ["query", "k", "params", "embedding", "traces", "future"])
+
+
+class QueryBatcher:
+    """
+    Request coalescer in front of RAGSystem.retrieve and embed_query.
+    Queries that arrive within window_ms of each other (up to max_batch) are
+    embedded with one encode call and searched with one multi-row index.search
+    on a background thread; each caller then gets its own rows back.
+    """
+    def __init__(self, rag, max_batch=None, window_ms=None):
+        self.rag = rag
+        self.max_batch = max_batch or BATCH_MAX_SIZE
+        self.window = (BATCH_WINDOW_MS if window_ms is None else window_ms) / 1000
+        self._queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def submit(self, query, k, nprobe=None, ef_search=None, mode=None, sources=None, page_range=None, embedding=None):
+        """Future of the top k hits of query; embedding skips encoding it again."""
+        return self._put(query, k, (nprobe, ef_search, mode, sources, page_range), embedding)
+
+    def embed(self, query):
+        """Future of the embedding of query (None without an index)."""
+        return self._put(query, None, None, None)
+
+    def _put(self, query, k, params, embedding):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="query-batcher", daemon=True)
+                self._thread.start()
+        future = Future()
+        # The caller's request traces get the timings of the shared encode + search
+        self._queue.put(BatchItem(query, k, params, embedding, metrics.current_traces(), future))
+        return future
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.window
+            while len(batch) < self.max_batch:
+                timeout = deadline - time.monotonic()
+                try:
+                    batch.append(self._queue.get(timeout=timeout) if timeout > 0 else self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            self._process(batch)
+
+    def _process(self, batch):
+        # Embed-only requests share one encode call. Search parameters, mode and filters
+        # apply to a whole search call, so searches are grouped by them.
+        groups = {}
+        for item in batch:
+            groups.setdefault(item.params, []).append(item)
+        for params, items in groups.items():
+            try:
+                with metrics.tracing([trace for item in items for trace in item.traces]):
+                    results = self._embed(items) if params is None else self._search(items, *params)
+                for item, result in zip(items, results):
+                    item.future.set_result(result)
+            except Exception as e:
+                for item in items:
+                    if not item.future.done():
+                        item.future.set_exception(e)
+
+    def _embed(self, items):
+        embeddings = self.rag.embed([item.query for item in items])
+        return [None] * len(items) if embeddings is None else list(embeddings)
+
+    def _search(self, items, nprobe, ef_search, mode, sources, page_range):
+        queries = [item.query for item in items]
+        embeddings = None
+        if any(item.embedding is not None for item in items):
+            # Reuse the embeddings callers brought (e.g. from the answer cache lookup), encode the rest
+            missing = [item.query for item in items if item.embedding is None]
+            encoded = self.rag.embed(missing) if missing else []
+            if encoded is None:
+                return [[] for _ in items]
+            encoded = iter(encoded)
+            embeddings = np.stack([item.embedding if item.embedding is not None else next(encoded) for item in items])
+        results = self.rag.retrieve_batch(
+            queries, max(item.k for item in items), nprobe=nprobe, ef_search=ef_search, embeddings=embeddings,
+            mode=mode, adaptive=False, rerank=False, sources=sources, page_range=page_range
+        )
+        return [hits[:item.k] for item, hits in zip(items, results)]
+
+
 # Singleton instance
 rag_system = RAGSystem()
+atexit.register(rag_system.embedding_cache.save)
+
+def retrieve(query, k=None, **kwargs):
+    return rag_system.retrieve(query, k, **kwargs)
+
+def retrieve_batch(queries, k=None, **kwargs):
+    return rag_system.retrieve_batch(queries, k, **kwargs)
+
+def embed_queries(queries):
+    return rag_system.embed(queries)
+
+def embed_query(query):
+    return rag_system.embed_query(query)
+
+def submit_retrieve(query, k=None, **kwargs):
+    return rag_system.submit_retrieve(query, k, **kwargs)
+
+def submit_embed_query(query):
+    return rag_system.submit_embed_query(query)
+
+def index_version():
+    return rag_system.version
+
+def reload_index():
+    return rag_system.reload()
+
+def warm_up():
+    return rag_system.warm_up()
+
+def is_ready():
+    return rag_system.warmed and rag_system.state is not None
+
+def embedding_cache_stats():
+    return rag_system.embedding_cache.stats()
+
+def _cache_metrics():
+    stats = embedding_cache_stats()
+    return metrics.gauge_lines(
+        "rag_embedding_cache", "Query embedding cache: entries, hits, misses and hit ratio.",
+        {key: stats[key] for key in ("entries", "hits", "misses", "hit_ratio")}
+    ) + metrics.gauge_lines(
+        "rag_embedding_cache_seconds", "Time spent encoding cache misses, and estimated time saved by hits.",
+        {"encode": stats["encode_seconds"], "saved": stats["estimated_seconds_saved"]}
+    )
 
-def retrieve(query, k=5):
-    return rag_system.retrieve(query, k)
+metrics.COLLECTORS.append(_cache_metrics)
 
 if __name__ == "__main__":
     # Test
@@ -0,0 +1,107 @@
+import os
+import time
+import threading
+from cache import ScoreCache
+import metrics
+
+# Small cross-encoder that reads (question, chunk) together; runs on CPU
+RERANK_MODEL_NAME = os.getenv("RAG_RERANK_MODEL", "cross-encoder/ms-marco-MiniLM-L-6-v2")
+# Pairs per forward pass
+RERANK_BATCH_SIZE = int(os.getenv("RAG_RERANK_BATCH_SIZE", "16"))
+# Time budget per query; whatever is not scored by then keeps its first-stage rank
+RERANK_DEADLINE_MS = float(os.getenv("RAG_RERANK_DEADLINE_MS", "200"))
+RERANK_CACHE_SIZE = int(os.getenv("RAG_RERANK_CACHE_SIZE", "20000"))
+# Reranked hits scoring below this (in the model's output units) are dropped; unset keeps all
+RERANK_MIN_SCORE = os.getenv("RAG_RERANK_MIN_SCORE")
+
+RERANKED = metrics.Counter("rag_rerank_pairs_total", "Rerank pairs by outcome.", labels=("outcome",))
+
+
+def load_model():
+    # Imported here so that importing rerank does not pull in torch
+    from sentence_transformers import CrossEncoder
+    return CrossEncoder(RERANK_MODEL_NAME, device="cpu")
+
+
+class Reranker:
+    """
+    Second-stage ranking of retrieved chunks with a cross-encoder.
+    Pairs are scored in batches in first-stage order, with scores cached per
+    (question, chunk text). Before each batch the remaining time budget is checked
+    against the measured cost per pair; when it runs out, the scored prefix is
+    reordered and the rest keeps its first-stage order.
+    """
+    def __init__(self, model=None, batch_size=None, deadline_ms=None, cache_size=None, min_score=None):
+        self.model = model
+        self.batch_size = batch_size or RERANK_BATCH_SIZE
+        self.deadline = (RERANK_DEADLINE_MS if deadline_ms is None else deadline_ms) / 1000
+        self.cache = ScoreCache(RERANK_CACHE_SIZE if cache_size is None else cache_size)
+        self.min_score = min_score if min_score is not None else (float(RERANK_MIN_SCORE) if RERANK_MIN_SCORE else None)
+        # Running estimate of seconds per scored pair, to predict whether a batch fits
+        self.seconds_per_pair = 0.0
+        self._load_lock = threading.Lock()
+
+    def ensure_loaded(self):
+        if self.model is None:
+            with self._load_lock:
+                if self.model is None:
+                    print(f"Loading reranker {RERANK_MODEL_NAME}...")
+                    self.model = load_model()
+        return self.model
+
+    def score(self, query, texts, deadline=None):
+        """
+        Cross-encoder scores for texts, in order, with None for texts not
+        scored before the deadline (a time.perf_counter() value).
+        """
+        scores = self.cache.get_many(query, texts)
+        missing = [i for i, score in enumerate(scores) if score is None]
+        if not missing:
+            return scores
+        model = self.ensure_loaded()
+        for start in range(0, len(missing), self.batch_size):
+            batch = missing[start:start + self.batch_size]
+            if deadline is not None and time.perf_counter() + self.seconds_per_pair * len(batch) > deadline:
+                RERANKED.inc(len(missing) - start, outcome="deadline")
+                break
+            began = time.perf_counter()
+            batch_scores = model.predict([(query, texts[i]) for i in batch], batch_size=len(batch), show_progress_bar=False)
+            per_pair = (time.perf_counter() - began) / len(batch)
+            self.seconds_per_pair = per_pair if not self.seconds_per_pair else 0.8 * self.seconds_per_pair + 0.2 * per_pair
+            self.cache.put_many(query, [texts[i] for i in batch], batch_scores)
+            for i, score in zip(batch, batch_scores):
+                scores[i] = float(score)
+            RERANKED.inc(len(batch), outcome="scored")
+        return scores
+
+    def rerank(self, query, hits, k):
+        """
+        Returns the top k hits by cross-encoder score (added as "rerank_score").
+        Hits not scored within the deadline follow the scored ones in first-stage order.
+        """
+        if not hits:
+            return hits
+        with metrics.stage("rerank"):
+            deadline = time.perf_counter() + self.deadline if self.deadline > 0 else None
+            scores = self.score(query, [hit["text"] for hit in hits], deadline)
+        scored = [(score, i) for i, score in enumerate(scores) if score is not None]
+        order = [i for _, i in sorted(scored, key=lambda pair: (-pair[0], pair[1]))]
+        order += [i for i, score in enumerate(scores) if score is None]
+        results = []
+        for i in order:
+            if scores[i] is not None:
+                if self.min_score is not None and scores[i] < self.min_score:
+                    continue
+                hits[i]["rerank_score"] = scores[i]
+            results.append(hits[i])
+        return results[:k]
+
+
+def _rerank_metrics():
+    return metrics.gauge_lines("rag_rerank_cache", "Rerank pair score cache: entries, hits and misses.", {
+        "entries": len(reranker.cache), "hits": reranker.cache.hits, "misses": reranker.cache.misses
+    })
+
+
+reranker = Reranker()
+metrics.COLLECTORS.append(_rerank_metrics)
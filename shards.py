@@ -0,0 +1,322 @@
+"""
+Scatter-gather search over a FAISS index split into shards.
+
+A shard is anything with search(queries, k, nprobe, ef_search, ranges) -> (distances, ids)
+and d / ntotal / quantized / approximate attributes. LocalShard searches an index loaded in this
+process. A shard server holds one index in its own process:
+
+    RAG_SHARD_AUTHKEY=<secret> python shards.py serve indexes/<version>/faiss_index.0.bin --port 7000
+
+and ShardClient searches it over a socket, so shards can live on other cores or other
+nodes. Requests are pickled, so a server refuses to start without an authkey, and
+every connection must prove it knows the key before anything is unpickled. Bind
+--host to a private interface only; the key authenticates but does not encrypt. ProcessShard starts a local
+server for a file and connects to it. ShardedIndex sends each query batch to all
+shards at once and merges their top k by distance. ranges, an (m, 2) array of
+[first, end) ids, restricts a search to those chunks (see ChunkStore.id_ranges).
+"""
+import os
+import sys
+import zlib
+import argparse
+import threading
+import subprocess
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Listener, Client, answer_challenge, deliver_challenge
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import faiss
+from chunk_store import ids_in_ranges
+
+SHARD_AUTHKEY = os.getenv("RAG_SHARD_AUTHKEY", "")
+# Filtered searches on indexes without ID selector support (PQ) decode this many vectors at a time
+DECODE_BLOCK_SIZE = 65536
+# Filtered searches on IVF and HNSW indexes raise nprobe / efSearch by 1 / (fraction of the
+# index that passes the filter), up to this factor. The selector only drops ids from the
+# results, so without the boost the probed lists or graph walk hold few matching chunks
+FILTER_SEARCH_BOOST_MAX = float(os.getenv("RAG_FILTER_SEARCH_BOOST_MAX", "8"))
+
+
+def shard_of(source, n_shards):
+    """Shard of a source document; all chunks of a document land in the same shard."""
+    return zlib.crc32(source.encode("utf-8")) % n_shards if n_shards > 1 else 0
+
+
+def is_quantized(index):
+    """True if the index only keeps compressed codes, so its distances are approximate."""
+    if isinstance(index, ShardedIndex):
+        return index.quantized
+    inner = index
+    if isinstance(inner, faiss.IndexIDMap):
+        inner = faiss.downcast_index(inner.index)
+    return not isinstance(inner, (faiss.IndexFlat, faiss.IndexIVFFlat, faiss.IndexHNSWFlat))
+
+
+def _inner(index):
+    return faiss.downcast_index(index.index) if isinstance(index, faiss.IndexIDMap) else index
+
+
+def is_approximate(index):
+    """True for IVF and HNSW indexes, which do not look at every vector, so a filter costs them recall."""
+    if isinstance(index, ShardedIndex):
+        return index.approximate
+    return isinstance(_inner(index), (faiss.IndexIVF, faiss.IndexHNSW))
+
+
+def supports_selector(index):
+    """False for indexes that ignore the ID selector in their search parameters."""
+    return not isinstance(_inner(index), faiss.IndexPQ)
+
+
+def id_selector(ranges):
+    """FAISS ID selector for [first, end) ranges: a bounds check for one range, a hash set for more."""
+    if len(ranges) == 1:
+        return faiss.IDSelectorRange(int(ranges[0, 0]), int(ranges[0, 1]))
+    return faiss.IDSelectorBatch(ids_in_ranges(ranges))
+
+
+def search_params(index, nprobe, ef_search, ranges=None):
+    """
+    Per-call search parameters for IVF (nprobe) and HNSW (efSearch) indexes, with an
+    ID selector when ranges are given. None when there is nothing to set.
+    """
+    inner = _inner(index)
+    selector = id_selector(ranges) if ranges is not None else None
+    boost = filter_boost(index, ranges) if ranges is not None else 1
+    if isinstance(inner, faiss.IndexIVF):
+        return faiss.SearchParametersIVF(nprobe=min(int(nprobe * boost), inner.nlist), sel=selector)
+    if isinstance(inner, faiss.IndexHNSW):
+        return faiss.SearchParametersHNSW(efSearch=int(ef_search * boost), sel=selector)
+    if selector is not None:
+        return faiss.SearchParameters(sel=selector)
+    return None
+
+
+def filter_boost(index, ranges):
+    """Factor for nprobe / efSearch under a filter: 1 / the fraction of the index in ranges, capped."""
+    matched = int((ranges[:, 1] - ranges[:, 0]).sum())
+    if matched >= index.ntotal:
+        return 1
+    return min(FILTER_SEARCH_BOOST_MAX, index.ntotal / max(matched, 1))
+
+
+def search_index(index, queries, k, nprobe, ef_search, ranges=None):
+    """
+    index.search with the query-time knobs. With ranges, only those ids are scored
+    (the selector is checked before any distance is computed).
+    """
+    if ranges is None or supports_selector(index):
+        return index.search(queries, k, params=search_params(index, nprobe, ef_search, ranges))
+    # IndexPQ ignores selectors: decode just the wanted codes, a block at a time, and compare with those
+    ids = ids_in_ranges(ranges)
+    blocks = [ids[start:start + DECODE_BLOCK_SIZE] for start in range(0, len(ids), DECODE_BLOCK_SIZE)]
+    return merge_results([exact_search(queries, index.reconstruct_batch(block), block, k) for block in blocks], k)
+
+
+def exact_search(queries, vectors, ids, k):
+    """Exact L2 search of queries against a few vectors with the given ids, shaped like index.search."""
+    distances = np.full((len(queries), k), np.finfo(np.float32).max, dtype=np.float32)
+    labels = np.full((len(queries), k), -1, dtype=np.int64)
+    n = min(k, len(ids))
+    if n:
+        D, I = faiss.knn(np.ascontiguousarray(queries, dtype=np.float32), np.ascontiguousarray(vectors, dtype=np.float32), n)
+        distances[:, :n], labels[:, :n] = D, ids[I]
+    return distances, labels
+
+
+def merge_results(results, k):
+    """Merges (distances, ids) pairs of the same queries into the overall top k by distance."""
+    distances = np.hstack([D for D, _ in results])
+    ids = np.hstack([I for _, I in results])
+    distances = np.where(ids == -1, np.finfo(np.float32).max, distances)
+    top = np.argsort(distances, axis=1, kind="stable")[:, :k]
+    return np.take_along_axis(distances, top, axis=1), np.take_along_axis(ids, top, axis=1)
+
+
+class LocalShard:
+    def __init__(self, index):
+        self.index = index
+        self.d = index.d
+        self.ntotal = index.ntotal
+        self.quantized = is_quantized(index)
+        self.approximate = is_approximate(index)
+
+    def search(self, queries, k, nprobe, ef_search, ranges=None):
+        return search_index(self.index, queries, k, nprobe, ef_search, ranges)
+
+    def close(self):
+        pass
+
+
+def _handle(connection, shard, authkey):
+    with connection:
+        # Authenticated here rather than in accept(), so a silent client cannot stall the listener
+        try:
+            deliver_challenge(connection, authkey)
+            answer_challenge(connection, authkey)
+        except (AuthenticationError, EOFError, OSError):
+            return
+        while True:
+            try:
+                request = connection.recv()
+            except EOFError:
+                return
+            try:
+                if request[0] == "info":
+                    connection.send((shard.d, shard.ntotal, shard.quantized, shard.approximate))
+                else:
+                    connection.send(shard.search(*request[1:]))
+            except Exception as e:
+                connection.send(e)
+
+
+def serve(path, host="127.0.0.1", port=0, authkey=None, threads=0, ready=None):
+    """
+    Loads one shard index and answers search requests, one thread per connection.
+    Clients must authenticate with authkey, which may not be empty.
+    ready(address) is called once the listener is up.
+    """
+    if not authkey:
+        raise ValueError("A shard server needs an authkey (RAG_SHARD_AUTHKEY): requests are unpickled")
+    if threads:
+        faiss.omp_set_num_threads(threads)
+    shard = LocalShard(faiss.read_index(path))
+    with Listener((host, port)) as listener:
+        if ready is not None:
+            ready(listener.address)
+        while True:
+            connection = listener.accept()
+            threading.Thread(target=_handle, args=(connection, shard, authkey), daemon=True).start()
+
+
+class ShardClient:
+    """A shard served by `python shards.py serve`, locally or on another node (authkey defaults to RAG_SHARD_AUTHKEY)."""
+    def __init__(self, address, authkey=None):
+        self.address = tuple(address)
+        authkey = authkey or SHARD_AUTHKEY.encode()
+        if not authkey:
+            raise ValueError("Set RAG_SHARD_AUTHKEY to the key of the shard server")
+        self._connection = Client(self.address, authkey=authkey)
+        # One request at a time per connection
+        self._lock = threading.Lock()
+        self.d, self.ntotal, self.quantized, self.approximate = self._request(("info",))
+
+    def _request(self, request):
+        with self._lock:
+            self._connection.send(request)
+            result = self._connection.recv()
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    def search(self, queries, k, nprobe, ef_search, ranges=None):
+        return self._request(("search", np.ascontiguousarray(queries, dtype=np.float32), k, nprobe, ef_search, ranges))
+
+    def close(self):
+        self._connection.close()
+
+
+class ProcessShard(ShardClient):
+    """
+    Starts a shard server for one index file as a child process and connects to it,
+    so the index lives in that process's memory and is searched on its cores.
+    The server exits when this object is closed or garbage collected (its stdin closes).
+    """
+    def __init__(self, path, threads=0):
+        authkey = os.urandom(16)
+        self.process = subprocess.Popen(
+            [sys.executable, os.path.abspath(__file__), "serve", path, "--threads", str(threads), "--parent"],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True
+        )
+        self.process.stdin.write(authkey.hex() + "\n")
+        self.process.stdin.flush()
+        host, port = self.process.stdout.readline().split()
+        super().__init__((host, int(port)), authkey)
+
+    def close(self):
+        super().close()
+        self.process.stdin.close()
+        self.process.wait(timeout=5)
+
+
+class ShardedIndex:
+    """
+    Searches all shards in parallel on a thread pool and merges their results.
+    numbers: the shard number of each shard (empty shards have no file, so they are
+    not simply 0..n-1); n_shards: the shard count the index was built with.
+    """
+    def __init__(self, shards, numbers=None, n_shards=None):
+        self.shards = list(shards)
+        self.numbers = list(numbers) if numbers is not None else list(range(len(self.shards)))
+        self.n_shards = n_shards or len(self.shards)
+        self.d = self.shards[0].d
+        self.ntotal = sum(shard.ntotal for shard in self.shards)
+        self.quantized = any(shard.quantized for shard in self.shards)
+        self.approximate = any(shard.approximate for shard in self.shards)
+        self._pool = ThreadPoolExecutor(max_workers=len(self.shards), thread_name_prefix="shard-search")
+
+    def search(self, queries, k, nprobe, ef_search, ranges=None, sources=None):
+        """
+        sources: names of the only documents that can match; shards are assigned by
+        shard_of, so the shards that cannot hold any of them are skipped.
+        """
+        searched = self.shards
+        if sources is not None:
+            wanted = {shard_of(source, self.n_shards) for source in sources}
+            searched = [shard for number, shard in zip(self.numbers, self.shards) if number in wanted]
+            if not searched:
+                return (np.full((len(queries), k), np.finfo(np.float32).max, dtype=np.float32),
+                        np.full((len(queries), k), -1, dtype=np.int64))
+        futures = [self._pool.submit(shard.search, queries, k, nprobe, ef_search, ranges) for shard in searched]
+        return merge_results([future.result() for future in futures], k)
+
+    def close(self):
+        for shard in self.shards:
+            shard.close()
+        self._pool.shutdown(wait=False)
+
+
+def open_shards(paths, processes=False, threads=0, numbers=None, n_shards=None):
+    """
+    Opens shard index files as a ShardedIndex, in this process or one worker process
+    per shard. threads: OpenMP threads per worker (0 splits the cores between them).
+    numbers and n_shards are passed on to ShardedIndex (see index_versions.shard_files).
+    """
+    if not processes:
+        return ShardedIndex((LocalShard(faiss.read_index(path)) for path in paths), numbers, n_shards)
+    threads = threads or max(1, (os.cpu_count() or 1) // len(paths))
+    return ShardedIndex((ProcessShard(path, threads) for path in paths), numbers, n_shards)
+
+
+def _exit_with_parent():
+    # stdin is a pipe from the ProcessShard that started this server
+    sys.stdin.read()
+    os._exit(0)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = parser.add_subparsers(dest="command", required=True)
+    serve_parser = sub.add_parser("serve", help="serve one shard index file")
+    serve_parser.add_argument("path")
+    serve_parser.add_argument("--host", default="127.0.0.1")
+    serve_parser.add_argument("--port", type=int, default=0)
+    serve_parser.add_argument("--threads", type=int, default=0, help="OpenMP threads (0: faiss default)")
+    serve_parser.add_argument("--parent", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.parent:
+        # Started by ProcessShard: the key comes on stdin, the address goes to stdout
+        authkey = bytes.fromhex(sys.stdin.readline().strip())
+
+        def ready(address):
+            print(*address, flush=True)
+            threading.Thread(target=_exit_with_parent, daemon=True).start()
+    else:
+        if not SHARD_AUTHKEY:
+            parser.error("set RAG_SHARD_AUTHKEY: the server unpickles requests, so it only accepts clients that know the key")
+        authkey = SHARD_AUTHKEY.encode()
+
+        def ready(address):
+            print(f"Serving {args.path} on {address[0]}:{address[1]}", flush=True)
+    serve(args.path, args.host, args.port, authkey, args.threads, ready)
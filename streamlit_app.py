@@ -1,8 +1,6 @@
 import streamlit as st
 import os
 import llm
-# Import ingest only when needed or keep for re-ingest
-import ingest
 
 st.set_page_config(page_title="Aviation RAG Chatbot", page_icon="✈️", layout="wide")
 
@@ -35,20 +33,22 @@ with st.sidebar:
     st.header("Data Management")
     if st.button("Re-ingest Documents"):
         with st.spinner("Ingesting documents... This may take a while."):
+            # Imported on demand: only re-ingesting needs PDF parsing
+            import ingest
             result = ingest.run_ingestion()
             if result.get("status") == "error":
                 st.error(result.get("message"))
             else:
                 st.success(f"Ingestion complete! Indexed {result.get('chunks_count')} chunks.")
-                # Clear resource cache to force reload next time
-                st.cache_resource.clear()
-                # Reload immediately
-                get_rag_system()
+                # Swap the new index version into the running system
+                rag_system.reload()
 
 # Display chat messages
 for message in st.session_state.messages:
     with st.chat_message(message["role"]):
         st.markdown(message["content"])
+        if message.get("error"):
+            st.error(message["error"])
         if "citations" in message and message["citations"]:
             st.markdown("---")
             st.markdown("**Sources:**")
@@ -72,44 +72,49 @@ if prompt := st.chat_input("What is Vso?"):
 
     # Generate response
     with st.chat_message("assistant"):
-        with st.spinner("Searching manuals..."):
-            try:
+        try:
+            with st.spinner("Searching manuals..."):
                 # 1. Retrieve
                 # Use the cached instance directly
-                chunks = rag_system.retrieve(prompt, k=5)
-                
+                chunks = rag_system.retrieve(prompt)
+
                 # 2. Build Prompt
                 llm_prompt = llm.build_prompt(prompt, chunks)
-                
-                # 3. Ask LLM
-                response_text = llm.ask_llm(llm_prompt)
-                
-                # 4. Parse Response
-                answer = response_text
-                citations = []
-                
-                if "Citations:" in response_text:
-                    parts = response_text.split("Citations:")
-                    answer = parts[0].replace("Answer:", "").strip()
-                    citations_text = parts[1].strip()
-                    citations = [c.strip() for c in citations_text.split(";") if c.strip()]
-                else:
-                    answer = response_text.replace("Answer:", "").strip()
 
-                if "This information is not available" in answer:
-                    answer = "This information is not available in the provided document(s)."
-                    citations = []
+            # 3. Ask LLM, showing tokens as they arrive
+            placeholder = st.empty()
+            response_text = ""
+            error = None
+            if chunks:
+                try:
+                    for token in llm.stream_llm(llm_prompt):
+                        response_text += token
+                        placeholder.markdown(response_text + "▌")
+                except llm.LLMError as e:
+                    error = f"The answer was interrupted: {e}" if response_text else str(e)
+            else:
+                # Nothing relevant was retrieved, no need to ask
+                response_text = llm.REFUSAL_ANSWER
+
+            if error is not None:
+                # Whatever arrived stays in this message, marked as cut off, instead of a second error message
+                placeholder.markdown(response_text)
+                st.error(error)
+                st.session_state.messages.append({"role": "assistant", "content": response_text, "error": error})
+            else:
+                # 4. Parse Response
+                answer, citations = llm.parse_response(response_text)
 
                 # Display Answer
-                st.markdown(answer)
-                
+                placeholder.markdown(answer)
+            
                 # Display Citations
                 if citations:
                     st.markdown("---")
                     st.markdown("**Sources:**")
                     for citation in citations:
                         st.markdown(f"- {citation}")
-                
+            
                 # Display Debug Chunks
                 if debug_mode and chunks:
                     with st.expander("retrieved Context (Debug)"):
@@ -126,6 +131,6 @@ if prompt := st.chat_input("What is Vso?"):
                     "citations": citations,
                     "chunks": chunks if debug_mode else None
                 })
-                
-            except Exception as e:
-                st.error(f"An error occurred: {str(e)}")
+            
+        except Exception as e:
+            st.error(f"An error occurred: {str(e)}")
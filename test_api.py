@@ -1,16 +1,55 @@
 from fastapi.testclient import TestClient
 from main import app
-from unittest.mock import patch
+from unittest.mock import patch, AsyncMock
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import time
+import httpx
+from types import SimpleNamespace
+import llm
+import pytest
+import numpy as np
+import main
+import rag
+from test_rag import system, TEXTS
 
 client = TestClient(app)
+embed_query, submit_embed_query, submit_retrieve = rag.embed_query, rag.submit_embed_query, rag.submit_retrieve
+
+@pytest.fixture(autouse=True)
+def fresh_answer_cache():
+    # Start every test with an empty cache and no query embeddings (no model load)
+    main.answer_cache.clear()
+    # Without a batcher, main retrieves with rag.retrieve in the pool, which the tests mock
+    with patch("rag.embed_query", return_value=None), patch("rag.index_version", return_value="v1"), \
+            patch("rag.submit_embed_query", return_value=None), patch("rag.submit_retrieve", return_value=None):
+        yield
 
 def test_health():
     response = client.get("/health")
     assert response.status_code == 200
     assert response.json() == {"status": "ok"}
 
+def test_ready():
+    with patch("rag.is_ready", return_value=False):
+        response = client.get("/ready")
+    assert response.status_code == 503
+    with patch("rag.is_ready", return_value=True):
+        response = client.get("/ready")
+    assert response.status_code == 200
+    assert response.json() == {"status": "ready", "index_version": "v1"}
+
+def test_main_does_not_import_ingest_dependencies():
+    # Query workers load torch only when warm-up or the first query needs the model
+    code = "import sys, main; print(any(m in sys.modules for m in ('ingest', 'torch', 'sentence_transformers', 'pypdf')))"
+    result = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, env={**os.environ, "GROQ_API_KEY": "x"})
+    assert result.stdout.strip().splitlines()[-1] == "False"
+
 @patch("rag.retrieve")
-@patch("llm.ask_llm")
+@patch("llm.ask_llm_async", new_callable=AsyncMock)
 def test_ask(mock_ask_llm, mock_retrieve):
     
     mock_retrieve.return_value = [
@@ -30,10 +69,33 @@ def test_ask(mock_ask_llm, mock_retrieve):
     assert len(data["retrieved_chunks"]) == 2
 
 @patch("rag.retrieve")
-@patch("llm.ask_llm")
+@patch("llm.ask_llm_async", new_callable=AsyncMock)
+def test_ask_timings_and_metrics(mock_ask_llm, mock_retrieve):
+    mock_retrieve.return_value = [
+        {"text": "Vso is the stall speed in landing configuration.", "source": "book1.pdf", "page": 10, "score": 0.1}
+    ]
+    mock_ask_llm.return_value = "Answer: Vso is the stall speed in landing configuration.\nCitations: book1.pdf, Page 10"
+
+    data = client.post("/ask", json={"question": "What is Vso?", "debug": True}).json()
+    assert {"queue", "retrieve", "build_prompt", "parse", "ask"} <= set(data["timings_ms"])
+    assert data["timings_ms"]["ask"] >= data["timings_ms"]["retrieve"]
+    assert client.post("/ask", json={"question": "What is Vne?"}).json()["timings_ms"] is None
+
+    llm.metrics.record_usage(SimpleNamespace(prompt_tokens=120, completion_tokens=30))
+    response = client.get("/metrics")
+    assert response.status_code == 200
+    assert 'rag_stage_seconds_count{stage="build_prompt"}' in response.text
+    assert 'rag_stage_in_flight{stage="ask"} 0' in response.text
+    assert 'rag_llm_tokens_total{type="prompt"}' in response.text
+    assert 'rag_answer_cache{kind="hit_ratio"}' in response.text
+    assert 'rag_embedding_cache{kind="hits"}' in response.text
+
+@patch("rag.retrieve")
+@patch("llm.ask_llm_async", new_callable=AsyncMock)
 def test_ask_refusal(mock_ask_llm, mock_retrieve):
-    # Mock retrieval with irrelevant chunks
+    # No chunk passed retrieval (e.g. all beyond the adaptive-k score threshold)
     mock_retrieve.return_value = []
+    skipped = main.LLM_SKIPPED._values.get((), 0)
     
     # Mock LLM response
     mock_ask_llm.return_value = "This information is not available in the provided document(s)."
@@ -44,6 +106,250 @@ def test_ask_refusal(mock_ask_llm, mock_retrieve):
     data = response.json()
     assert data["answer"] == "This information is not available in the provided document(s)."
     assert data["citations"] == []
+    # Refused right away, without a Groq round trip
+    mock_ask_llm.assert_not_called()
+    assert main.LLM_SKIPPED._values[()] == skipped + 1
+
+@patch("rag.retrieve")
+@patch("llm.ask_llm_async", new_callable=AsyncMock)
+def test_ask_llm_error_is_flagged_and_not_cached(mock_ask_llm, mock_retrieve):
+    mock_retrieve.return_value = [
+        {"text": "Vso is the stall speed in landing configuration.", "source": "book1.pdf", "page": 10, "score": 0.1}
+    ]
+    mock_ask_llm.return_value = "Error communicating with LLM: rate limited"
+
+    data = client.post("/ask", json={"question": "What is Vso?"}).json()
+    assert data["error"] == "Error communicating with LLM: rate limited"
+
+    mock_ask_llm.return_value = "Answer: Vso is the stall speed in landing configuration.\nCitations: book1.pdf, Page 10"
+    data = client.post("/ask", json={"question": "What is Vso?"}).json()
+    assert data["error"] is None
+    assert data["answer"] == "Vso is the stall speed in landing configuration."
+    assert mock_ask_llm.await_count == 2
+
+def _parse_sse(body):
+    events = []
+    for frame in body.strip().split("\n\n"):
+        lines = dict(line.split(": ", 1) for line in frame.split("\n"))
+        events.append((lines["event"], json.loads(lines["data"])))
+    return events
+
+@patch("rag.retrieve")
+@patch("llm.stream_llm_async")
+def test_ask_stream(mock_stream_llm, mock_retrieve):
+    mock_retrieve.return_value = [
+        {"text": "Vso is the stall speed in landing configuration.", "source": "book1.pdf", "page": 10, "score": 0.1}
+    ]
+
+    async def tokens(prompt):
+        for token in ["Answer: Vso is the stall ", "speed in landing configuration.", "\nCitations: book1.pdf, Page 10"]:
+            yield token
+    mock_stream_llm.side_effect = tokens
+
+    response = client.post("/ask/stream", json={"question": "What is Vso?"})
+
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/event-stream")
+    events = _parse_sse(response.text)
+    assert [name for name, _ in events] == ["chunks", "token", "token", "token", "done"]
+    assert events[0][1]["chunks"] == [{"source": "book1.pdf", "page": 10, "score": 0.1}]
+    assert events[-1][1] == {
+        "answer": "Vso is the stall speed in landing configuration.",
+        "citations": ["book1.pdf, Page 10"]
+    }
+
+@patch("rag.retrieve")
+@patch("llm.ask_llm_async", new_callable=AsyncMock)
+def test_ask_answer_cache(mock_ask_llm, mock_retrieve):
+    mock_retrieve.return_value = [
+        {"text": "Vso is the stall speed in landing configuration.", "source": "book1.pdf", "page": 10, "score": 0.1}
+    ]
+    mock_ask_llm.return_value = "Answer: Vso is the stall speed in landing configuration.\nCitations: book1.pdf, Page 10"
+
+    first = client.post("/ask", json={"question": "What is Vso?"}).json()
+    # Same question after normalization: served from the exact level
+    second = client.post("/ask", json={"question": "  what is VSO "}).json()
+    assert second == first
+    assert mock_ask_llm.await_count == 1
+
+    # Paraphrase whose embedding is close enough: served from the semantic level
+    with patch("rag.embed_query", return_value=[1.0, 0.0, 0.0]):
+        client.post("/ask", json={"question": "Define Vso"})
+    with patch("rag.embed_query", return_value=[0.999, 0.01, 0.0]):
+        third = client.post("/ask", json={"question": "What does Vso mean?"}).json()
+    assert third == first
+    assert mock_ask_llm.await_count == 2
+
+    # A new index version invalidates everything
+    with patch("rag.index_version", return_value="v2"):
+        client.post("/ask", json={"question": "What is Vso?"})
+    assert mock_ask_llm.await_count == 3
+
+@patch("rag.retrieve")
+@patch("llm.ask_llm_async", new_callable=AsyncMock)
+def test_ask_filters(mock_ask_llm, mock_retrieve):
+    mock_retrieve.return_value = [
+        {"text": "Vso is the stall speed in landing configuration.", "source": "book1.pdf", "page": 10, "score": 0.1}
+    ]
+    mock_ask_llm.return_value = "Answer: Vso is the stall speed in landing configuration.\nCitations: book1.pdf, Page 10"
+
+    client.post("/ask", json={"question": "What is Vso?"})
+    response = client.post("/ask", json={"question": "What is Vso?", "sources": ["book1.pdf"], "page_range": [5, 20]})
+    assert response.status_code == 200
+    assert mock_retrieve.call_args.kwargs["sources"] == ["book1.pdf"]
+    assert mock_retrieve.call_args.kwargs["page_range"] == (5, 20)
+    # Filtered questions neither read nor fill the answer cache
+    assert mock_ask_llm.await_count == 2
+    client.post("/ask", json={"question": "What is Vso?"})
+    assert mock_ask_llm.await_count == 2
+
+@patch("rag.retrieve_batch")
+@patch("llm.ask_llm_async", new_callable=AsyncMock)
+def test_ask_batch(mock_ask_llm, mock_retrieve_batch):
+    questions = ["What is Vso?", "What is Vne?", "What is Vx?"]
+    mock_retrieve_batch.side_effect = lambda queries, k=5, **kwargs: [
+        [{"text": f"{q} chunk", "source": "book1.pdf", "page": 10, "score": 0.1}] for q in queries
+    ]
+
+    async def answer(prompt):
+        if "Vne" in prompt:
+            return "Error communicating with LLM: rate limited"
+        return "Answer: A speed.\nCitations: book1.pdf, Page 10"
+    mock_ask_llm.side_effect = answer
+
+    embeddings = np.eye(3, dtype=np.float32)
+    with patch("rag.embed_queries", return_value=embeddings):
+        response = client.post("/ask_batch", json={"questions": questions})
+
+    assert response.status_code == 200
+    results = sorted((json.loads(line) for line in response.text.splitlines()), key=lambda r: r["index"])
+    assert [r["question"] for r in results] == questions
+    assert results[0]["answer"] == "A speed." and results[2]["citations"] == ["book1.pdf, Page 10"]
+    assert "rate limited" in results[1]["error"]
+    # One matrix search for the whole batch
+    assert mock_retrieve_batch.call_count == 1
+    assert mock_retrieve_batch.call_args.args[0] == questions
+
+def _slow_retrieve(query, k=5, **kwargs):
+    time.sleep(0.05)  # blocking, like encode + FAISS search
+    return [{"text": "Vso is the stall speed in landing configuration.", "source": "book1.pdf", "page": 10, "score": 0.1}]
+
+async def _slow_llm(prompt):
+    await asyncio.sleep(0.2)  # network wait on Groq
+    return "Answer: Vso is the stall speed.\nCitations: book1.pdf, Page 10"
+
+def _throughput(clients, requests_per_client=2):
+    async def client_loop(http, client_id):
+        for i in range(requests_per_client):
+            # Distinct questions so the answer cache does not short-circuit the pipeline
+            response = await http.post("/ask", json={"question": f"What is Vso? ({clients}-{client_id}-{i})"})
+            assert response.status_code == 200
+
+    async def run():
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as http:
+            start = time.perf_counter()
+            await asyncio.gather(*(client_loop(http, c) for c in range(clients)))
+            return clients * requests_per_client / (time.perf_counter() - start)
+
+    return asyncio.run(run())
+
+@patch("rag.retrieve", side_effect=_slow_retrieve)
+@patch("llm.ask_llm_async", side_effect=_slow_llm)
+def test_ask_throughput_scales_with_clients(mock_ask_llm, mock_retrieve):
+    single = _throughput(1)
+    concurrent = _throughput(8)
+    # Served one at a time this would stay ~4 req/s regardless of client count
+    assert concurrent > 3 * single
+
+@patch("llm.ask_llm_async", new_callable=AsyncMock)
+def test_concurrent_asks_are_batched_with_answer_cache(mock_ask_llm, system):
+    mock_ask_llm.return_value = "Answer: A speed.\nCitations: poh.pdf, Page 10"
+    system.model.delay = 0.02
+    system.batcher = rag.QueryBatcher(system, max_batch=32, window_ms=50)
+    searches = []
+    retrieve_batch = system.retrieve_batch
+    system.retrieve_batch = lambda queries, *args, **kwargs: (searches.append(len(queries)), retrieve_batch(queries, *args, **kwargs))[1]
+
+    async def run():
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as http:
+            return await asyncio.gather(*(http.post("/ask", json={"question": question, "debug": True}) for question in questions))
+
+    # More concurrent requests than retrieval pool threads
+    questions = [f"{text} ({i})" for i, (text, _, _) in enumerate(TEXTS * 4)]
+    assert len(questions) > main.RETRIEVAL_WORKERS
+
+    # The cache lookup embedding goes through the batcher and is reused by retrieval;
+    # requests wait for their batch on the event loop, not on pool threads
+    with patch("rag.rag_system", system), patch("rag.embed_query", embed_query), \
+            patch("rag.submit_embed_query", submit_embed_query), patch("rag.submit_retrieve", submit_retrieve):
+        responses = asyncio.run(run())
+
+    assert main.answer_cache.enabled
+    assert system.model.calls == 1
+    assert searches == [len(questions)]
+    del system.retrieve_batch
+    for question, response in zip(questions, responses):
+        assert response.status_code == 200
+        assert response.json()["retrieved_chunks"][0]["text"] == system.retrieve(question, k=1)[0]["text"]
+
+@patch("rag.retrieve")
+@patch("llm.stream_llm_async")
+def test_ask_stream_error_after_tokens_is_not_cached(mock_stream_llm, mock_retrieve):
+    mock_retrieve.return_value = [
+        {"text": "Vso is the stall speed in landing configuration.", "source": "book1.pdf", "page": 10, "score": 0.1}
+    ]
+
+    async def broken(prompt):
+        yield "Answer: Vso is the stall "
+        raise llm.LLMError("Error communicating with LLM: connection reset")
+    mock_stream_llm.side_effect = broken
+
+    events = _parse_sse(client.post("/ask/stream", json={"question": "What is Vso?"}).text)
+    assert [name for name, _ in events] == ["chunks", "token", "error"]
+    assert "connection reset" in events[-1][1]["detail"]
+
+    # Neither the exact nor the semantic level kept the partial answer
+    with patch("rag.embed_query", return_value=[1.0, 0.0, 0.0]):
+        client.post("/ask/stream", json={"question": "What is Vso?"})
+    assert mock_stream_llm.call_count == 2
+    assert main.answer_cache.stats()["entries"] == 0
+
+class _FailingStubCompletions(llm._StubCompletions):
+    """Stub LLM that fails right away, or after the first streamed token."""
+    def _completion(self, kwargs):
+        raise RuntimeError("Groq went away")
+
+    def _chunks(self, kwargs):
+        yield next(super()._chunks(kwargs))
+        raise RuntimeError("Groq went away")
+
+@patch("rag.retrieve")
+def test_load_test_counts_llm_errors(mock_retrieve, monkeypatch):
+    import evaluate
+    mock_retrieve.return_value = [
+        {"text": "Vso is the stall speed in landing configuration.", "source": "book1.pdf", "page": 10, "score": 0.1}
+    ]
+    monkeypatch.setattr(llm, "LLM_STUB_TOKEN_MS", 0)
+    stub = llm.StubClient(asynchronous=True)
+    monkeypatch.setattr(llm, "async_client", stub)
+
+    async def send(question, stream):
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as http:
+            return await evaluate.send_request(http, question, stream)
+
+    for stream in (False, True):
+        result = asyncio.run(send(f"What is Vso? ({stream})", stream))
+        assert result["error"] is None
+    assert result["ttft"] is not None
+
+    # Both endpoints answer 200, but the load test counts the failures
+    stub.chat.completions = _FailingStubCompletions(asynchronous=True)
+    for stream in (False, True):
+        result = asyncio.run(send(f"What is Vne? ({stream})", stream))
+        assert "Groq went away" in result["error"]
 
 import traceback
 
@@ -51,8 +357,13 @@ if __name__ == "__main__":
     # Manually run tests if pytest not available
     try:
         test_health()
+        test_ready()
         test_ask()
         test_ask_refusal()
+        test_ask_stream()
+        test_ask_answer_cache()
+        test_ask_batch()
+        test_ask_throughput_scales_with_clients()
         print("All tests passed!")
     except Exception as e:
         print(f"Tests failed: {e}")
@@ -0,0 +1,385 @@
+import os
+import time
+import hashlib
+import numpy as np
+import faiss
+import pytest
+import ingest
+import index_versions
+from chunk_store import ChunkStore, ChunkStoreWriter
+from shards import shard_of
+
+DIM = 16
+
+
+class LengthModel:
+    """Encodes each text as [length, position in its forward pass] and records the pass sizes."""
+    def __init__(self):
+        self.passes = []
+
+    def encode(self, texts, **kwargs):
+        self.passes.append([len(text) for text in texts])
+        return np.array([[len(text), i] for i, text in enumerate(texts)], dtype=np.float32)
+
+
+class HashModel:
+    """Deterministic unit vector per text."""
+    def encode(self, texts, **kwargs):
+        vectors = []
+        for text in texts:
+            seed = int(hashlib.md5(text.encode()).hexdigest()[:8], 16)
+            v = np.random.default_rng(seed).standard_normal(DIM)
+            vectors.append(v / np.linalg.norm(v))
+        return np.array(vectors, dtype=np.float32).reshape(len(texts), DIM)
+
+
+class FakePage:
+    """A page mentioning "slow" takes a while to extract, so parallel tasks finish out of order."""
+    def __init__(self, text):
+        self.text = text
+
+    def extract_text(self):
+        if "slow" in self.text:
+            time.sleep(0.05)
+        return self.text
+
+
+class FakePdfReader:
+    """Reads a text file whose pages are separated by form feeds; a file starting with CORRUPT fails to open."""
+    def __init__(self, path):
+        with open(path) as f:
+            text = f.read()
+        if text.startswith("CORRUPT"):
+            raise ValueError("not a PDF")
+        self.pages = [FakePage(page) for page in text.split("\f")]
+
+
+@pytest.fixture
+def library(tmp_path, monkeypatch):
+    """Empty data folder and index directory in tmp_path, with PDFs and the embedding model faked."""
+    monkeypatch.chdir(tmp_path)
+    os.makedirs(ingest.DATA_FOLDER)
+    monkeypatch.setattr(ingest, "PdfReader", FakePdfReader)
+    monkeypatch.setattr(ingest, "load_model", HashModel)
+    monkeypatch.setattr(ingest, "ENCODE_WORKERS", 1)
+    monkeypatch.setattr(ingest, "PQ_M", 4)
+
+    def write(name, pages):
+        with open(os.path.join(ingest.DATA_FOLDER, name), "w") as f:
+            f.write("\f".join(pages))
+    return write
+
+
+def pages_of(name, count, version=0):
+    return [f"{name} page {page} revision {version} about stall speed and flaps" for page in range(1, count + 1)]
+
+
+def check_index(expected):
+    """The current version holds exactly the expected {(source, page): text}, and each text finds its own chunk."""
+    manifest, indexes, store = ingest.load_existing()
+    assert manifest is not None
+    chunks = {(chunk["source"], chunk["page"]): (chunk_id, chunk["text"]) for chunk_id, chunk in store.items()}
+    assert {key: text for key, (_, text) in chunks.items()} == expected
+    index = indexes[0]
+    assert index.ntotal == len(expected)
+    for chunk_id, text in chunks.values():
+        _, ids = index.search(HashModel().encode([text]), 1)
+        assert ids[0, 0] == chunk_id
+    store.close()
+
+
+def chunk_ids():
+    """{(source, page): chunk id} of the current version."""
+    _, _, store = ingest.load_existing()
+    ids = {(chunk["source"], chunk["page"]): chunk_id for chunk_id, chunk in store.items()}
+    store.close()
+    return ids
+
+
+def test_incremental_ingestion_adds_changes_deletes_and_skips(library):
+    a, b = pages_of("a.pdf", 3), pages_of("b.pdf", 2)
+    library("a.pdf", a)
+    result = ingest.run_ingestion()
+    assert (result["added"], result["removed"], result["chunks_count"]) == (3, 0, 3)
+    check_index({("a.pdf", page): text for page, text in enumerate(a, start=1)})
+
+    # Add a file: the chunks of a.pdf keep their ids
+    before = chunk_ids()
+    library("b.pdf", b)
+    result = ingest.run_ingestion()
+    assert (result["added"], result["removed"], result["chunks_count"]) == (2, 0, 5)
+    expected = {(name, page): text for name, pages in (("a.pdf", a), ("b.pdf", b)) for page, text in enumerate(pages, start=1)}
+    check_index(expected)
+    assert {key: chunk_id for key, chunk_id in chunk_ids().items() if key[0] == "a.pdf"} == before
+
+    # Change one page: only that page is re-chunked, under a new id
+    before = chunk_ids()
+    a[1] = "a.pdf page 2 rewritten to cover the never exceed speed instead"
+    library("a.pdf", a)
+    result = ingest.run_ingestion()
+    assert (result["added"], result["removed"], result["chunks_count"]) == (1, 1, 5)
+    expected[("a.pdf", 2)] = a[1]
+    check_index(expected)
+    after = chunk_ids()
+    assert after[("a.pdf", 2)] not in before.values()
+    assert {key: after[key] for key in before if key != ("a.pdf", 2)} == {key: before[key] for key in before if key != ("a.pdf", 2)}
+
+    # Delete a file
+    os.remove(os.path.join(ingest.DATA_FOLDER, "b.pdf"))
+    result = ingest.run_ingestion()
+    assert (result["added"], result["removed"], result["chunks_count"]) == (0, 2, 3)
+    expected = {key: text for key, text in expected.items() if key[0] == "a.pdf"}
+    check_index(expected)
+
+    # Nothing changed: no new version is written
+    version = index_versions.current_version()
+    result = ingest.run_ingestion()
+    assert (result["added"], result["removed"], result["chunks_count"]) == (0, 0, 3)
+    assert index_versions.current_version() == version
+    check_index(expected)
+
+
+@pytest.mark.parametrize("index_type", ingest.INDEX_TYPES)
+def test_add_and_repeated_deletes_for_each_index_type(library, monkeypatch, index_type):
+    monkeypatch.setattr(ingest, "INDEX_TYPE", index_type)
+    expected = {}
+    for name in ("a.pdf", "b.pdf", "c.pdf"):
+        library(name, pages_of(name, 3))
+        expected.update({(name, page): text for page, text in enumerate(pages_of(name, 3), start=1)})
+    assert ingest.run_ingestion()["added"] == 9
+
+    # Remove, add, then remove again: IVF used to abort the process on the second remove
+    os.remove(os.path.join(ingest.DATA_FOLDER, "a.pdf"))
+    assert ingest.run_ingestion()["removed"] == 3
+    library("d.pdf", pages_of("d.pdf", 2))
+    assert ingest.run_ingestion()["added"] == 2
+    os.remove(os.path.join(ingest.DATA_FOLDER, "b.pdf"))
+    result = ingest.run_ingestion()
+    assert (result["added"], result["removed"]) == (0, 3)
+    expected = {key: text for key, text in expected.items() if key[0] == "c.pdf"}
+    expected.update({("d.pdf", page): text for page, text in enumerate(pages_of("d.pdf", 2), start=1)})
+    check_index(expected)
+
+    os.remove(os.path.join(ingest.DATA_FOLDER, "c.pdf"))
+    os.remove(os.path.join(ingest.DATA_FOLDER, "d.pdf"))
+    assert ingest.run_ingestion()["removed"] == 5
+    library("e.pdf", pages_of("e.pdf", 1))
+    assert ingest.run_ingestion()["added"] == 1
+    check_index({("e.pdf", 1): pages_of("e.pdf", 1)[0]})
+
+
+def test_ivf_is_retrained_once_the_corpus_outgrows_its_lists(library, monkeypatch):
+    monkeypatch.setattr(ingest, "INDEX_TYPE", "ivf")
+    library("small.pdf", pages_of("small.pdf", 40))
+    ingest.run_ingestion()
+    _, indexes, _ = ingest.load_existing()
+    assert faiss.downcast_index(indexes[0].index).nlist == 1
+
+    library("large.pdf", pages_of("large.pdf", 200))
+    ingest.run_ingestion()
+    _, indexes, _ = ingest.load_existing()
+    assert faiss.downcast_index(indexes[0].index).nlist == 240 // 39
+    assert indexes[0].ntotal == 240
+
+
+def test_parallel_extraction_keeps_serial_order_and_skips_corrupt_files(library, monkeypatch):
+    monkeypatch.setattr(ingest, "PAGES_PER_TASK", 2)
+    library("a.pdf", ["a1 slow", "a2", "a3 slow", "a4", "a5"])
+    library("b.pdf", ["CORRUPT"])
+    library("c.pdf", ["c1", "c2 slow"])
+    library("d.pdf", ["d1 slow"])
+    files = ingest.list_documents()
+
+    serial = list(ingest.iter_files(files, workers=1))
+    assert serial == [
+        ("a.pdf", [(1, "a1 slow"), (2, "a2"), (3, "a3 slow"), (4, "a4"), (5, "a5")]),
+        ("b.pdf", None),
+        ("c.pdf", [(1, "c1"), (2, "c2 slow")]),
+        ("d.pdf", [(1, "d1 slow")]),
+    ]
+    for _ in range(3):
+        assert list(ingest.iter_files(files, workers=3)) == serial
+
+
+def test_corrupt_pdf_does_not_fail_the_run(library):
+    good = pages_of("good.pdf", 3)
+    library("good.pdf", good)
+    library("bad.pdf", ["CORRUPT"])
+    result = ingest.run_ingestion(workers=2)
+    assert (result["status"], result["added"]) == ("success", 3)
+    check_index({("good.pdf", page): text for page, text in enumerate(good, start=1)})
+    manifest, _, _ = ingest.load_existing()
+    assert "bad.pdf" not in manifest["files"]
+
+    # Once readable it is picked up like any new file
+    library("bad.pdf", pages_of("bad.pdf", 1))
+    assert ingest.run_ingestion(workers=2)["added"] == 1
+
+
+def test_stage_stats_count_items_and_busy_time():
+    stats = ingest.StageStats("extract", "pages")
+    with stats.measure(3):
+        time.sleep(0.02)
+
+    def produce():
+        for page in range(2):
+            time.sleep(0.02)
+            yield page
+    # Time spent by the consumer between items is not the producer's
+    for _ in stats.timed(produce()):
+        stats.count += 1
+        time.sleep(0.05)
+
+    assert stats.count == 5
+    assert 0.06 <= stats.seconds < 0.15
+    assert stats.rate == pytest.approx(5 / stats.seconds)
+    assert str(stats).startswith("extract: 5 pages in ")
+    assert ingest.StageStats("embed", "vectors").rate == 0.0
+
+
+def test_ingestion_reports_throughput_per_stage(library, capsys):
+    library("a.pdf", pages_of("a.pdf", 4))
+    library("b.pdf", pages_of("b.pdf", 2))
+    result = ingest.run_ingestion()
+    assert set(result["throughput"]) == {"extract", "chunk", "embed", "insert"}
+    out = capsys.readouterr().out
+    for line in ("extract: 6 pages", "chunk: 6 chunks", "embed: 6 vectors", "insert: 6 vectors"):
+        assert line in out
+
+
+def test_source_filter_finds_documents_next_to_empty_shards(library, monkeypatch):
+    import rag
+    monkeypatch.setattr(ingest, "INDEX_SHARDS", 4)
+    monkeypatch.setattr(rag, "FILTER_EXACT_MAX", 0)
+    # poh.pdf lands in shard 1 and a.pdf in shard 3, so shards 0 and 2 have no file
+    library("poh.pdf", pages_of("poh.pdf", 2))
+    library("a.pdf", pages_of("a.pdf", 2))
+    ingest.run_ingestion()
+    assert [number for number, _ in index_versions.shard_files(index_versions.current_dir())] == [1, 3]
+
+    system = rag.RAGSystem()
+    system.batcher = None
+    system.model = HashModel()
+    system.load_resources()
+    try:
+        for name in ("poh.pdf", "a.pdf"):
+            query = pages_of(name, 2)[1]
+            hits = system.retrieve(query, k=3, sources=[name], mode="vector", adaptive=False, rerank=False)
+            assert [hit["source"] for hit in hits] == [name, name]
+            assert hits[0]["text"] == query
+    finally:
+        system.index.close()
+
+
+def test_encoder_sorts_by_length_and_keeps_input_order():
+    texts = ["x" * n for n in (50, 800, 120, 790, 60, 400, 55)]
+    model = LengthModel()
+    encoder = ingest.Encoder(model, batch_size=2, workers=1)
+    embeddings = encoder.encode(texts)
+
+    assert embeddings[:, 0].tolist() == [len(text) for text in texts]
+    # Longest first, similar lengths share a forward pass
+    assert model.passes == [[800, 790], [400, 120], [60, 55], [50]]
+    assert encoder.padded_tokens < encoder.unsorted_padded_tokens
+
+
+def write_store(path, rows):
+    """rows: (chunk_id, text, source, page, vector or None)."""
+    writer = ChunkStoreWriter(str(path))
+    for chunk_id, text, source, page, vector in rows:
+        writer.add(chunk_id, {"text": text, "source": source, "page": page}, vector)
+    writer.close()
+    return ChunkStore(str(path))
+
+
+def test_chunk_store_round_trip(tmp_path):
+    vectors = np.arange(12, dtype=np.float32).reshape(3, 4)
+    rows = [
+        (7, "Vso: 48 KIAS — flaps 30°", "poh.pdf", 10, vectors[0]),
+        (3, "Vne: 163 KIAS", "poh.pdf", 12, vectors[1]),
+        (5, "Density altitude", "phak.pdf", 41, vectors[2]),
+    ]
+    store = write_store(tmp_path / "store", rows)
+    assert len(store) == 3
+    assert list(store.items()) == [(chunk_id, {"text": text, "source": source, "page": page}) for chunk_id, text, source, page, _ in rows]
+    assert store[7]["text"] == "Vso: 48 KIAS — flaps 30°"
+    assert 3 in store and 4 not in store
+    assert store.get(4) is None
+    with pytest.raises(KeyError):
+        store[4]
+    assert store.rows_of([3, 4, 7, 100, -1]).tolist() == [1, -1, 0, -1, -1]
+    np.testing.assert_array_equal(store.vectors, vectors)
+    assert store.id_ranges(sources=["poh.pdf"]).tolist() == [[3, 4], [7, 8]]
+    store.close()
+
+
+def test_empty_chunk_store(tmp_path):
+    store = write_store(tmp_path / "store", [])
+    assert len(store) == 0
+    # Nothing to map: the text buffer is an empty bytes object
+    assert store._text == b""
+    assert list(store.items()) == []
+    assert store.get(1) is None and 1 not in store
+    assert store.rows_of([1, 2]).tolist() == [-1, -1]
+    assert store.vectors is None
+    assert store.id_ranges().shape == (0, 2)
+    store.close()
+
+
+def test_chunk_store_keeps_vectors_only_if_every_row_has_one(tmp_path):
+    store = write_store(tmp_path / "some", [(1, "a", "x.pdf", 1, np.ones(4)), (2, "b", "x.pdf", 1, None)])
+    assert store.vectors is None
+    assert store[2]["text"] == "b"
+    store.close()
+    store = write_store(tmp_path / "none", [(1, "a", "x.pdf", 1, None)])
+    assert store.vectors is None
+    store.close()
+
+
+def test_copy_rows_and_directory_swap(tmp_path):
+    path = str(tmp_path / "store")
+    rows = [(chunk_id, f"chunk {chunk_id}", f"{chunk_id % 2}.pdf", chunk_id, np.full(4, chunk_id)) for chunk_id in range(6)]
+    old = write_store(path, rows)
+
+    # Rewrite the same directory from the open store, keeping the even ids and adding one
+    writer = ChunkStoreWriter(path)
+    old.copy_rows(writer, keep=lambda chunk_id: chunk_id % 2 == 0)
+    writer.add(10, {"text": "chunk 10", "source": "new.pdf", "page": 1}, np.full(4, 10))
+    writer.close()
+    assert sorted(os.listdir(tmp_path)) == ["store"]
+
+    new = ChunkStore(path)
+    assert [chunk_id for chunk_id, _ in new.items()] == [0, 2, 4, 10]
+    assert new[4] == {"text": "chunk 4", "source": "0.pdf", "page": 4}
+    np.testing.assert_array_equal(new.vectors[:, 0], [0, 2, 4, 10])
+    # The reader opened before the swap still sees its own mapped files
+    assert len(old) == 6 and old[5]["text"] == "chunk 5"
+    np.testing.assert_array_equal(old.vectors[5], np.full(4, 5))
+    old.close()
+    new.close()
+
+
+def test_shards_are_assigned_by_source_and_rebuilt_losslessly(tmp_path):
+    sources = [f"manual-{n}.pdf" for n in range(6)]
+    ids = np.arange(40, dtype=np.int64)
+    vectors = np.random.default_rng(0).standard_normal((40, 8)).astype(np.float32)
+    writer = ChunkStoreWriter(str(tmp_path / "chunk_store"))
+    for chunk_id, vector in zip(ids, vectors):
+        writer.add(chunk_id, {"text": f"chunk {chunk_id}", "source": sources[chunk_id % 6], "page": 1}, vector)
+    writer.close()
+    store = ChunkStore(str(tmp_path / "chunk_store"))
+
+    sharded = ingest.ShardedIndexWriter([None] * 3, "flat")
+    sharded.add(ids, vectors, [sources[i % 6] for i in ids])
+    indexes = sharded.finish()
+    for shard, index in enumerate(indexes):
+        for chunk_id in faiss.vector_to_array(index.id_map):
+            assert shard_of(sources[chunk_id % 6], 3) == shard
+
+    # Re-sharding (and re-typing) uses the exact vectors of the chunk store
+    rebuilt = ingest.rebuild_shards(indexes, "sq8", 2, store)
+    assert len(rebuilt) == 2
+    found = np.sort(np.concatenate([faiss.vector_to_array(index.id_map) for index in rebuilt if index is not None]))
+    assert found.tolist() == ids.tolist()
+    single = ingest.rebuild_shards(rebuilt, "flat", 1, store)[0]
+    np.testing.assert_array_equal(single.reconstruct(7), vectors[7])
@@ -0,0 +1,176 @@
+import re
+import json
+import time
+import asyncio
+import groq
+import httpx
+import pytest
+import llm
+import generate_questions
+from chunk_store import ChunkStore, ChunkStoreWriter
+from ingest import chunk_text
+
+PAGE = " ".join(f"Step {i}: check item {i} and confirm the annunciator panel shows no caution lights." for i in range(30))
+
+
+def test_pack_context_merges_overlapping_chunks():
+    pieces = chunk_text(PAGE)
+    assert len(pieces) >= 3
+    chunks = [
+        {"id": 10 + i, "text": text, "source": "poh.pdf", "page": 4, "score": 0.5 + i / 10}
+        for i, text in enumerate(pieces[:3])
+    ]
+    packed, stats = llm.pack_context(chunks, token_budget=10000)
+
+    assert len(packed) == 1
+    assert packed[0]["text"] == " ".join(PAGE.split())[:len(packed[0]["text"])]
+    assert packed[0]["score"] == 0.5
+    assert stats["tokens_saved"] > 0 and stats["chunks_out"] == 1
+
+
+def test_pack_context_drops_near_duplicates_and_respects_budget():
+    text = "Vso is the stall speed or the minimum steady flight speed in the landing configuration."
+    chunks = [
+        {"id": 1, "text": text, "source": "poh.pdf", "page": 10, "score": 0.2},
+        {"id": 2, "text": text + " See also", "source": "phak.pdf", "page": 4, "score": 0.3},
+        {"id": 3, "text": "Vne is the never exceed speed. " * 20, "source": "poh.pdf", "page": 12, "score": 0.4},
+        {"id": 4, "text": "Va is the design maneuvering speed.", "source": "poh.pdf", "page": 13, "score": 0.5},
+    ]
+    packed, stats = llm.pack_context(chunks, token_budget=80)
+
+    # The duplicate from phak.pdf is dropped and the long chunk does not fit
+    assert [c["id"] for c in packed] == [1, 4]
+    assert stats["tokens_after"] <= 80
+
+    prompt = llm.build_prompt("What is Vso?", chunks, token_budget=80)
+    assert "phak.pdf" not in prompt and "Chunk 2" in prompt and "Chunk 3" not in prompt
+
+
+def test_parse_questions_takes_the_first_json_array():
+    text = 'Sure [see below]:\n[{"excerpt": 1, "question": "What is the stall speed?"}, {"excerpt": 3, "question": "Too short"}]\nHope this helps [1].'
+    assert generate_questions.parse_questions(text, 2) == {1: "What is the stall speed?"}
+    assert generate_questions.parse_questions("no JSON [here]", 2) == {}
+    assert generate_questions.parse_questions(None, 2) == {}
+
+
+def test_token_bucket_paces_bursts_and_pauses():
+    async def run():
+        bucket = generate_questions.TokenBucket(600, capacity=2)  # 10 per second
+        start = time.monotonic()
+        await bucket.acquire()
+        await bucket.acquire()
+        burst = time.monotonic() - start
+        await bucket.acquire()
+        paced = time.monotonic() - start
+        bucket.pause(0.2)
+        await bucket.acquire()
+        return burst, paced, time.monotonic() - start - paced
+    burst, paced, paused = asyncio.run(run())
+    assert burst < 0.05
+    assert 0.08 <= paced < 0.3
+    assert paused >= 0.2
+
+
+def _rate_limit_error(retry_after=None):
+    headers = {"retry-after": str(retry_after)} if retry_after is not None else {}
+    response = httpx.Response(429, headers=headers, request=httpx.Request("POST", "https://api.groq.com"))
+    return groq.RateLimitError("rate limited", response=response, body=None)
+
+
+def test_question_generation_retries_with_backoff(tmp_path, monkeypatch):
+    monkeypatch.setattr(generate_questions, "BACKOFF_SECONDS", 0.01)
+    monkeypatch.setattr(generate_questions, "MAX_ATTEMPTS", 3)
+    monkeypatch.setattr(generate_questions, "REQUESTS_PER_MINUTE", 6000)
+    calls = []
+
+    async def complete(prompt, client=None, system_prompt=None):
+        calls.append(system_prompt)
+        if len(calls) == 1:
+            raise _rate_limit_error(retry_after=0.05)
+        if len(calls) == 2:
+            raise groq.APIConnectionError(request=httpx.Request("POST", "https://api.groq.com"))
+        return "[]"
+    monkeypatch.setattr(llm, "complete_async", complete)
+
+    generator = generate_questions.QuestionGenerator(None, checkpoint=str(tmp_path / "partial"))
+    start = time.monotonic()
+    assert asyncio.run(generator._complete("prompt", 1)) == "[]"
+    # retry-after of the 429 first, then the backoff
+    assert time.monotonic() - start >= 0.05 + 0.02
+    assert calls == [generate_questions.SYSTEM_PROMPT] * 3
+
+    calls.clear()
+    monkeypatch.setattr(llm, "complete_async", lambda *args, **kwargs: (calls.append(1), _raise(_rate_limit_error()))[1])
+    with pytest.raises(groq.RateLimitError):
+        asyncio.run(generator._complete("prompt", 1))
+    assert len(calls) == 3
+
+
+def _raise(error):
+    raise error
+
+
+def _question_store(path, count):
+    writer = ChunkStoreWriter(str(path))
+    for chunk_id in range(count):
+        writer.add(chunk_id, {"text": f"Excerpt {chunk_id} about stall speeds", "source": f"{chunk_id % 3}.pdf", "page": chunk_id})
+    writer.close()
+    return ChunkStore(str(path))
+
+
+def test_question_generation_resumes_from_checkpoint(tmp_path, monkeypatch):
+    monkeypatch.setattr(generate_questions, "CATEGORIES", {"factual": 4, "applied": 2})
+    store = _question_store(tmp_path / "store", 20)
+    checkpoint = str(tmp_path / "questions.json.partial")
+    prompts = []
+
+    def answer(prompt):
+        excerpts = [int(number) for number in re.findall(r"^\s*\[(\d+)\]$", prompt, re.MULTILINE)]
+        return json.dumps([{"excerpt": number, "question": f"Question about excerpt {number}?"} for number in excerpts])
+
+    async def interrupted(prompt, client=None, system_prompt=None):
+        prompts.append(prompt)
+        if "1 applied question" in prompt:
+            raise ValueError("interrupted")
+        return answer(prompt)
+    monkeypatch.setattr(llm, "complete_async", interrupted)
+    first = generate_questions.QuestionGenerator(store, per_prompt=2, checkpoint=checkpoint)
+    asyncio.run(first.run())
+    assert [q["category"] for q in first.questions] == ["factual"] * 4
+    with open(checkpoint, "a") as f:
+        f.write('{"category": "applied", "chunk_')  # cut off mid-line
+
+    async def complete(prompt, client=None, system_prompt=None):
+        prompts.append(prompt)
+        return answer(prompt)
+    monkeypatch.setattr(llm, "complete_async", complete)
+    prompts.clear()
+    second = generate_questions.QuestionGenerator(store, per_prompt=2, checkpoint=checkpoint)
+    second.resume()
+    questions = asyncio.run(second.run())
+
+    # Only the missing category was asked for, from chunks not used before
+    assert len(prompts) == 1 and "1 applied question" in prompts[0]
+    assert sorted(q["category"] for q in questions) == ["applied"] * 2 + ["factual"] * 4
+    used = [q["chunk_id"] for q in questions]
+    assert len(set(used)) == 6
+    for q in questions:
+        assert q["source"] == store[q["chunk_id"]]["source"] == q["source_chunk_id"]
+    store.close()
+
+
+def test_stream_llm_raises_instead_of_yielding_the_error(monkeypatch):
+    class Failing(llm._StubCompletions):
+        def _chunks(self, kwargs):
+            yield next(super()._chunks(kwargs))
+            raise RuntimeError("Groq went away")
+    stub = llm.StubClient()
+    stub.chat.completions = Failing(asynchronous=False)
+    monkeypatch.setattr(llm, "client", stub)
+    monkeypatch.setattr(llm, "LLM_STUB_TOKEN_MS", 0)
+
+    tokens = []
+    with pytest.raises(llm.LLMError, match="Groq went away"):
+        for token in llm.stream_llm("prompt"):
+            tokens.append(token)
+    assert tokens == ["Answer:"]
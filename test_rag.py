@@ -0,0 +1,425 @@
+import re
+import hashlib
+import threading
+import time
+import numpy as np
+import faiss
+import pytest
+import rag
+import rerank
+import shards
+from cache import EmbeddingCache
+import index_versions
+import metrics
+from chunk_store import ChunkStore, ChunkStoreWriter
+from lexical import LexicalIndex, build_lexical_index, reciprocal_rank_fusion
+
+DIM = 16
+
+TEXTS = [
+    ("Vso is the stall speed in landing configuration.", "poh.pdf", 10),
+    ("Vne is the never exceed speed.", "poh.pdf", 12),
+    ("Engine failure during takeoff run: throttle idle, brakes as required.", "sop.pdf", 3),
+    ("Density altitude increases takeoff distance.", "phak.pdf", 41),
+]
+
+
+class FakeModel:
+    """Deterministic stand-in for SentenceTransformer that counts encode calls."""
+    def __init__(self, delay=0.0):
+        self.delay = delay
+        self.calls = 0
+
+    def encode(self, texts, **kwargs):
+        self.calls += 1
+        time.sleep(self.delay)
+        vectors = []
+        for text in texts:
+            seed = int(hashlib.md5(text.encode()).hexdigest()[:8], 16)
+            v = np.random.default_rng(seed).standard_normal(DIM)
+            vectors.append(v / np.linalg.norm(v))
+        return np.array(vectors, dtype=np.float32).reshape(len(texts), DIM)
+
+
+class FakeCrossEncoder:
+    """Scores a (question, text) pair by the number of words they share."""
+    def __init__(self):
+        self.pairs = 0
+
+    def predict(self, pairs, batch_size=32, show_progress_bar=None):
+        self.pairs += len(pairs)
+        words = lambda text: set(re.findall(r"\w+", text.lower()))
+        return np.array([len(words(query) & words(text)) for query, text in pairs], dtype=np.float32)
+
+
+@pytest.fixture
+def system(tmp_path):
+    model = FakeModel()
+    writer = ChunkStoreWriter(str(tmp_path / "chunk_store"))
+    ids = np.arange(100, 100 + len(TEXTS), dtype=np.int64)
+    for chunk_id, (text, source, page) in zip(ids, TEXTS):
+        writer.add(chunk_id, {"text": text, "source": source, "page": page})
+    writer.close()
+
+    index = faiss.IndexIDMap2(faiss.IndexFlatL2(DIM))
+    index.add_with_ids(model.encode([text for text, _, _ in TEXTS]), ids)
+
+    chunks = ChunkStore(str(tmp_path / "chunk_store"))
+    build_lexical_index(chunks, str(tmp_path / "lexical_index"))
+
+    system = rag.RAGSystem()
+    system.embedding_cache = EmbeddingCache(max_entries=100)
+    system.state = rag.IndexState(index, chunks, LexicalIndex(str(tmp_path / "lexical_index")), "v1")
+    system.model = model
+    model.calls = 0
+    return system
+
+
+def test_retrieve_returns_chunk_for_exact_text(system):
+    hits = system.retrieve(TEXTS[1][0], k=2)
+    assert hits[0]["id"] == 101
+    assert hits[0]["source"] == "poh.pdf" and hits[0]["page"] == 12
+    assert hits[0]["score"] == pytest.approx(0.0, abs=1e-5)
+
+
+def test_select_hits_applies_threshold_and_elbow():
+    hits = [{"id": i, "score": score} for i, score in enumerate([0.2, 0.25, 0.9, 1.0, 1.7])]
+    assert [h["id"] for h in rag.select_hits(hits, 5, score_threshold=1.5, min_gap=0.15)] == [0, 1]
+    assert [h["id"] for h in rag.select_hits(hits, 5, score_threshold=1.5, min_gap=1.0)] == [0, 1, 2, 3]
+    assert [h["id"] for h in rag.select_hits(hits, 3, score_threshold=1.5, min_gap=1.0)] == [0, 1, 2]
+    assert rag.select_hits(hits, 5, score_threshold=0.1) == []
+
+
+def test_adaptive_retrieve_keeps_only_relevant_chunks(system):
+    assert len(system.retrieve(TEXTS[0][0], k=4)) == 4
+    hits = system.retrieve(TEXTS[0][0], k=4, adaptive=True, score_threshold=1.0)
+    assert [h["id"] for h in hits] == [100]
+    assert system.retrieve("unrelated question", k=4, adaptive=True, score_threshold=0.01) == []
+    assert system.retrieve_batch([TEXTS[0][0], TEXTS[1][0]], k=4, adaptive=True, score_threshold=1.0) == [
+        system.retrieve(TEXTS[0][0], k=4, adaptive=True, score_threshold=1.0),
+        system.retrieve(TEXTS[1][0], k=4, adaptive=True, score_threshold=1.0),
+    ]
+
+
+def test_rerank_reorders_caches_and_falls_back_at_deadline(system):
+    query = "density takeoff distance"
+    model = FakeCrossEncoder()
+    system.reranker = rerank.Reranker(model, batch_size=2, deadline_ms=0)
+    hits = system.retrieve(query, k=2, rerank=True)
+    assert [h["id"] for h in hits] == [103, 102]
+    assert hits[0]["rerank_score"] == 3
+    assert model.pairs == len(TEXTS)
+    assert system.retrieve_batch([query], k=2, rerank=True) == [hits]
+    assert model.pairs == len(TEXTS)
+
+    # A budget too small for even one batch keeps the first-stage order
+    system.reranker = rerank.Reranker(model, batch_size=2, deadline_ms=1)
+    system.reranker.seconds_per_pair = 1.0
+    first_stage = [h["id"] for h in system.retrieve(query, k=2, rerank=False)]
+    assert [h["id"] for h in system.retrieve(query, k=2, rerank=True)] == first_stage
+    assert model.pairs == len(TEXTS)
+
+
+def test_retrieve_batch_uses_one_encode_call(system):
+    results = system.retrieve_batch([text for text, _, _ in TEXTS], k=1)
+    assert [hits[0]["id"] for hits in results] == [100, 101, 102, 103]
+    assert system.model.calls == 1
+
+
+def test_concurrent_retrieves_are_coalesced(system):
+    system.model.delay = 0.02
+    system.batcher = rag.QueryBatcher(system, max_batch=16, window_ms=20)
+    results = [None] * 8
+
+    traces = [None] * 8
+
+    def ask(i):
+        traces[i] = metrics.start_trace()
+        results[i] = system.retrieve(TEXTS[i % len(TEXTS)][0], k=1 + i % 2)
+
+    threads = [threading.Thread(target=ask, args=(i,)) for i in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert system.model.calls < 8
+    for i, hits in enumerate(results):
+        assert len(hits) == 1 + i % 2
+        assert hits[0]["id"] == 100 + i % len(TEXTS)
+        # Each request is charged the shared encode + search it waited on
+        assert "search" in traces[i]
+
+
+def test_repeated_queries_hit_embedding_cache(system):
+    first = system.retrieve_batch([TEXTS[0][0], TEXTS[1][0], TEXTS[0][0]], k=1)
+    assert system.model.calls == 1
+    second = system.retrieve_batch(["  " + TEXTS[0][0], TEXTS[1][0]], k=1)
+    assert system.model.calls == 1
+    assert [hits[0]["id"] for hits in first + second] == [100, 101, 100, 100, 101]
+    stats = system.embedding_cache.stats()
+    assert stats["hits"] == 2 and stats["misses"] == 3 and stats["entries"] == 2
+
+
+def test_embedding_cache_is_bounded_and_persists(tmp_path):
+    path = str(tmp_path / "embeddings.npz")
+    cache = EmbeddingCache(max_entries=2, path=path)
+    cache.put_many("m", ["a", "b", "c"], np.eye(3, dtype=np.float32))
+    assert cache.get_many("m", ["a", "c", "c"])[0] is None
+    assert cache.get_many("other-model", ["c"]) == [None]
+    cache.save()
+
+    reloaded = EmbeddingCache(max_entries=2, path=path)
+    assert len(reloaded) == 2
+    np.testing.assert_array_equal(reloaded.get_many("m", ["c"])[0], [0, 0, 1])
+
+
+def test_quantized_index_is_rescored_with_stored_vectors(system, tmp_path):
+    model = FakeModel()
+    vectors = model.encode([text for text, _, _ in TEXTS])
+    ids = np.arange(100, 100 + len(TEXTS), dtype=np.int64)
+    writer = ChunkStoreWriter(str(tmp_path / "quantized_store"))
+    for chunk_id, (text, source, page), vector in zip(ids, TEXTS, vectors):
+        writer.add(chunk_id, {"text": text, "source": source, "page": page}, vector)
+    writer.close()
+    chunks = ChunkStore(str(tmp_path / "quantized_store"))
+    assert np.array_equal(chunks.vectors, vectors)
+    assert chunks.rows_of([103, 7, 100]).tolist() == [3, -1, 0]
+
+    index = faiss.index_factory(DIM, "IDMap2,PQ4x2")
+    index.train(vectors)
+    index.add_with_ids(vectors, ids)
+    assert rag.is_quantized(index) and not rag.is_quantized(system.index)
+    system.state = rag.IndexState(index, chunks, None, "v2")
+
+    hits = system.retrieve(TEXTS[2][0], k=2)
+    # Exact distances, not the PQ approximation
+    assert hits[0]["id"] == 102 and hits[0]["score"] == pytest.approx(0.0, abs=1e-5)
+
+
+@pytest.mark.parametrize("processes", [False, True])
+def test_sharded_index_matches_single_index(system, tmp_path, processes):
+    model = FakeModel()
+    vectors = model.encode([text for text, _, _ in TEXTS])
+    queries = model.encode(["stall speed", "takeoff distance"])
+    paths = []
+    for shard in range(2):
+        index = faiss.IndexIDMap2(faiss.IndexFlatL2(DIM))
+        rows = [i for i, (_, source, _) in enumerate(TEXTS) if shards.shard_of(source, 2) == shard]
+        index.add_with_ids(vectors[rows], np.array(rows, dtype=np.int64) + 100)
+        paths.append(str(tmp_path / f"faiss_index.{shard}.bin"))
+        faiss.write_index(index, paths[-1])
+
+    sharded = shards.open_shards(paths, processes=processes)
+    try:
+        assert sharded.ntotal == len(TEXTS)
+        D, I = sharded.search(queries, 3, None, None)
+        expected_D, expected_I = system.index.search(queries, 3)
+        np.testing.assert_array_equal(I, expected_I)
+        np.testing.assert_allclose(D, expected_D, rtol=1e-6)
+        # Asking for more than there are pads with -1, like faiss
+        assert (sharded.search(queries, 6, None, None)[1][:, 4:] == -1).all()
+        # Filtered by source: only the shard holding sop.pdf is searched
+        ranges = system.chunks.id_ranges(["sop.pdf"])
+        assert sharded.search(queries, 3, None, None, ranges, ["sop.pdf"])[1][:, :2].tolist() == [[102, -1], [102, -1]]
+
+        single = system.retrieve_batch(["stall speed"], k=3)
+        system.state = rag.IndexState(sharded, system.chunks, system.lexical, "v2")
+        assert system.retrieve_batch(["stall speed"], k=3) == single
+    finally:
+        sharded.close()
+
+
+def test_shard_server_rejects_unauthenticated_clients(tmp_path):
+    from multiprocessing import AuthenticationError
+    from multiprocessing.connection import Client
+    path = str(tmp_path / "faiss_index.0.bin")
+    index = faiss.IndexIDMap2(faiss.IndexFlatL2(DIM))
+    index.add_with_ids(FakeModel().encode(["a", "b"]), np.array([100, 101], dtype=np.int64))
+    faiss.write_index(index, path)
+    with pytest.raises(ValueError):
+        shards.serve(path, authkey=b"")
+
+    ready, addresses = threading.Event(), []
+    threading.Thread(
+        target=shards.serve, args=(path,), kwargs={"authkey": b"secret", "ready": lambda a: (addresses.append(a), ready.set())},
+        daemon=True
+    ).start()
+    assert ready.wait(5)
+
+    # A client without the key gets a challenge, fails it, and is disconnected unanswered
+    connection = Client(addresses[0])
+    connection.send(("info",))
+    messages = []
+    with pytest.raises(EOFError):
+        while True:
+            messages.append(connection.recv_bytes())
+    assert messages[0].startswith(b"#CHALLENGE#") and messages[-1] == b"#FAILURE#"
+    with pytest.raises(AuthenticationError):
+        shards.ShardClient(addresses[0], b"wrong")
+    # The server keeps serving clients with the key
+    client = shards.ShardClient(addresses[0], b"secret")
+    assert client.ntotal == 2
+    client.close()
+
+
+@pytest.mark.parametrize("stored_vectors", [False, True])
+def test_filtered_retrieve_searches_only_matching_chunks(system, tmp_path, stored_vectors):
+    chunks = system.chunks
+    np.testing.assert_array_equal(chunks.id_ranges(["poh.pdf"]), [[100, 102]])
+    # poh.pdf page 12 and phak.pdf page 41; sop.pdf page 3 splits the ids
+    np.testing.assert_array_equal(chunks.id_ranges(page_range=(11, 50)), [[101, 102], [103, 104]])
+    assert len(chunks.id_ranges(["missing.pdf"])) == 0
+
+    if stored_vectors:
+        # Small subsets are compared exactly with the vectors in the chunk store instead of the index
+        writer = ChunkStoreWriter(str(tmp_path / "store_with_vectors"))
+        vectors = FakeModel().encode([text for text, _, _ in TEXTS])
+        for row, (text, source, page) in enumerate(TEXTS):
+            writer.add(100 + row, {"text": text, "source": source, "page": page}, vectors[row])
+        writer.close()
+        system.state = system.state._replace(chunks=ChunkStore(str(tmp_path / "store_with_vectors")), index=None)
+
+    hits = system.retrieve(TEXTS[2][0], k=3, sources=["poh.pdf"])
+    assert sorted(hit["id"] for hit in hits) == [100, 101]
+    assert [hit["id"] for hit in system.retrieve(TEXTS[2][0], k=3, page_range=(1, 5))] == [102]
+    assert [hit["id"] for hit in system.retrieve_batch(["Vne"], k=3, sources=["phak.pdf", "sop.pdf"], page_range=(40, 41))[0]] == [103]
+    hybrid = system.retrieve("Vne speed", k=3, mode="hybrid", sources=["phak.pdf"])
+    assert [hit["id"] for hit in hybrid] == [103]
+    assert system.retrieve(TEXTS[0][0], sources=["missing.pdf"]) == []
+
+
+def test_filtered_search_on_ivf_and_hnsw_widens_or_goes_exact(monkeypatch):
+    vectors = np.random.default_rng(0).standard_normal((400, DIM)).astype(np.float32)
+    ids = np.arange(400, dtype=np.int64)
+    ivf = faiss.IndexIDMap2(faiss.IndexIVFFlat(faiss.IndexFlatL2(DIM), DIM, 8))
+    ivf.train(vectors)
+    hnsw = faiss.IndexIDMap2(faiss.IndexHNSWFlat(DIM, 8))
+    flat = faiss.IndexIDMap2(faiss.IndexFlatL2(DIM))
+    for index in (ivf, hnsw, flat):
+        index.add_with_ids(vectors, ids)
+    few, most = np.array([[0, 10]]), np.array([[0, 300]])
+
+    # 10 of 400 chunks pass: the budget grows by up to FILTER_SEARCH_BOOST_MAX, nprobe at most to nlist
+    monkeypatch.setattr(shards, "FILTER_SEARCH_BOOST_MAX", 8)
+    assert shards.search_params(ivf, 2, 16).nprobe == 2
+    assert shards.search_params(ivf, 2, 16, few).nprobe == 8
+    assert shards.search_params(hnsw, 2, 16, few).efSearch == 128
+    assert shards.search_params(hnsw, 2, 16, most).efSearch == 21
+    D, I = shards.search_index(ivf, vectors[:1], 3, 1, 16, few)
+    assert I[0, 0] == 0 and set(I[0]) <= set(range(10))
+
+    # Past FILTER_EXACT_MAX, small fractions of an IVF / HNSW corpus are still compared exactly
+    monkeypatch.setattr(rag, "FILTER_EXACT_MAX", 0)
+    monkeypatch.setattr(rag, "FILTER_EXACT_FRACTION", 0.05)
+    assert rag.RAGSystem._filter_is_exact(hnsw, few) and rag.RAGSystem._filter_is_exact(ivf, few)
+    assert not rag.RAGSystem._filter_is_exact(flat, few)
+    assert not rag.RAGSystem._filter_is_exact(hnsw, most)
+
+
+def test_lexical_search_ranks_exact_tokens(system):
+    scores, ids = system.lexical.search("Vne speed?", 3)
+    assert ids.tolist() == [101, 100]
+    assert scores[0] > scores[1] > 0
+    assert len(system.lexical.search("pasta", 3)[1]) == 0
+
+
+def test_reciprocal_rank_fusion():
+    _, ids = reciprocal_rank_fusion([[1, 2, 3, -1], [3, 4]], k=3)
+    assert ids.tolist() == [3, 1, 2]
+
+
+def test_hybrid_retrieve_finds_exact_token(system):
+    # The fake embeddings of "Vne" are unrelated to the chunk; BM25 carries it
+    hits = system.retrieve("Vne", k=2, mode="hybrid")
+    assert hits[0]["id"] == 101
+    assert len(hits) == 2
+
+
+def test_onnx_encoder_matches_torch_embeddings(tmp_path):
+    pytest.importorskip("onnxruntime")
+    pytest.importorskip("onnx")
+    from transformers import BertConfig, BertModel, BertTokenizerFast
+    from sentence_transformers import SentenceTransformer
+    from sentence_transformers.sentence_transformer.modules import Transformer, Pooling, Normalize
+    import onnx_encoder
+
+    # A tiny BERT in the shape of all-MiniLM-L6-v2: mean pooling, then normalization
+    words = sorted({word for text, _, _ in TEXTS for word in re.findall(r"\w+", text.lower())})
+    (tmp_path / "bert").mkdir()
+    (tmp_path / "bert" / "vocab.txt").write_text("\n".join(["[PAD]", "[UNK]", "[CLS]", "[SEP]", "[MASK]", ".", ":", ","] + words) + "\n")
+    BertTokenizerFast(str(tmp_path / "bert" / "vocab.txt")).save_pretrained(str(tmp_path / "bert"))
+    config = BertConfig(vocab_size=len(words) + 8, hidden_size=32, num_hidden_layers=2, num_attention_heads=2, intermediate_size=64)
+    BertModel(config).save_pretrained(str(tmp_path / "bert"))
+    transformer = Transformer(str(tmp_path / "bert"), max_seq_length=16)
+    model = SentenceTransformer(modules=[transformer, Pooling(32), Normalize()], device="cpu")
+    model.save(str(tmp_path / "model"))
+
+    onnx_encoder.export(str(tmp_path / "model"), str(tmp_path / "onnx"))
+    texts = [text for text, _, _ in TEXTS] + ["Vso?", " ".join([TEXTS[2][0]] * 4)]
+    expected = model.encode(texts)
+    fp32 = onnx_encoder.OnnxEncoder(str(tmp_path / "onnx")).encode(texts, batch_size=4)
+    np.testing.assert_allclose(fp32, expected, atol=1e-5)
+    int8 = onnx_encoder.OnnxEncoder(str(tmp_path / "onnx"), quantized=True).encode(texts)
+    assert onnx_encoder.cosine_parity(expected, int8) > 0.99
+
+
+def _publish_version(texts, first_id, shard_count=1):
+    model = FakeModel()
+    version = index_versions.new_version()
+    path = index_versions.create(version)
+    writer = ChunkStoreWriter(f"{path}/{index_versions.CHUNK_STORE_DIR}")
+    ids = np.arange(first_id, first_id + len(texts), dtype=np.int64)
+    for chunk_id, text in zip(ids, texts):
+        writer.add(chunk_id, {"text": text, "source": "poh.pdf", "page": 1})
+    writer.close()
+    for shard in range(shard_count):
+        index = faiss.IndexIDMap2(faiss.IndexFlatL2(DIM))
+        index.add_with_ids(model.encode(texts[shard::shard_count]), ids[shard::shard_count])
+        name = index_versions.INDEX_FILE if shard_count == 1 else index_versions.SHARD_FILE.format(shard)
+        faiss.write_index(index, f"{path}/{name}")
+    index_versions.publish(version)
+    return version
+
+
+def test_reload_swaps_in_new_version(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    first = _publish_version([text for text, _, _ in TEXTS[:2]], 0)
+    system = rag.RAGSystem()
+    system.batcher = None
+    system.model = FakeModel()
+    system.load_resources()
+    assert system.version == first
+
+    second = _publish_version([text for text, _, _ in TEXTS], 100)
+    with system.using_state() as old_state:
+        assert system.reload()
+        assert system.version == second
+        assert system.retrieve(TEXTS[3][0], k=1)[0]["id"] == 103
+        # A query that started on the old state can still finish on it
+        assert old_state.chunks.get(1)["text"] == TEXTS[1][0]
+    # ...and the old state is closed once that query is done
+    with pytest.raises(ValueError):
+        old_state.chunks.get(1)
+    assert not system.reload()
+
+
+def test_reloads_do_not_accumulate_shard_processes(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(rag, "SHARD_PROCESSES", True)
+    texts = [text for text, _, _ in TEXTS]
+    _publish_version(texts, 0, shard_count=2)
+    system = rag.RAGSystem()
+    system.batcher = None
+    system.model = FakeModel()
+    system.load_resources()
+    processes = [shard.process for shard in system.index.shards]
+
+    for version in range(1, 4):
+        _publish_version(texts, 100 * version, shard_count=2)
+        assert system.reload()
+        assert system.retrieve(TEXTS[2][0], k=1)[0]["id"] == 100 * version + 2
+        processes.extend(shard.process for shard in system.index.shards)
+    # Only the shards of the current version are still running
+    assert [process.poll() is None for process in processes] == [False] * 6 + [True] * 2
+    system.index.close()